@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+from dotenv import load_dotenv
+from jobs import job_manager
+from tenants import current_tenant_id
+
+# Load environment variables
+load_dotenv()
+
+def _parse_rate(value):
+    """'5/3600' -> (5 commands, per 3600 seconds)"""
+    count, _, seconds = value.partition('/')
+    return float(count), float(seconds or 60)
+
+# Commands any one user may start, as <count>/<seconds>, across all commands
+RATE_LIMIT_USER = _parse_rate(os.getenv('RATE_LIMIT_USER', '30/60'))
+
+# Per user and command, e.g. "backup:2/3600,export:6/600"; "*" applies to unlisted commands
+RATE_LIMITS = {
+    name.strip(): _parse_rate(rate)
+    for name, rate in (
+        item.split(':') for item in os.getenv(
+            'RATE_LIMITS',
+            'backup:2/3600,pbackup:2/3600,ibackup:4/3600,export:6/600,rebuild:2/3600,bundle:4/600,*:6/60'
+        ).split(',') if item
+    )
+}
+
+# Backups running or queued at once per CRM, across all its users (0 = no limit)
+BACKUP_MAX_ACTIVE = int(os.getenv('BACKUP_MAX_ACTIVE', 1))
+
+class TokenBucket:
+    """Allows bursts of up to capacity commands, refilled at capacity per period"""
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is now)"""
+        self.tokens = min(self.capacity, self.tokens + max(0, now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class AdmissionController:
+    """Decides whether a user's command may queue a job
+
+    A command needs a token from the user's bucket and from the bucket of
+    that user and command; tokens are only taken when both have one, so a
+    refused command costs nothing. Backups are also capped per tenant, across
+    its users, since each one is a full mysqldump of its production database.
+    """
+
+    def __init__(self, user_limit=RATE_LIMIT_USER, limits=None, max_backups=BACKUP_MAX_ACTIVE, jobs=job_manager):
+        self.user_limit = user_limit
+        self.limits = dict(RATE_LIMITS if limits is None else limits)
+        self.max_backups = max_backups
+        self.jobs = jobs
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._stats = {'admitted': 0, 'rate_limited': 0, 'backups_limited': 0}
+
+    def _bucket(self, key, limit):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*limit)
+        return bucket
+
+    def admit(self, user_id, command, job_type):
+        """Take the tokens for a command; returns (None, 0) when it may run, otherwise
+        ('rate', seconds until it would be admitted) or ('backups', 0)"""
+        with self._lock:
+            backups = self.jobs.active('backup', current_tenant_id()) if job_type == 'backup' else 0
+            if self.max_backups and backups >= self.max_backups:
+                self._stats['backups_limited'] += 1
+                return 'backups', 0
+
+            buckets = [self._bucket((user_id, None), self.user_limit)]
+            limit = self.limits.get(command, self.limits.get('*'))
+            if limit:
+                buckets.append(self._bucket((user_id, command), limit))
+            now = time.monotonic()
+            wait = max(bucket.wait_time(now) for bucket in buckets)
+            if wait:
+                self._stats['rate_limited'] += 1
+                return 'rate', wait
+
+            for bucket in buckets:
+                bucket.take()
+            self._stats['admitted'] += 1
+            return None, 0
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, buckets=len(self._buckets))
+
+admission = AdmissionController()
@@ -0,0 +1,281 @@
+import os
+import time
+import decimal
+import sqlite3
+import datetime
+import threading
+from dotenv import load_dotenv
+from database import execute_query
+from tenants import TenantLocal
+
+# Load environment variables
+load_dotenv()
+
+# Aggregate store configuration
+REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')
+AGGREGATES_DB = os.getenv('AGGREGATES_DB', os.path.join(REPORTS_DIR, 'aggregates.db'))
+USE_AGGREGATES = os.getenv('USE_AGGREGATES', 'true').lower() in ('1', 'true', 'yes')
+# Seconds between incremental refreshes triggered by report requests
+AGGREGATES_REFRESH_INTERVAL = float(os.getenv('AGGREGATES_REFRESH_INTERVAL', 60))
+
+# Fact -> source table, summed column, row filter and optional grouping column
+FACTS = {
+    'sales': {
+        'table': 'tblinvoices',
+        'amount': 'total',
+        'where': 'status != 5',  # Not cancelled
+        'group': None,
+    },
+    'payments': {
+        'table': 'tblinvoicepaymentrecords',
+        'amount': 'amount',
+        'where': None,
+        'group': 'paymentmode',
+    },
+}
+
+def _month_range(year, month):
+    start = datetime.date(year, month, 1)
+    end = datetime.date(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+class AggregateStore:
+    """Per-month rollups of the sales and payments fact tables, kept in SQLite
+
+    refresh() only recomputes the months touched by rows added since the
+    stored watermark (plus the current and previous month, where edits and
+    cancellations usually happen). Stock Perfex has no index on the date
+    columns, so they are recomputed with one grouped query over a primary key
+    range: from the lowest id any of those months held when last computed.
+    As ids grow with time, that reads about the rows of the recent months.
+    rebuild() recomputes everything to reconcile any drift, such as a row
+    whose date was edited into a month from before that id.
+    """
+
+    def __init__(self, path=AGGREGATES_DB):
+        self.path = path
+        self._lock = threading.RLock()
+        self._db = None
+        self._refreshed = {}
+
+    def _connect(self):
+        # Called with the lock held
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS rollups (
+                    fact TEXT NOT NULL,
+                    year INTEGER NOT NULL,
+                    month INTEGER NOT NULL,
+                    grp TEXT NOT NULL DEFAULT '',
+                    count INTEGER NOT NULL,
+                    total TEXT NOT NULL,
+                    PRIMARY KEY (fact, year, month, grp)
+                );
+                CREATE TABLE IF NOT EXISTS bounds (
+                    fact TEXT NOT NULL,
+                    year INTEGER NOT NULL,
+                    month INTEGER NOT NULL,
+                    min_id INTEGER NOT NULL,
+                    PRIMARY KEY (fact, year, month)
+                );
+                CREATE TABLE IF NOT EXISTS watermarks (
+                    fact TEXT PRIMARY KEY,
+                    max_id INTEGER NOT NULL,
+                    refreshed REAL NOT NULL
+                );
+            """)
+            self._db.commit()
+        return self._db
+
+    def _watermark(self, db, fact):
+        row = db.execute("SELECT max_id FROM watermarks WHERE fact = ?", (fact,)).fetchone()
+        return row[0] if row else None
+
+    def _set_watermark(self, db, fact, max_id):
+        db.execute(
+            "INSERT OR REPLACE INTO watermarks (fact, max_id, refreshed) VALUES (?, ?, ?)",
+            (fact, max_id, time.time())
+        )
+
+    def _grouped_query(self, fact, conditions=()):
+        """Per month (and group) count, total and lowest id of a fact's rows
+
+        The fact's row filter goes into the aggregates rather than the WHERE
+        clause, so min_id covers every row of the month, e.g. a cancelled
+        invoice that is later reinstated.
+        """
+        definition = FACTS[fact]
+        group = definition['group']
+        select_group = f"{group} AS grp, " if group else ""
+        group_by = f", {group}" if group else ""
+        counted = f"CASE WHEN {definition['where']} THEN {{}} END" if definition['where'] else "{}"
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        return (
+            f"SELECT YEAR(date) AS year, MONTH(date) AS month, {select_group}"
+            f"COUNT({counted.format(1)}) AS count, SUM({counted.format(definition['amount'])}) AS total, "
+            f"MIN(id) AS min_id "
+            f"FROM {definition['table']} {where}"
+            f"GROUP BY YEAR(date), MONTH(date){group_by}"
+        )
+
+    def _bounds(self, db, fact):
+        return {
+            (year, month): min_id
+            for year, month, min_id in db.execute("SELECT year, month, min_id FROM bounds WHERE fact = ?", (fact,))
+        }
+
+    def _recompute_months(self, db, fact, months, watermark):
+        """Recompute the rollups of the given (year, month)s with one query over a primary key range"""
+        months = sorted(months)
+        bounds = self._bounds(db, fact)
+        start_id = min([bounds[month] for month in months if month in bounds] + [watermark + 1])
+        start, _ = _month_range(*months[0])
+        rows = execute_query(self._grouped_query(fact, ["id >= %s", "date >= %s"]), (start_id, start))
+
+        for year, month in months:
+            db.execute("DELETE FROM rollups WHERE fact = ? AND year = ? AND month = ?", (fact, year, month))
+            db.execute("DELETE FROM bounds WHERE fact = ? AND year = ? AND month = ?", (fact, year, month))
+        wanted = set(months)
+        lowest = {}
+        for row in rows:
+            key = (row['year'], row['month'])
+            # Later months outside the set are only partly inside the id range
+            if key not in wanted:
+                continue
+            lowest[key] = min(lowest.get(key, row['min_id']), row['min_id'])
+            if row['count']:
+                db.execute(
+                    "INSERT INTO rollups (fact, year, month, grp, count, total) VALUES (?, ?, ?, ?, ?, ?)",
+                    (fact, *key, str(row.get('grp') or ''), row['count'], str(row['total'] or 0))
+                )
+        db.executemany(
+            "INSERT INTO bounds (fact, year, month, min_id) VALUES (?, ?, ?, ?)",
+            [(fact, year, month, min_id) for (year, month), min_id in lowest.items()]
+        )
+
+    def refresh(self, fact, max_age=0):
+        """Bring a fact's rollups up to date with rows added since the last refresh"""
+        with self._lock:
+            if time.monotonic() - self._refreshed.get(fact, float('-inf')) < max_age:
+                return 0
+            db = self._connect()
+            watermark = self._watermark(db, fact)
+            # Stores written before month bounds were kept are rebuilt once
+            if watermark is None or (
+                not self._bounds(db, fact)
+                and db.execute("SELECT 1 FROM rollups WHERE fact = ? LIMIT 1", (fact,)).fetchone()
+            ):
+                self.rebuild(fact)
+                return None
+
+            table = FACTS[fact]['table']
+            max_id = execute_query(f"SELECT MAX(id) AS max_id FROM {table}")[0]['max_id'] or 0
+            months = set()
+            if max_id > watermark:
+                # A primary key range scan over the new rows only
+                touched = execute_query(
+                    f"SELECT DISTINCT YEAR(date) AS year, MONTH(date) AS month "
+                    f"FROM {table} WHERE id > %s AND id <= %s AND date IS NOT NULL",
+                    (watermark, max_id)
+                )
+                months.update((row['year'], row['month']) for row in touched)
+            today = datetime.date.today()
+            previous = today.replace(day=1) - datetime.timedelta(days=1)
+            months.update({(today.year, today.month), (previous.year, previous.month)})
+
+            self._recompute_months(db, fact, months, watermark)
+            self._set_watermark(db, fact, max_id)
+            db.commit()
+            self._refreshed[fact] = time.monotonic()
+            return len(months)
+
+    def rebuild(self, fact):
+        """Recompute all of a fact's rollups with one full scan; returns rows changed"""
+        table = FACTS[fact]['table']
+
+        with self._lock:
+            db = self._connect()
+            max_id = execute_query(f"SELECT MAX(id) AS max_id FROM {table}")[0]['max_id'] or 0
+            rows = [row for row in execute_query(self._grouped_query(fact)) if row['year'] is not None]
+            fresh = {
+                (row['year'], row['month'], str(row.get('grp') or '')): (row['count'], str(row['total'] or 0))
+                for row in rows if row['count']
+            }
+            lowest = {}
+            for row in rows:
+                key = (row['year'], row['month'])
+                lowest[key] = min(lowest.get(key, row['min_id']), row['min_id'])
+            stored = {
+                (year, month, grp): (count, total)
+                for year, month, grp, count, total in db.execute(
+                    "SELECT year, month, grp, count, total FROM rollups WHERE fact = ?", (fact,)
+                )
+            }
+            changed = sum(1 for key in fresh.keys() | stored.keys() if fresh.get(key) != stored.get(key))
+
+            db.execute("DELETE FROM rollups WHERE fact = ?", (fact,))
+            db.executemany(
+                "INSERT INTO rollups (fact, year, month, grp, count, total) VALUES (?, ?, ?, ?, ?, ?)",
+                [(fact, year, month, grp, count, total) for (year, month, grp), (count, total) in fresh.items()]
+            )
+            db.execute("DELETE FROM bounds WHERE fact = ?", (fact,))
+            db.executemany(
+                "INSERT INTO bounds (fact, year, month, min_id) VALUES (?, ?, ?, ?)",
+                [(fact, year, month, min_id) for (year, month), min_id in lowest.items()]
+            )
+            self._set_watermark(db, fact, max_id)
+            db.commit()
+            self._refreshed[fact] = time.monotonic()
+            return changed
+
+    def rows(self, fact, limit=None):
+        """Rollup rows newest month first, as dicts with year, month, grp, count and total"""
+        query = "SELECT year, month, grp, count, total FROM rollups WHERE fact = ? ORDER BY year DESC, month DESC, grp"
+        params = [fact]
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            result = self._connect().execute(query, params).fetchall()
+        return [
+            {'year': year, 'month': month, 'grp': grp, 'count': count, 'total': decimal.Decimal(total)}
+            for year, month, grp, count, total in result
+        ]
+
+aggregate_store = TenantLocal(lambda tenant: AggregateStore(tenant.path('aggregates.db', AGGREGATES_DB)))
+
+def get_sales_rollup(months=24):
+    """Monthly invoice count and total for the last months, newest first"""
+    aggregate_store.refresh('sales', max_age=AGGREGATES_REFRESH_INTERVAL)
+    return [
+        {'year': row['year'], 'month': row['month'], 'count': row['count'], 'total': row['total']}
+        for row in aggregate_store.rows('sales', limit=months)
+    ]
+
+def get_payments_rollup(limit=100):
+    """Monthly payment count and total per payment mode name, newest first"""
+    aggregate_store.refresh('payments', max_age=AGGREGATES_REFRESH_INTERVAL)
+    # Payment modes are a handful of rows; names are looked up at read time
+    names = {
+        str(row['id']): row['name']
+        for row in execute_query("SELECT id, name FROM tblpaymentmodes")
+    }
+
+    merged = {}
+    for row in aggregate_store.rows('payments'):
+        key = (row['year'], row['month'], names.get(row['grp']))
+        entry = merged.setdefault(key, {
+            'year': row['year'], 'month': row['month'], 'count': 0, 'total': decimal.Decimal(0),
+            'payment_mode': key[2],
+        })
+        entry['count'] += row['count']
+        entry['total'] += row['total']
+    return list(merged.values())[:limit]
+
+def rebuild_aggregates():
+    """Recompute all rollups from the source tables; returns rows changed per fact"""
+    return {fact: aggregate_store.rebuild(fact) for fact in FACTS}
@@ -1,16 +1,29 @@
 import os
+import sys
+import math
+import time
+import asyncio
 import logging
-from flask import Flask, request
+import functools
+import threading
+import contextlib
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
 from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, Dispatcher
+from telegram.error import TelegramError
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, ContextTypes, filters
 from dotenv import load_dotenv
-from database import get_connection, backup_database
-from reports import (
-    get_sales_report, 
-    get_payments_report, 
-    get_invoices_report, 
-    get_estimates_report, 
-    get_proposals_report
+from jobs import job_manager, current_job, JobCancelled
+from admission import admission
+from tenants import tenant_for_user, set_tenant, current_tenant_id
+from artifacts import artifact_store
+from cache import result_cache
+from storage import storage_manager
+from scheduler import Scheduler, subscribers, SCHEDULED_REPORTS, SCHEDULE_TIMES, SCHEDULE_PUSH
+from metrics import (
+    registry, stats_collector, tenant_stats_collector, render_metrics, install_log_tracing, start_trace, stage,
+    WEBHOOK_UPDATES, ERRORS
 )
 
 # Load environment variables
@@ -18,27 +31,83 @@ load_dotenv()
 
 # Enable logging
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s', level=logging.INFO
 )
+install_log_tracing()
+# httpx logs every Bot API request, token included
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-# Flask app
-app = Flask(__name__)
+# Import the report stack (database driver, xlsxwriter...) in a background thread at startup;
+# when off, it is loaded by the first report or backup
+PRELOAD_REPORTS = os.getenv('PRELOAD_REPORTS', 'true').lower() in ('1', 'true', 'yes')
 
 # Telegram bot
 TOKEN = os.getenv('TELEGRAM_TOKEN')
-ADMIN_USER_IDS = [int(id) for id in os.getenv('ADMIN_USER_IDS', '').split(',') if id]
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+# Sent by Telegram with every webhook request when set; other requests are rejected
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+# Bot API server, e.g. a local telegram-bot-api instance ("http://localhost:8081/bot")
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Updates handled at the same time on the event loop
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 64))
+# Seconds sending a request body (an upload) to Telegram may take
+TELEGRAM_UPLOAD_TIMEOUT = float(os.getenv('TELEGRAM_UPLOAD_TIMEOUT', 300))
+
+# The bot and the event loop it runs on; jobs send their messages and files through it
+_application = None
+_loop = None
 
 def is_authorized(user_id):
-    """Check if user is authorized to use the bot"""
-    return user_id in ADMIN_USER_IDS
+    """Check if user is authorized to use the bot, i.e. an admin of one of its tenants"""
+    return tenant_for_user(user_id) is not None
+
+def on_loop(coroutine):
+    """Run a Bot API call from a job thread on the bot's event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coroutine, _loop).result()
+
+def read_file(path):
+    """File contents for an upload, read in the job thread rather than on the event loop"""
+    with open(path, 'rb') as file:
+        return file.read()
 
-def start(update: Update, context: CallbackContext) -> None:
+def format_wait(seconds) -> str:
+    """Wait time in whole seconds, or minutes once it gets long"""
+    if seconds < 120:
+        return f'{math.ceil(seconds)} ثانیه'
+    return f'{math.ceil(seconds / 60)} دقیقه'
+
+async def admit(update: Update, command: str, job_type: str) -> bool:
+    """Apply the user's rate limits and the backup cap before a job is queued; explains a refusal in the chat."""
+    reason, wait = admission.admit(update.effective_user.id, command, job_type)
+    if reason is None:
+        return True
+    if reason == 'backups':
+        backups = [
+            f'#{job.id}' for job in job_manager.list()
+            if job.type == 'backup' and job.tenant == current_tenant_id() and job.finished is None
+        ]
+        await update.message.reply_text(
+            f"پشتیبان‌گیری دیگری در جریان است ({'، '.join(backups)}). لطفا پس از پایان آن دوباره تلاش کنید."
+        )
+    else:
+        await update.message.reply_text(
+            f'تعداد درخواست‌های شما بیش از حد مجاز است. لطفا {format_wait(wait)} دیگر دوباره تلاش کنید.'
+        )
+    return False
+
+def job_label(job) -> str:
+    """Job number for acknowledgements, with the job's place in the queue while it waits for a worker"""
+    position = job_manager.position(job)
+    if position:
+        return f'(کار #{job.id}، در صف: نفر {position})'
+    return f'(کار #{job.id})'
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     user = update.effective_user
     if not is_authorized(user.id):
-        update.message.reply_text(f"متاسفم {user.first_name}، شما مجاز به استفاده از این ربات نیستید.")
+        await update.message.reply_text(f"متاسفم {user.first_name}، شما مجاز به استفاده از این ربات نیستید.")
         return
 
     keyboard = [
@@ -47,138 +116,591 @@ def start(update: Update, context: CallbackContext) -> None:
         ['📋 گزارش پروپوزال‌ها', '💾 پشتیبان‌گیری پایگاه داده']
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    update.message.reply_text(
+    await update.message.reply_text(
         f'سلام {user.first_name}! من دستیار Perfex CRM شما هستم.\n'
         'یکی از گزینه‌های زیر را انتخاب کنید:',
         reply_markup=reply_markup
     )
 
-def help_command(update: Update, context: CallbackContext) -> None:
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
     if not is_authorized(update.effective_user.id):
         return
         
-    update.message.reply_text(
+    await update.message.reply_text(
         'دستورات موجود:\n'
         '/start - شروع ربات\n'
         '/help - نمایش این پیام راهنما\n'
         '/backup - ایجاد پشتیبان از پایگاه داده\n'
+        '/pbackup - پشتیبان موازی (هر جدول در یک فایل)\n'
+        '/ibackup - پشتیبان افزایشی\n'
         '/sales - دریافت گزارش فروش\n'
         '/payments - دریافت گزارش پرداخت‌ها\n'
         '/invoices - دریافت گزارش فاکتورها\n'
         '/estimates - دریافت گزارش پیش فاکتورها\n'
-        '/proposals - دریافت گزارش پروپوزال‌ها'
+        '/proposals - دریافت گزارش پروپوزال‌ها\n'
+        '/bundle - همه گزارش‌ها در یک فایل\n'
+        '/export - خروجی بازه‌ای (invoices، payments، estimates، proposals)\n'
+        '/yoy - مقایسه ماه به ماه یک سال با سال قبل (sales یا payments)\n'
+        '/trend - روند ماهانه با میانگین متحرک ۱۲ ماهه (sales یا payments)\n'
+        '/rebuild - بازسازی جداول خلاصه فروش و پرداخت\n'
+        '/subscribe - دریافت خودکار گزارش‌های زمان‌بندی‌شده\n'
+        '/unsubscribe - لغو دریافت خودکار گزارش‌ها\n'
+        '/diagnose - بررسی کارایی کوئری‌ها و پیشنهاد ایندکس\n'
+        '/jobs - وضعیت کارهای در حال اجرا\n'
+        '/cancel - لغو یک کار'
     )
 
-def backup_command(update: Update, context: CallbackContext) -> None:
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Create a database backup."""
     if not is_authorized(update.effective_user.id):
         return
-        
-    update.message.reply_text('در حال ایجاد پشتیبان از پایگاه داده...')
+
+    if not await admit(update, 'backup', 'backup'):
+        return
+
+    job = job_manager.submit(
+        'backup', run_backup, update,
+        description='backup', owner=update.effective_user.id
+    )
+    await update.message.reply_text(f'در حال ایجاد پشتیبان از پایگاه داده... {job_label(job)}')
+
+def run_backup(update: Update) -> None:
+    """Backup job: stream a compressed dump and upload each volume as it is written."""
+    def upload_volume(path, index):
+        on_loop(update.message.reply_document(
+            document=read_file(path),
+            filename=os.path.basename(path),
+            caption=f'پشتیبان پایگاه داده - بخش {index}'
+        ))
+
     try:
-        backup_file = backup_database()
-        with open(backup_file, 'rb') as file:
-            update.message.reply_document(
-                document=file,
-                filename=os.path.basename(backup_file),
-                caption='پشتیبان‌گیری از پایگاه داده با موفقیت انجام شد!'
-            )
+        from backups import backup_database
+        volumes, stats = backup_database(on_volume=upload_volume)
+        on_loop(update.message.reply_text(
+            'پشتیبان‌گیری از پایگاه داده با موفقیت انجام شد!\n' + format_backup_stats(stats)
+        ))
     except Exception as e:
         logger.error(f"Backup error: {e}")
-        update.message.reply_text(f'خطا در ایجاد پشتیبان: {e}')
+        on_loop(update.message.reply_text(f'خطا در ایجاد پشتیبان: {e}'))
+        raise
 
-def sales_report(update: Update, context: CallbackContext) -> None:
-    """Get sales report."""
+async def parallel_backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Create a parallel per-table backup from one consistent snapshot."""
     if not is_authorized(update.effective_user.id):
         return
-        
-    update.message.reply_text('در حال تولید گزارش فروش...')
+
+    if not await admit(update, 'pbackup', 'backup'):
+        return
+
+    job = job_manager.submit(
+        'backup', run_parallel_backup, update,
+        description='parallel backup', owner=update.effective_user.id
+    )
+    await update.message.reply_text(f'در حال ایجاد پشتیبان موازی از پایگاه داده... {job_label(job)}')
+
+def run_parallel_backup(update: Update) -> None:
+    """Parallel backup job: dump all tables concurrently and report the result."""
     try:
-        report_file = get_sales_report()
-        with open(report_file, 'rb') as file:
-            update.message.reply_document(
-                document=file,
-                filename=os.path.basename(report_file),
-                caption='گزارش فروش آماده شد!'
-            )
+        from backups import parallel_backup, format_size
+        directory, manifest = parallel_backup()
+        rows = sum(table['rows'] for table in manifest['tables'])
+        size = sum(table['bytes'] for table in manifest['tables'])
+        on_loop(update.message.reply_text(
+            'پشتیبان‌گیری موازی با موفقیت انجام شد!\n'
+            f"پوشه: {os.path.basename(directory)}\n"
+            f"جدول‌ها: {len(manifest['tables'])}، ردیف‌ها: {rows}، حجم: {format_size(size)}\n"
+            f"زمان: {manifest['elapsed']:.1f} ثانیه، snapshot: {manifest['snapshot']}"
+        ))
     except Exception as e:
-        logger.error(f"Sales report error: {e}")
-        update.message.reply_text(f'خطا در تولید گزارش فروش: {e}')
+        logger.error(f"Parallel backup error: {e}")
+        on_loop(update.message.reply_text(f'خطا در ایجاد پشتیبان: {e}'))
+        raise
 
-def payments_report(update: Update, context: CallbackContext) -> None:
-    """Get payments report."""
+async def incremental_backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Add a base or delta backup to the incremental backup chain."""
     if not is_authorized(update.effective_user.id):
         return
-        
-    update.message.reply_text('در حال تولید گزارش پرداخت‌ها...')
+
+    if not await admit(update, 'ibackup', 'backup'):
+        return
+
+    job = job_manager.submit(
+        'backup', run_incremental_backup, update,
+        description='incremental backup', owner=update.effective_user.id
+    )
+    await update.message.reply_text(f'در حال ایجاد پشتیبان افزایشی... {job_label(job)}')
+
+def run_incremental_backup(update: Update) -> None:
+    """Incremental backup job: record a base or a delta and report it."""
     try:
-        report_file = get_payments_report()
-        with open(report_file, 'rb') as file:
-            update.message.reply_document(
-                document=file,
-                filename=os.path.basename(report_file),
-                caption='گزارش پرداخت‌ها آماده شد!'
+        from backups import incremental_backup, format_size
+        directory, chain, entry = incremental_backup()
+        if entry is chain['base']:
+            details = 'پشتیبان کامل پایه ایجاد شد.'
+        else:
+            details = (
+                f"بخش افزایشی {len(chain['deltas'])} ({chain['mode']}): "
+                f"{format_size(entry['bytes'])} در {entry['elapsed']:.1f} ثانیه"
             )
+        on_loop(update.message.reply_text(
+            'پشتیبان‌گیری افزایشی با موفقیت انجام شد!\n'
+            f"زنجیره: {os.path.basename(directory)}\n{details}"
+        ))
     except Exception as e:
-        logger.error(f"Payments report error: {e}")
-        update.message.reply_text(f'خطا در تولید گزارش پرداخت‌ها: {e}')
+        logger.error(f"Incremental backup error: {e}")
+        on_loop(update.message.reply_text(f'خطا در ایجاد پشتیبان: {e}'))
+        raise
 
-def invoices_report(update: Update, context: CallbackContext) -> None:
-    """Get invoices report."""
+def format_backup_stats(stats) -> str:
+    """Completion message details: sizes, ratio, throughput and time per stage."""
+    from backups import format_size
+    timings = stats['timings']
+    return (
+        f"تعداد بخش‌ها: {stats['volumes']}\n"
+        f"حجم خام: {format_size(stats['raw_bytes'])}، فشرده ({stats['compression']}): "
+        f"{format_size(stats['compressed_bytes'])} (نسبت {stats['ratio']:.1f})\n"
+        f"سرعت: {format_size(stats['throughput'])}/s در {stats['elapsed']:.1f} ثانیه\n"
+        f"زمان مراحل: dump {timings['dump']:.1f}s، فشرده‌سازی {timings['compress']:.1f}s، "
+        f"نوشتن {timings['write']:.1f}s، ارسال {timings['upload']:.1f}s"
+    )
+
+# Report type -> report name shown to the user
+REPORT_NAMES = {
+    'sales': 'گزارش فروش',
+    'payments': 'گزارش پرداخت‌ها',
+    'invoices': 'گزارش فاکتورها',
+    'estimates': 'گزارش پیش فاکتورها',
+    'proposals': 'گزارش پروپوزال‌ها',
+    'bundle': 'گزارش تجمیعی',
+}
+
+async def submit_report(update: Update, report_type: str) -> None:
+    """Queue a report job and acknowledge it right away."""
     if not is_authorized(update.effective_user.id):
         return
-        
-    update.message.reply_text('در حال تولید گزارش فاکتورها...')
+
+    name = REPORT_NAMES[report_type]
+    if not await admit(update, report_type, 'report'):
+        return
+
+    job = job_manager.submit(
+        'report', run_report, update, report_type,
+        description=report_type, owner=update.effective_user.id
+    )
+    await update.message.reply_text(f'در حال تولید {name}... {job_label(job)}')
+
+def run_report(update: Update, report_type: str) -> None:
+    """Report job: fetch the rows, then resend a cached upload or render and upload the file."""
+    name = REPORT_NAMES[report_type]
     try:
-        report_file = get_invoices_report()
-        with open(report_file, 'rb') as file:
-            update.message.reply_document(
-                document=file,
-                filename=os.path.basename(report_file),
-                caption='گزارش فاکتورها آماده شد!'
-            )
+        from reports import get_report_data, report_digest
+        data = get_report_data(report_type)
+        digest = report_digest(report_type, data)
+        if current_job() and current_job().cancelled:
+            return
+        send_report(update.message.reply_document, report_type, data, digest)
     except Exception as e:
-        logger.error(f"Invoices report error: {e}")
-        update.message.reply_text(f'خطا در تولید گزارش فاکتورها: {e}')
+        logger.error(f"{report_type.capitalize()} report error: {e}")
+        on_loop(update.message.reply_text(f'خطا در تولید {name}: {e}'))
+        raise
 
-def estimates_report(update: Update, context: CallbackContext) -> None:
-    """Get estimates report."""
+def send_report(send_document, report_type: str, data, digest: str) -> None:
+    """Send a report (or the bundle) with the Bot API method send_document, by cached file_id when the data is unchanged."""
+    caption = f'{REPORT_NAMES[report_type]} آماده شد!'
+
+    # Unchanged data: resend the file Telegram already has
+    file_id = artifact_store.get(digest)
+    if file_id:
+        try:
+            with stage(report_type, 'upload'):
+                on_loop(send_document(document=file_id, caption=caption))
+            return
+        except TelegramError as e:
+            logger.warning(f"Cached {report_type} report could not be resent: {e}")
+            artifact_store.discard(digest)
+
+    from reports import render_report, render_bundle
+    if report_type == 'bundle':
+        report_file = render_bundle(data, digest)
+    else:
+        report_file = render_report(report_type, data, digest)
+    if current_job() and current_job().cancelled:
+        return
+    with stage(report_type, 'upload'):
+        message = on_loop(send_document(
+            document=read_file(report_file),
+            filename=os.path.basename(report_file),
+            caption=caption
+        ))
+    artifact_store.put(digest, report_type, message.document.file_id, message.document.file_size)
+
+async def bundle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Get all reports in one workbook."""
     if not is_authorized(update.effective_user.id):
         return
-        
-    update.message.reply_text('در حال تولید گزارش پیش فاکتورها...')
+
+    if not await admit(update, 'bundle', 'report'):
+        return
+
+    job = job_manager.submit(
+        'report', run_bundle, update,
+        description='bundle', owner=update.effective_user.id
+    )
+    await update.message.reply_text(f"در حال تولید {REPORT_NAMES['bundle']}... {job_label(job)}")
+
+def run_bundle(update: Update) -> None:
+    """Bundle job: fetch all reports concurrently, then send them as one multi-sheet workbook."""
     try:
-        report_file = get_estimates_report()
-        with open(report_file, 'rb') as file:
-            update.message.reply_document(
-                document=file,
-                filename=os.path.basename(report_file),
-                caption='گزارش پیش فاکتورها آماده شد!'
-            )
+        from reports import get_bundle_data, bundle_digest
+        with stage('bundle', 'query'):
+            datasets = get_bundle_data()
+        if current_job() and current_job().cancelled:
+            return
+        send_report(update.message.reply_document, 'bundle', datasets, bundle_digest(datasets))
     except Exception as e:
-        logger.error(f"Estimates report error: {e}")
-        update.message.reply_text(f'خطا در تولید گزارش پیش فاکتورها: {e}')
+        logger.error(f"Bundle report error: {e}")
+        on_loop(update.message.reply_text(f"خطا در تولید {REPORT_NAMES['bundle']}: {e}"))
+        raise
+
+async def sales_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Get sales report."""
+    await submit_report(update, 'sales')
+
+async def payments_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Get payments report."""
+    await submit_report(update, 'payments')
+
+async def invoices_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Get invoices report."""
+    await submit_report(update, 'invoices')
 
-def proposals_report(update: Update, context: CallbackContext) -> None:
+async def estimates_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Get estimates report."""
+    await submit_report(update, 'estimates')
+
+async def proposals_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Get proposals report."""
+    await submit_report(update, 'proposals')
+
+# Export type -> export name shown to the user
+EXPORT_NAMES = {
+    'invoices': 'خروجی فاکتورها',
+    'payments': 'خروجی پرداخت‌ها',
+    'estimates': 'خروجی پیش فاکتورها',
+    'proposals': 'خروجی پروپوزال‌ها',
+}
+
+EXPORT_FILTERS = ('from', 'to', 'client', 'status')
+
+# Telegram bots may upload at most 50 MB per file
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+# Minimum seconds between progress message edits, to stay within Telegram's rate limits
+EXPORT_PROGRESS_INTERVAL = float(os.getenv('EXPORT_PROGRESS_INTERVAL', 3))
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Export rows in a range: /export <type> [from=YYYY-MM-DD] [to=YYYY-MM-DD] [client=ID] [status=NAME]"""
     if not is_authorized(update.effective_user.id):
         return
-        
-    update.message.reply_text('در حال تولید گزارش پروپوزال‌ها...')
+
+    usage = (
+        f"استفاده: /export <{'|'.join(EXPORT_NAMES)}> "
+        'from=2024-01-01 to=2024-12-31 client=<شناسه مشتری> status=<وضعیت>'
+    )
+    export_type = context.args[0] if context.args else None
+    if export_type not in EXPORT_NAMES:
+        await update.message.reply_text(usage)
+        return
+
+    export_filters = {}
+    for arg in context.args[1:]:
+        key, _, value = arg.partition('=')
+        if key not in EXPORT_FILTERS or not value:
+            await update.message.reply_text(usage)
+            return
+        export_filters[key] = value
+
+    if not await admit(update, 'export', 'export'):
+        return
+
+    job = job_manager.submit(
+        'export', run_export, update, export_type, export_filters,
+        description=f'export {export_type}', owner=update.effective_user.id
+    )
+    await update.message.reply_text(f'در حال تولید {EXPORT_NAMES[export_type]}... {job_label(job)}')
+
+def run_export(update: Update, export_type: str, export_filters: dict) -> None:
+    """Export job: page through the rows into a file, editing progress into the chat, and upload it."""
+    name = EXPORT_NAMES[export_type]
+    status_message = on_loop(update.message.reply_text(f'{name}: ۰ ردیف'))
+    last_edit = [time.monotonic()]
+
+    def progress(rows, last_date):
+        job = current_job()
+        if job and job.cancelled:
+            raise JobCancelled()
+        if time.monotonic() - last_edit[0] < EXPORT_PROGRESS_INTERVAL:
+            return
+        last_edit[0] = time.monotonic()
+        try:
+            on_loop(status_message.edit_text(f'{name}: {rows} ردیف (تا تاریخ {last_date})'))
+        except TelegramError as e:
+            logger.warning(f"Export progress update failed: {e}")
+
+    try:
+        from reports import export_report
+        report_file = export_report(
+            export_type,
+            date_from=export_filters.get('from'),
+            date_to=export_filters.get('to'),
+            client=export_filters.get('client'),
+            status=export_filters.get('status'),
+            progress=progress
+        )
+        if os.path.getsize(report_file) > TELEGRAM_UPLOAD_LIMIT:
+            on_loop(status_message.edit_text(
+                f'{name} آماده شد اما برای ارسال در تلگرام بزرگ است. فایل روی سرور: {report_file}'
+            ))
+            return
+        on_loop(status_message.edit_text(f'{name} آماده شد، در حال ارسال...'))
+        on_loop(update.message.reply_document(
+            document=read_file(report_file),
+            filename=os.path.basename(report_file),
+            caption=f'{name} آماده شد!'
+        ))
+    except JobCancelled:
+        on_loop(status_message.edit_text(f'{name} لغو شد.'))
+        raise
+    except Exception as e:
+        logger.error(f"{export_type.capitalize()} export error: {e}")
+        on_loop(update.message.reply_text(f'خطا در تولید {name}: {e}'))
+        raise
+
+# Trend -> name shown to the user
+TREND_NAMES = {
+    'sales': 'فروش',
+    'payments': 'پرداخت‌ها',
+}
+
+TREND_REPORT_NAMES = {
+    'yoy': 'گزارش مقایسه سالانه',
+    'trend': 'گزارش روند ماهانه',
+}
+
+async def yoy_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Compare a year with the year before, month by month: /yoy [sales|payments] [year]"""
+    await submit_trend_report(update, context, 'yoy', 'استفاده: /yoy <sales|payments> [سال]')
+
+async def trend_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Monthly totals with a moving average: /trend [sales|payments] [months]"""
+    await submit_trend_report(update, context, 'trend', 'استفاده: /trend <sales|payments> [تعداد ماه]')
+
+async def submit_trend_report(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, usage: str) -> None:
+    """Queue a year-over-year or trend report job from the command arguments."""
+    if not is_authorized(update.effective_user.id):
+        return
+
+    trend = context.args[0] if context.args else 'sales'
+    value = context.args[1] if len(context.args) > 1 else None
+    if trend not in TREND_NAMES or (value is not None and not value.isdigit()):
+        await update.message.reply_text(usage)
+        return
+
+    name = f'{TREND_REPORT_NAMES[kind]} {TREND_NAMES[trend]}'
+    if not await admit(update, kind, 'report'):
+        return
+
+    job = job_manager.submit(
+        'report', run_trend_report, update, kind, trend, int(value) if value else None,
+        description=f'{kind} {trend}', owner=update.effective_user.id
+    )
+    await update.message.reply_text(f'در حال تولید {name}... {job_label(job)}')
+
+def run_trend_report(update: Update, kind: str, trend: str, value) -> None:
+    """Trend job: compute the totals from the monthly snapshots and upload the report."""
+    name = f'{TREND_REPORT_NAMES[kind]} {TREND_NAMES[trend]}'
     try:
-        report_file = get_proposals_report()
-        with open(report_file, 'rb') as file:
-            update.message.reply_document(
-                document=file,
+        from reports import get_yoy_report, get_trend_report
+        if kind == 'yoy':
+            report_file = get_yoy_report(trend, value)
+        else:
+            report_file = get_trend_report(trend, value or 36)
+        if current_job() and current_job().cancelled:
+            return
+        with stage(f'{trend}_{kind}', 'upload'):
+            on_loop(update.message.reply_document(
+                document=read_file(report_file),
                 filename=os.path.basename(report_file),
-                caption='گزارش پروپوزال‌ها آماده شد!'
-            )
+                caption=f'{name} آماده شد!'
+            ))
+    except Exception as e:
+        logger.error(f"{trend.capitalize()} {kind} report error: {e}")
+        on_loop(update.message.reply_text(f'خطا در تولید {name}: {e}'))
+        raise
+
+async def rebuild_aggregates_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Recompute the sales and payments rollups from scratch."""
+    if not is_authorized(update.effective_user.id):
+        return
+
+    if not await admit(update, 'rebuild', 'export'):
+        return
+
+    job = job_manager.submit(
+        'export', run_rebuild_aggregates, update,
+        description='rebuild aggregates', owner=update.effective_user.id
+    )
+    await update.message.reply_text(f'در حال بازسازی جداول خلاصه... {job_label(job)}')
+
+def run_rebuild_aggregates(update: Update) -> None:
+    """Rebuild job: full recompute of the rollups, reporting how many rows drifted."""
+    try:
+        from aggregates import rebuild_aggregates
+        changed = rebuild_aggregates()
+        on_loop(update.message.reply_text(
+            'جداول خلاصه بازسازی شد.\n'
+            f"ردیف‌های اصلاح‌شده: فروش {changed['sales']}، پرداخت‌ها {changed['payments']}"
+        ))
     except Exception as e:
-        logger.error(f"Proposals report error: {e}")
-        update.message.reply_text(f'خطا در تولید گزارش پروپوزال‌ها: {e}')
+        logger.error(f"Rebuild aggregates error: {e}")
+        on_loop(update.message.reply_text(f'خطا در بازسازی جداول خلاصه: {e}'))
+        raise
+
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Receive the scheduled reports in this chat."""
+    if not is_authorized(update.effective_user.id):
+        return
+
+    subscribers.add(update.effective_chat.id)
+    await update.message.reply_text(
+        f"گزارش‌های زمان‌بندی‌شده ({', '.join(SCHEDULED_REPORTS)}) در ساعت‌های "
+        f"{', '.join(SCHEDULE_TIMES)} برای شما ارسال می‌شوند."
+    )
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Stop receiving the scheduled reports in this chat."""
+    if not is_authorized(update.effective_user.id):
+        return
+
+    subscribers.remove(update.effective_chat.id)
+    await update.message.reply_text('ارسال گزارش‌های زمان‌بندی‌شده لغو شد.')
+
+def push_scheduled_report(bot, report_type: str, data, digest: str) -> None:
+    """Send a freshly pre-built report to every subscribed chat."""
+    for chat_id in subscribers.list():
+        try:
+            send_report(functools.partial(bot.send_document, chat_id), report_type, data, digest)
+        except Exception as e:
+            logger.error(f"Pushing {report_type} report to {chat_id} failed: {e}")
+
+# Telegram rejects messages longer than 4096 characters
+TELEGRAM_MESSAGE_LIMIT = 4000
+
+async def diagnose_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Check the report queries' plans and suggest indexes and rewrites."""
+    if not is_authorized(update.effective_user.id):
+        return
+
+    if not await admit(update, 'diagnose', 'report'):
+        return
+
+    job = job_manager.submit(
+        'report', run_diagnose, update,
+        description='diagnose', owner=update.effective_user.id
+    )
+    await update.message.reply_text(f'در حال بررسی کوئری‌های گزارش‌ها... {job_label(job)}')
 
-def handle_message(update: Update, context: CallbackContext) -> None:
+def run_diagnose(update: Update) -> None:
+    """Diagnose job: EXPLAIN every report query and list problems, suggestions and profiled timings."""
+    try:
+        from reports import report_queries
+        from database import explain_query
+        from profiler import profiler, plan_flags, recommend
+
+        sections = []
+        for name, query, params in report_queries():
+            plan = explain_query(query, params)
+            flags = plan_flags(plan)
+            suggestions = recommend(query, plan)
+            if not flags and not suggestions:
+                sections.append(f'✅ {name}: مشکلی دیده نشد')
+                continue
+            lines = [f'⚠️ {name}:']
+            lines += [f'  - {flag}' for flag in flags]
+            lines += [f'  💡 {suggestion}' for suggestion in suggestions]
+            sections.append('\n'.join(lines))
+
+        # Profiles are kept per tenant; only this CRM's queries are listed
+        tenant_profiler = profiler.get()
+        if tenant_profiler.enabled:
+            for profile in tenant_profiler.profiles(limit=5):
+                sections.append(
+                    f"⏱ {profile['count']}× میانگین {profile['avg_seconds'] * 1000:.0f}ms، "
+                    f"حداکثر {profile['max_seconds'] * 1000:.0f}ms، "
+                    f"ردیف‌ها {profile['rows']} از {profile['examined']} خوانده‌شده\n"
+                    f"  {profile['query'][:300]}"
+                )
+        else:
+            sections.append('برای ثبت زمان اجرای کوئری‌ها DB_PROFILE=true را تنظیم کنید.')
+
+        # Split into messages under Telegram's length limit
+        message = ''
+        for section in sections:
+            if message and len(message) + len(section) + 2 > TELEGRAM_MESSAGE_LIMIT:
+                on_loop(update.message.reply_text(message))
+                message = ''
+            message = f'{message}\n\n{section}' if message else section[:TELEGRAM_MESSAGE_LIMIT]
+        on_loop(update.message.reply_text(message))
+    except Exception as e:
+        logger.error(f"Diagnose error: {e}")
+        on_loop(update.message.reply_text(f'خطا در بررسی کوئری‌ها: {e}'))
+        raise
+
+JOB_STATUS_LABELS = {
+    'queued': 'در صف',
+    'running': 'در حال اجرا',
+    'done': 'انجام شد',
+    'failed': 'ناموفق',
+    'cancelled': 'لغو شد',
+}
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """List the user's recent jobs and their status."""
+    if not is_authorized(update.effective_user.id):
+        return
+
+    jobs = job_manager.list(owner=update.effective_user.id)[:10]
+    if not jobs:
+        await update.message.reply_text('هیچ کاری ثبت نشده است.')
+        return
+
+    lines = []
+    for job in jobs:
+        position = job_manager.position(job) if job.status == 'queued' else 0
+        status = f'در صف، نفر {position}' if position else JOB_STATUS_LABELS[job.status]
+        lines.append(f'#{job.id} {job.description}: {status}')
+    await update.message.reply_text('\n'.join(lines))
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Cancel a queued or running job: /cancel <job id>"""
+    if not is_authorized(update.effective_user.id):
+        return
+
+    try:
+        job_id = int(context.args[0].lstrip('#'))
+    except (IndexError, ValueError):
+        await update.message.reply_text('استفاده: /cancel <شماره کار>')
+        return
+
+    job = job_manager.get(job_id)
+    if job is None or job.owner != update.effective_user.id or not job_manager.cancel(job_id):
+        await update.message.reply_text(f'کار #{job_id} یافت نشد یا به پایان رسیده است.')
+        return
+
+    await update.message.reply_text(f'درخواست لغو کار #{job_id} ثبت شد.')
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle incoming messages."""
     if not is_authorized(update.effective_user.id):
         return
@@ -186,79 +708,193 @@ def handle_message(update: Update, context: CallbackContext) -> None:
     text = update.message.text
     
     if text == '💾 پشتیبان‌گیری پایگاه داده':
-        backup_command(update, context)
+        await backup_command(update, context)
     elif text == '📊 گزارش فروش':
-        sales_report(update, context)
+        await sales_report(update, context)
     elif text == '💰 گزارش پرداخت‌ها':
-        payments_report(update, context)
+        await payments_report(update, context)
     elif text == '📝 گزارش فاکتورها':
-        invoices_report(update, context)
+        await invoices_report(update, context)
     elif text == '📄 گزارش پیش فاکتورها':
-        estimates_report(update, context)
+        await estimates_report(update, context)
     elif text == '📋 گزارش پروپوزال‌ها':
-        proposals_report(update, context)
+        await proposals_report(update, context)
     else:
-        update.message.reply_text('لطفا یکی از گزینه‌های منو را انتخاب کنید.')
+        await update.message.reply_text('لطفا یکی از گزینه‌های منو را انتخاب کنید.')
 
-def setup_bot():
+async def trace_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Start a trace for each update and select its sender's tenant; its handlers and jobs share both."""
+    start_trace(f"u{update.update_id}")
+    if update.effective_user:
+        set_tenant(tenant_for_user(update.effective_user.id))
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Log and count errors raised by handlers."""
+    ERRORS.inc(component='handler')
+    logger.error(f"Update handling failed: {context.error}")
+
+def jobs_collector():
+    """Running and queued jobs per type, and updates received but not yet handled."""
+    stats = job_manager.stats()
+    backlog = _application.update_queue.qsize() if _application else 0
+    return [
+        ('jobs_running', 'gauge', 'Jobs running per type',
+         [({'type': job_type}, counts['running']) for job_type, counts in stats.items()]),
+        ('jobs_queued', 'gauge', 'Jobs waiting for a free slot per type',
+         [({'type': job_type}, counts['queued']) for job_type, counts in stats.items()]),
+        ('updates_queued', 'gauge', 'Webhook updates waiting to be handled', [({}, backlog)]),
+    ]
+
+def loaded_stats(module, name):
+    """stats() callable of module.name that reports nothing until the module has been imported."""
+    def stats():
+        if module not in sys.modules:
+            return {}
+        return getattr(sys.modules[module], name)()
+    return stats
+
+registry.add_collector(jobs_collector)
+registry.add_collector(tenant_stats_collector(
+    'db_pool', loaded_stats('database', 'get_tenant_pool_stats'), 'Database connection pool'
+))
+registry.add_collector(stats_collector('result_cache', result_cache.stats, 'Query result cache'))
+registry.add_collector(tenant_stats_collector('artifacts', artifact_store.stats_by_tenant, 'Uploaded report files'))
+registry.add_collector(stats_collector('admission', admission.stats, 'Commands admitted and refused by the rate limits'))
+registry.add_collector(stats_collector('storage', storage_manager.stats, 'Report and backup retention'))
+registry.add_collector(tenant_stats_collector(
+    'snapshots', loaded_stats('snapshots', 'get_snapshot_stats'), 'Monthly Parquet snapshots'
+))
+registry.add_collector(stats_collector(
+    'report_coalescing', loaded_stats('reports', 'get_coalescing_stats'), 'Coalesced report builds'
+))
+
+def preload_report_stack() -> None:
+    """Import the modules reports and backups need, so the first request doesn't wait for them."""
+    started = time.monotonic()
+    import reports
+    import backups
+    import xlsxwriter
+    logger.info(f"Report stack loaded in {time.monotonic() - started:.2f}s")
+
+async def post_init(application: Application) -> None:
+    """Remember the event loop for the jobs, start the report scheduler and the storage sweeper."""
+    global _application, _loop
+    _application = application
+    _loop = asyncio.get_running_loop()
+
+    # Pre-build reports off-peak, optionally pushing them to subscribers
+    push = functools.partial(push_scheduled_report, application.bot) if SCHEDULE_PUSH else None
+    application.bot_data['scheduler'] = Scheduler(push=push)
+    application.bot_data['scheduler'].start()
+
+    # Keep REPORTS_DIR and BACKUP_DIR within their quotas
+    storage_manager.start()
+
+async def post_shutdown(application: Application) -> None:
+    application.bot_data['scheduler'].stop()
+    storage_manager.stop()
+
+def setup_bot(polling=False) -> Application:
     """Setup the bot with all handlers"""
-    # Create updater
-    updater = Updater(TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .write_timeout(TELEGRAM_UPLOAD_TIMEOUT)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    if not polling:
+        # Updates arrive through /webhook
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Runs before the other handlers of every update
+    application.add_handler(TypeHandler(Update, trace_update), group=-1)
+    application.add_error_handler(error_handler)
 
     # Add handlers
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("backup", backup_command))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^📊 گزارش فروش$'), sales_report))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^💰 گزارش پرداخت‌ها$'), payments_report))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^📝 گزارش فاکتورها$'), invoices_report))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^📄 گزارش پیش فاکتورها$'), estimates_report))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^📋 گزارش پروپوزال‌ها$'), proposals_report))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
-
-    # Always use webhook if URL is provided
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("backup", backup_command))
+    application.add_handler(CommandHandler("pbackup", parallel_backup_command))
+    application.add_handler(CommandHandler("ibackup", incremental_backup_command))
+    application.add_handler(CommandHandler("sales", sales_report))
+    application.add_handler(CommandHandler("payments", payments_report))
+    application.add_handler(CommandHandler("invoices", invoices_report))
+    application.add_handler(CommandHandler("estimates", estimates_report))
+    application.add_handler(CommandHandler("proposals", proposals_report))
+    application.add_handler(CommandHandler("bundle", bundle_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("yoy", yoy_command))
+    application.add_handler(CommandHandler("trend", trend_command))
+    application.add_handler(CommandHandler("rebuild", rebuild_aggregates_command))
+    application.add_handler(CommandHandler("subscribe", subscribe_command))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
+    application.add_handler(CommandHandler("diagnose", diagnose_command))
+    application.add_handler(CommandHandler("jobs", jobs_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(MessageHandler(filters.Regex('^📊 گزارش فروش$'), sales_report))
+    application.add_handler(MessageHandler(filters.Regex('^💰 گزارش پرداخت‌ها$'), payments_report))
+    application.add_handler(MessageHandler(filters.Regex('^📝 گزارش فاکتورها$'), invoices_report))
+    application.add_handler(MessageHandler(filters.Regex('^📄 گزارش پیش فاکتورها$'), estimates_report))
+    application.add_handler(MessageHandler(filters.Regex('^📋 گزارش پروپوزال‌ها$'), proposals_report))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+
+    return application
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    """Run the bot on the web server's event loop and point the Telegram webhook at it"""
+    application = setup_bot()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
     if WEBHOOK_URL:
-        updater.start_webhook(
-            listen='0.0.0.0',
-            port=int(os.getenv('PORT', 5000)),
-            url_path=TOKEN,
-            webhook_url=f"{WEBHOOK_URL}/{TOKEN}"
-        )
+        await application.bot.set_webhook(url=f"{WEBHOOK_URL}/webhook", secret_token=WEBHOOK_SECRET)
     else:
-        logger.warning("WEBHOOK_URL not set. Bot will not start.")
-        return None
+        logger.warning("WEBHOOK_URL not set. Telegram won't send updates to /webhook.")
+    try:
+        yield
+    finally:
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+
+async def webhook(request):
+    """Queue webhook updates for the bot and acknowledge at once"""
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return PlainTextResponse('forbidden', status_code=403)
+    update = Update.de_json(await request.json(), _application.bot)
+    WEBHOOK_UPDATES.inc()
+    await _application.update_queue.put(update)
+    return PlainTextResponse('ok')
 
-    return updater
+async def metrics(request):
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
 
-def webhook(request):
-    """Process webhook updates"""
-    dispatcher: Dispatcher = request.app.config['DISPATCHER']
-    update = Update.de_json(request.get_json(force=True), dispatcher.bot)
-    dispatcher.process_update(update)
-    return 'ok'
+async def index(request):
+    return PlainTextResponse('ربات تلگرام Perfex CRM در حال اجراست!')
 
-@app.route('/webhook', methods=['POST'])
-def process_webhook():
-    return webhook(request)
+app = Starlette(
+    routes=[
+        Route('/webhook', webhook, methods=['POST']),
+        Route('/metrics', metrics),
+        Route('/', index),
+    ],
+    lifespan=lifespan,
+)
 
-@app.route('/')
-def index():
-    return 'ربات تلگرام Perfex CRM در حال اجراست!'
+if PRELOAD_REPORTS:
+    threading.Thread(target=preload_report_stack, name='preload', daemon=True).start()
 
 if __name__ == '__main__':
-    # Setup bot
-    updater = setup_bot()
-    
-    # Store dispatcher in Flask app config
-    app.config['DISPATCHER'] = updater.dispatcher
-    
-    # Start the Bot in webhook mode
     if WEBHOOK_URL:
-        updater.bot.set_webhook(url=f"{WEBHOOK_URL}/webhook")
-        # Start the Flask server
-        app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
+        # Serve the webhook; the bot starts with the server
+        import uvicorn
+        uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
     else:
         # Use polling instead if webhook is not configured
-        updater.start_polling()
-        updater.idle() 
\ No newline at end of file
+        setup_bot(polling=True).run_polling()
@@ -0,0 +1,115 @@
+import os
+import time
+import sqlite3
+import threading
+from dotenv import load_dotenv
+from tenants import TenantLocal
+
+# Load environment variables
+load_dotenv()
+
+# Artifact store configuration
+REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')
+ARTIFACTS_DB = os.getenv('ARTIFACTS_DB', os.path.join(REPORTS_DIR, 'artifacts.db'))
+ARTIFACTS_MAX_ENTRIES = int(os.getenv('ARTIFACTS_MAX_ENTRIES', 500))
+ARTIFACTS_MAX_AGE_DAYS = float(os.getenv('ARTIFACTS_MAX_AGE_DAYS', 30))
+
+class ArtifactStore:
+    """Content-addressed map of report digests to Telegram file_ids, persisted in SQLite"""
+
+    def __init__(self, path=ARTIFACTS_DB, max_entries=ARTIFACTS_MAX_ENTRIES,
+                 max_age_days=ARTIFACTS_MAX_AGE_DAYS):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self._lock = threading.Lock()
+        self._db = None
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'invalid': 0}
+
+    def _connect(self):
+        # Called with the lock held
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    digest TEXT PRIMARY KEY,
+                    report_type TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    size INTEGER,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS artifacts_last_used ON artifacts (last_used)")
+            self._db.commit()
+        return self._db
+
+    def get(self, digest):
+        """Return the file_id of an already uploaded report with this digest, or None"""
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT file_id, created FROM artifacts WHERE digest = ?", (digest,)
+            ).fetchone()
+            if row is None or (self.max_age and now - row[1] > self.max_age):
+                self._stats['misses'] += 1
+                return None
+            db.execute(
+                "UPDATE artifacts SET last_used = ?, hits = hits + 1 WHERE digest = ?", (now, digest)
+            )
+            db.commit()
+            self._stats['hits'] += 1
+            return row[0]
+
+    def put(self, digest, report_type, file_id, size=None):
+        """Remember the file_id a report with this digest was uploaded as"""
+        now = time.time()
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO artifacts (digest, report_type, file_id, size, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, report_type, file_id, size, now, now)
+            )
+            self._stats['stores'] += 1
+            self._evict(db, now)
+            db.commit()
+
+    def discard(self, digest):
+        """Forget a file_id Telegram no longer accepts"""
+        with self._lock:
+            db = self._connect()
+            db.execute("DELETE FROM artifacts WHERE digest = ?", (digest,))
+            db.commit()
+            self._stats['invalid'] += 1
+
+    def _evict(self, db, now):
+        # Called with the lock held: drop expired entries, then the least recently used
+        evicted = 0
+        if self.max_age:
+            evicted += db.execute(
+                "DELETE FROM artifacts WHERE created < ?", (now - self.max_age,)
+            ).rowcount
+        if self.max_entries:
+            evicted += db.execute(
+                "DELETE FROM artifacts WHERE digest IN ("
+                "SELECT digest FROM artifacts ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            ).rowcount
+        self._stats['evictions'] += evicted
+
+    def stats(self):
+        """Return hit/miss counters, hit rate and number of stored entries"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = self._connect().execute("SELECT COUNT(*) FROM artifacts").fetchone()[0]
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+artifact_store = TenantLocal(lambda tenant: ArtifactStore(tenant.path('artifacts.db', ARTIFACTS_DB)))
@@ -0,0 +1,1080 @@
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import zlib
+import queue
+import decimal
+import logging
+import datetime
+import argparse
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import subprocess
+from dotenv import load_dotenv
+import mysql.connector
+from mysql.connector import Error
+from database import get_connection
+from jobs import current_job
+from metrics import record_backup
+from storage import PARTIAL_SUFFIX
+from tenants import current_tenant
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Backup pipeline configuration
+BACKUP_COMPRESSION = os.getenv('BACKUP_COMPRESSION', 'gzip')  # gzip, zstd or none
+BACKUP_COMPRESSION_LEVEL = int(os.getenv('BACKUP_COMPRESSION_LEVEL', 6))
+BACKUP_THREADS = int(os.getenv('BACKUP_THREADS', os.cpu_count() or 1))
+# Telegram bots may upload at most 50 MB per file, so stay below that by default
+BACKUP_VOLUME_SIZE = int(os.getenv('BACKUP_VOLUME_SIZE', 45 * 1024 * 1024))
+BACKUP_CHUNK_SIZE = 1024 * 1024
+
+# Parallel backup configuration
+BACKUP_PARALLEL_WORKERS = int(os.getenv('BACKUP_PARALLEL_WORKERS', os.cpu_count() or 1))
+BACKUP_INSERT_ROWS = int(os.getenv('BACKUP_INSERT_ROWS', 1000))
+# Like mysqldump's net_buffer_length: keeps each INSERT well below max_allowed_packet
+BACKUP_INSERT_BYTES = int(os.getenv('BACKUP_INSERT_BYTES', 1024 * 1024))
+# Seconds writes may stay blocked by the global read lock while workers start their snapshots
+BACKUP_LOCK_TIMEOUT = float(os.getenv('BACKUP_LOCK_TIMEOUT', 30))
+# Seconds without any message from the workers after which they are considered hung
+BACKUP_WORKER_TIMEOUT = float(os.getenv('BACKUP_WORKER_TIMEOUT', 3600))
+MANIFEST_NAME = 'manifest.json'
+
+# Incremental backup configuration
+BACKUP_INCREMENTAL_MODE = os.getenv('BACKUP_INCREMENTAL_MODE', 'auto')  # auto, binlog or watermark
+BACKUP_CHAIN_MAX_DELTAS = int(os.getenv('BACKUP_CHAIN_MAX_DELTAS', 30))
+# Columns holding a row's last change time, used as high-water marks next to auto-increment keys
+BACKUP_CHANGE_COLUMNS = [
+    column.strip() for column in os.getenv(
+        'BACKUP_CHANGE_COLUMNS', 'last_updated,dateupdated,date_updated,updated_at'
+    ).split(',') if column.strip()
+]
+CHAIN_NAME = 'chain.json'
+
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+def get_compressor(method=BACKUP_COMPRESSION, level=BACKUP_COMPRESSION_LEVEL, threads=BACKUP_THREADS):
+    """Return an object with compress()/flush() for the given method"""
+    if method == 'gzip':
+        # wbits=31 writes a gzip header, so volumes concatenate to a plain .gz file
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if method == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstandard not installed, use BACKUP_COMPRESSION=gzip")
+        return zstandard.ZstdCompressor(level=level, threads=threads).compressobj()
+    if method == 'none':
+        return _NoCompression()
+    raise Exception(f"Unknown backup compression: {method}")
+
+def get_decompressor(method):
+    """Return an object with decompress() for the given method"""
+    if method == 'gzip':
+        return zlib.decompressobj(31)
+    if method == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstandard not installed")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if method == 'none':
+        return _NoCompression()
+    raise Exception(f"Unknown backup compression: {method}")
+
+class _NoCompression:
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+class VolumeWriter:
+    """Write a byte stream into numbered volume files of at most volume_size bytes
+
+    Each volume is written under a .partial name and renamed when it is
+    complete, so neither the uploader nor retention sees half a volume.
+    """
+
+    def __init__(self, base_path, volume_size=BACKUP_VOLUME_SIZE, on_volume=None):
+        self.base_path = base_path
+        self.volume_size = volume_size
+        self.on_volume = on_volume
+        self.volumes = []
+        self.bytes_written = 0
+        self._file = None
+        self._file_size = 0
+
+    def _open(self):
+        path = f"{self.base_path}.{len(self.volumes) + 1:03d}"
+        self.volumes.append(path)
+        self._file = open(path + PARTIAL_SUFFIX, 'wb')
+        self._file_size = 0
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.replace(self.volumes[-1] + PARTIAL_SUFFIX, self.volumes[-1])
+            if self.on_volume:
+                self.on_volume(self.volumes[-1], len(self.volumes))
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self._file is None:
+                self._open()
+            room = self.volume_size - self._file_size
+            self._file.write(view[:room])
+            written = min(room, len(view))
+            self._file_size += written
+            self.bytes_written += written
+            view = view[written:]
+            if self._file_size >= self.volume_size:
+                self._close()
+
+    def close(self):
+        self._close()
+
+def mysqldump_command(extra_args=()):
+    """mysqldump arguments for the current tenant's database; the password goes via MYSQL_PWD"""
+    tenant = current_tenant()
+    return [
+        'mysqldump',
+        f'--host={tenant.host}',
+        f'--user={tenant.user}',
+        '--single-transaction',
+        '--quick',
+        *extra_args,
+        tenant.database,
+    ]
+
+def mysql_env():
+    """Environment for MySQL client tools, keeping the password off the command line"""
+    env = dict(os.environ)
+    password = current_tenant().password
+    if password:
+        env['MYSQL_PWD'] = password
+    return env
+
+def stream_command_to_volumes(cmd, base_path, compression=BACKUP_COMPRESSION,
+                              volume_size=BACKUP_VOLUME_SIZE, on_volume=None):
+    """Pipe a command's stdout through a compressor into volume files
+
+    Finished volumes are handed to on_volume(path, index) on a separate
+    thread, so uploading overlaps with dumping and compressing. Returns
+    the volume paths and per-stage statistics.
+    """
+    uploads = queue.Queue()
+    timings = {'dump': 0.0, 'compress': 0.0, 'write': 0.0, 'upload': 0.0}
+    upload_errors = []
+
+    def upload_worker():
+        while True:
+            item = uploads.get()
+            if item is None:
+                return
+            started = time.monotonic()
+            try:
+                on_volume(*item)
+            except Exception as e:
+                logger.error(f"Uploading backup volume {item[0]} failed: {e}")
+                upload_errors.append(e)
+            timings['upload'] += time.monotonic() - started
+
+    uploader = None
+    if on_volume:
+        uploader = threading.Thread(target=upload_worker, name='backup-upload', daemon=True)
+        uploader.start()
+
+    compressor = get_compressor(compression)
+    writer = VolumeWriter(base_path, volume_size, on_volume=lambda *item: uploads.put(item))
+    raw_bytes = 0
+    started = time.monotonic()
+
+    try:
+        # stderr goes to a file so a chatty tool can never block on a full pipe
+        errors = tempfile.TemporaryFile()
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors, env=mysql_env())
+    except OSError as e:
+        raise Exception(f"Database backup failed: {e}")
+
+    try:
+        while True:
+            job = current_job()
+            if job and job.cancelled:
+                process.kill()
+                raise Exception("Database backup cancelled")
+
+            stage = time.monotonic()
+            chunk = process.stdout.read(BACKUP_CHUNK_SIZE)
+            timings['dump'] += time.monotonic() - stage
+            if not chunk:
+                break
+            raw_bytes += len(chunk)
+
+            stage = time.monotonic()
+            compressed = compressor.compress(chunk)
+            timings['compress'] += time.monotonic() - stage
+
+            stage = time.monotonic()
+            writer.write(compressed)
+            timings['write'] += time.monotonic() - stage
+
+        stage = time.monotonic()
+        tail = compressor.flush()
+        timings['compress'] += time.monotonic() - stage
+        writer.write(tail)
+
+        if process.wait() != 0:
+            errors.seek(0)
+            stderr = errors.read().decode('utf-8', 'replace').strip()
+            raise Exception(f"Database backup failed: {stderr or process.returncode}")
+        writer.close()
+    except Exception:
+        process.kill()
+        process.wait()
+        writer.on_volume = None
+        writer.close()
+        for path in writer.volumes:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+    finally:
+        errors.close()
+        if uploader is not None:
+            uploads.put(None)
+            uploader.join()
+
+    if upload_errors:
+        raise Exception(f"Uploading backup failed: {upload_errors[0]}")
+
+    elapsed = time.monotonic() - started
+    stats = {
+        'volumes': len(writer.volumes),
+        'raw_bytes': raw_bytes,
+        'compressed_bytes': writer.bytes_written,
+        'ratio': raw_bytes / writer.bytes_written if writer.bytes_written else 0.0,
+        'elapsed': elapsed,
+        'throughput': raw_bytes / elapsed if elapsed else 0.0,
+        'timings': timings,
+        'compression': compression,
+    }
+    return writer.volumes, stats
+
+def backup_database(on_volume=None, compression=BACKUP_COMPRESSION, volume_size=BACKUP_VOLUME_SIZE):
+    """Create a compressed backup of the database, split into volumes
+
+    on_volume(path, index) is called for each volume as soon as it is
+    complete. Concatenating the volumes in order gives one compressed
+    dump. Returns (volume paths, statistics).
+    """
+    tenant = current_tenant()
+    timestamp = time.strftime('%Y%m%d-%H%M%S')
+    base_path = os.path.join(tenant.backup_dir, f"{tenant.database}-{timestamp}.sql{EXTENSIONS[compression]}")
+    volumes, stats = stream_command_to_volumes(
+        mysqldump_command(), base_path,
+        compression=compression, volume_size=volume_size, on_volume=on_volume
+    )
+    record_backup('full', stats['elapsed'], stats['compressed_bytes'])
+    return volumes, stats
+
+def format_size(size):
+    """Human readable byte size"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+def connection_config(database=None):
+    """Connection arguments for worker processes, which open their own connections"""
+    config = current_tenant().connection_config()
+    config.update({'database': database or config['database'], 'charset': 'utf8mb4'})
+    return config
+
+def open_compressed(path, mode, compression=BACKUP_COMPRESSION, level=BACKUP_COMPRESSION_LEVEL):
+    """Open a (compressed) text file for reading ('rt') or writing ('wt')"""
+    if compression == 'gzip':
+        return gzip.open(path, mode, compresslevel=level, encoding='utf-8')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstandard not installed, use BACKUP_COMPRESSION=gzip")
+        return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=level), encoding='utf-8')
+    if compression == 'none':
+        return open(path, mode, encoding='utf-8')
+    raise Exception(f"Unknown backup compression: {compression}")
+
+def quote_identifier(name):
+    """Quote a table or column name with backticks"""
+    return '`' + name.replace('`', '``') + '`'
+
+_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    "'": "\\'",
+    '\0': '\\0',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\x1a': '\\Z',
+})
+
+def sql_literal(value):
+    """Render a value fetched by mysql.connector as a MySQL literal on a single line"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return '0x' + bytes(value).hex() if value else "''"
+    if isinstance(value, datetime.timedelta):
+        seconds = int(abs(value).total_seconds())
+        micros = abs(value).microseconds
+        text = f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+        if micros:
+            text += f".{micros:06d}"
+        return f"'{'-' if value < datetime.timedelta(0) else ''}{text}'"
+    if isinstance(value, (datetime.date, datetime.time)):
+        return f"'{value}'"
+    if isinstance(value, set):
+        value = ','.join(sorted(value))
+    return "'" + str(value).translate(_ESCAPES) + "'"
+
+def _checksum(checksum, data):
+    # Order independent sum of row CRCs, so tables without a primary key verify too
+    return (checksum + zlib.crc32(data)) & 0xFFFFFFFFFFFFFFFF
+
+def _dump_table(connection, table, options):
+    """Write a table's rows as multi-row INSERT statements, one per line
+
+    Each statement holds at most BACKUP_INSERT_ROWS rows and, unless a
+    single row is larger, BACKUP_INSERT_BYTES bytes, so it can be replayed
+    within the server's max_allowed_packet.
+    For incremental dumps (options['since']) only rows past the table's
+    previous watermark are written, as REPLACE statements; tables without
+    watermark columns are copied whole after a DELETE.
+    """
+    started = time.monotonic()
+    path = os.path.join(options['directory'], f"{table}.sql{EXTENSIONS[options['compression']]}")
+    marks = options.get('watermarks', {}).get(table, {})
+    since = options.get('since')
+    query = f"SELECT * FROM {quote_identifier(table)}"
+    params = []
+    verb = 'INSERT'
+    preamble = ''
+
+    if since is not None:
+        previous = since.get(table) or {}
+        conditions = []
+        for kind in ('key', 'change'):
+            if marks.get(kind) and previous.get(kind) is not None:
+                conditions.append(f"{quote_identifier(marks[kind])} > %s")
+                params.append(previous[kind])
+        if conditions:
+            query += ' WHERE ' + ' OR '.join(conditions)
+        if marks:
+            verb = 'REPLACE'
+        else:
+            preamble = f"DELETE FROM {quote_identifier(table)};\n"
+
+    cursor = connection.cursor()
+    cursor.execute(query, params)
+    names = [column[0] for column in cursor.description]
+    columns = ', '.join(quote_identifier(name) for name in names)
+    prefix = f"{verb} INTO {quote_identifier(table)} ({columns}) VALUES "
+    positions = {kind: names.index(column) for kind, column in marks.items() if column in names}
+    highest = {kind: None for kind in positions}
+    rows = 0
+    checksum = 0
+
+    prefix_size = len(prefix.encode('utf-8')) + 2
+    values = []
+    size = prefix_size
+
+    with open_compressed(path, 'wt', options['compression']) as file:
+        file.write(preamble)
+        while True:
+            batch = cursor.fetchmany(BACKUP_INSERT_ROWS)
+            if not batch:
+                break
+            for row in batch:
+                literal = '(' + ','.join(map(sql_literal, row)) + ')'
+                encoded = literal.encode('utf-8')
+                checksum = _checksum(checksum, encoded)
+                if values and (len(values) >= BACKUP_INSERT_ROWS
+                               or size + len(encoded) + 1 > BACKUP_INSERT_BYTES):
+                    file.write(prefix + ','.join(values) + ';\n')
+                    values = []
+                    size = prefix_size
+                values.append(literal)
+                size += len(encoded) + 1
+                for kind, position in positions.items():
+                    value = row[position]
+                    if value is not None and (highest[kind] is None or value > highest[kind]):
+                        highest[kind] = value
+            rows += len(batch)
+        if values:
+            file.write(prefix + ','.join(values) + ';\n')
+    cursor.close()
+
+    result = {
+        'name': table,
+        'file': os.path.basename(path),
+        'rows': rows,
+        'checksum': checksum,
+        'bytes': os.path.getsize(path),
+        'seconds': time.monotonic() - started,
+    }
+    if positions:
+        previous = (since or {}).get(table) or {}
+        result['watermark'] = {
+            kind: previous.get(kind) if value is None else value if isinstance(value, int) else str(value)
+            for kind, value in highest.items()
+        }
+    return result
+
+def _restore_table(connection, table, options):
+    """Replay a table file written by _dump_table"""
+    started = time.monotonic()
+    entry = options['tables'][table]
+    path = os.path.join(options['directory'], entry['file'])
+    cursor = connection.cursor()
+    rows = 0
+    statements = 0
+
+    with open_compressed(path, 'rt', options['compression']) as file:
+        for line in file:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            cursor.execute(line)
+            rows += cursor.rowcount
+            statements += 1
+            if statements % 50 == 0:
+                connection.commit()
+    connection.commit()
+    cursor.close()
+
+    return {'name': table, 'rows': rows, 'seconds': time.monotonic() - started}
+
+def _verify_table(connection, table, options):
+    """Recompute row count and checksum of a restored table"""
+    started = time.monotonic()
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT * FROM {quote_identifier(table)}")
+    rows = 0
+    checksum = 0
+    while True:
+        batch = cursor.fetchmany(BACKUP_INSERT_ROWS)
+        if not batch:
+            break
+        for row in batch:
+            checksum = _checksum(checksum, ('(' + ','.join(map(sql_literal, row)) + ')').encode('utf-8'))
+        rows += len(batch)
+    cursor.close()
+
+    return {'name': table, 'rows': rows, 'checksum': checksum, 'seconds': time.monotonic() - started}
+
+_TABLE_ACTIONS = {
+    'dump': _dump_table,
+    'restore': _restore_table,
+    'verify': _verify_table,
+}
+
+def _table_worker(action, config, options, tasks, results, commands):
+    """Worker process: open a connection, report ready, then process tables from the queue
+
+    Dump workers wait for the coordinator's 'snapshot' command before
+    starting their snapshot transaction and acknowledge it, so the global
+    read lock is only held for that step, not while workers start up.
+    """
+    try:
+        connection = mysql.connector.connect(**config)
+        cursor = connection.cursor()
+        if action == 'dump':
+            cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        elif action == 'restore':
+            cursor.execute("SET SESSION sql_mode = 'NO_AUTO_VALUE_ON_ZERO'")
+            cursor.execute("SET SESSION foreign_key_checks = 0")
+            cursor.execute("SET SESSION unique_checks = 0")
+        cursor.close()
+    except Exception as e:
+        results.put(('error', None, str(e)))
+        return
+    results.put(('ready', None, None))
+
+    if action == 'dump':
+        if commands.get() != 'snapshot':
+            connection.close()
+            return
+        try:
+            cursor = connection.cursor()
+            cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            cursor.close()
+        except Exception as e:
+            results.put(('error', None, str(e)))
+            return
+        results.put(('snapshot', None, None))
+
+    handler = _TABLE_ACTIONS[action]
+    while True:
+        table = tasks.get()
+        if table is None:
+            break
+        try:
+            results.put(('done', handler(connection, table, options), None))
+        except Exception as e:
+            results.put(('error', table, str(e)))
+            break
+    connection.close()
+
+def _next_result(results, processes, deadline=None):
+    """Wait for the next worker message until deadline (default: BACKUP_WORKER_TIMEOUT from now)"""
+    if deadline is None:
+        deadline = time.monotonic() + BACKUP_WORKER_TIMEOUT
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception("Timed out waiting for backup workers")
+        try:
+            return results.get(timeout=min(1, remaining))
+        except queue.Empty:
+            job = current_job()
+            if job and job.cancelled:
+                raise Exception("Backup operation cancelled")
+            if not any(process.is_alive() for process in processes):
+                raise Exception("Backup workers exited unexpectedly")
+
+def _run_table_workers(action, config, options, tables, workers, lock=None):
+    """Process tables in parallel worker processes; returns results in table order
+
+    For dumps, lock() is called once every worker is connected; it may take
+    the global read lock and return a callable releasing it. The workers then
+    start their snapshot transactions and the lock is released as soon as all
+    of them have, or after BACKUP_LOCK_TIMEOUT seconds, killing the workers.
+    Hung workers are killed after BACKUP_WORKER_TIMEOUT seconds of silence.
+    """
+    if not tables:
+        if lock:
+            unlock = lock()
+            if unlock:
+                unlock()
+        return []
+
+    context = multiprocessing.get_context('spawn')
+    tasks = context.Queue()
+    results = context.Queue()
+    for table in tables:
+        tasks.put(table)
+    count = max(1, min(workers, len(tables)))
+    for _ in range(count):
+        tasks.put(None)
+
+    commands = [context.Queue() for _ in range(count)]
+    processes = [
+        context.Process(
+            target=_table_worker, args=(action, config, options, tasks, results, command), daemon=True
+        )
+        for command in commands
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        ready = 0
+        while ready < count:
+            kind, _, error = _next_result(results, processes)
+            if kind == 'error':
+                raise Exception(f"Backup worker could not connect: {error}")
+            ready += 1
+
+        if action == 'dump':
+            deadline = time.monotonic() + BACKUP_LOCK_TIMEOUT
+            unlock = lock() if lock else None
+            try:
+                for command in commands:
+                    command.put('snapshot')
+                started = 0
+                while started < count:
+                    kind, _, error = _next_result(results, processes, deadline)
+                    if kind == 'error':
+                        raise Exception(f"Backup worker could not start a snapshot: {error}")
+                    started += 1
+            finally:
+                if unlock:
+                    try:
+                        unlock()
+                    except Exception as e:
+                        # Closing the coordinator's connection releases the lock as well
+                        logger.error(f"Releasing the global read lock failed: {e}")
+
+        done = {}
+        while len(done) < len(tables):
+            kind, payload, error = _next_result(results, processes)
+            if kind == 'error':
+                raise Exception(f"{action.capitalize()} of table {payload} failed: {error}")
+            done[payload['name']] = payload
+        return [done[table] for table in tables]
+    except BaseException:
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+        raise
+    finally:
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+def _binlog_position(cursor):
+    """Current binary log coordinates, or None when binary logging is unavailable"""
+    for statement in ("SHOW MASTER STATUS", "SHOW BINARY LOG STATUS"):
+        try:
+            cursor.execute(statement)
+            row = cursor.fetchone()
+        except Error:
+            continue
+        if row:
+            return {'file': row['File'], 'position': row['Position']}
+        return None
+    return None
+
+def _watermark_columns(cursor):
+    """Per table auto-increment key and last-change columns usable as high-water marks"""
+    cursor.execute("""
+        SELECT TABLE_NAME AS table_name, COLUMN_NAME AS column_name, COLUMN_KEY AS column_key,
+               EXTRA AS extra, DATA_TYPE AS data_type
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE()
+    """)
+    marks = {}
+    for row in cursor.fetchall():
+        table = marks.setdefault(row['table_name'], {})
+        if row['column_key'] == 'PRI' and 'auto_increment' in row['extra']:
+            table['key'] = row['column_name']
+        elif (row['column_name'] in BACKUP_CHANGE_COLUMNS
+              and row['data_type'] in ('datetime', 'timestamp', 'date')):
+            table['change'] = row['column_name']
+    return {table: columns for table, columns in marks.items() if columns}
+
+def _snapshot_dump(directory, workers, compression, since=None):
+    """Dump all tables of one consistent snapshot into directory, in parallel
+
+    Returns the manifest fields shared by full and incremental dumps.
+    """
+    os.makedirs(directory, exist_ok=True)
+    control = get_connection()
+    cursor = control.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT TABLE_NAME AS name, TABLE_TYPE AS type,
+                   COALESCE(DATA_LENGTH, 0) + COALESCE(INDEX_LENGTH, 0) AS size
+            FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE()
+        """)
+        objects = cursor.fetchall()
+        tables = [
+            row['name'] for row in sorted(objects, key=lambda row: row['size'], reverse=True)
+            if row['type'] == 'BASE TABLE'
+        ]
+        views = [row['name'] for row in objects if row['type'] == 'VIEW']
+        watermarks = _watermark_columns(cursor)
+
+        definitions = {}
+        for table in tables:
+            cursor.execute(f"SHOW CREATE TABLE {quote_identifier(table)}")
+            definitions[table] = cursor.fetchone()['Create Table']
+        view_definitions = []
+        for view in views:
+            cursor.execute(f"SHOW CREATE VIEW {quote_identifier(view)}")
+            view_definitions.append({'name': view, 'create': cursor.fetchone()['Create View']})
+
+        state = {'snapshot': 'per-worker', 'binlog': None}
+
+        def lock():
+            try:
+                # Don't queue behind long running statements while blocking every write
+                cursor.execute(f"SET SESSION lock_wait_timeout = {max(1, int(BACKUP_LOCK_TIMEOUT))}")
+                cursor.execute("FLUSH TABLES WITH READ LOCK")
+            except Error as e:
+                # Needs the RELOAD privilege; without it each worker gets its own snapshot
+                logger.warning(f"Could not take global read lock, snapshots are per worker: {e}")
+                return None
+            state['snapshot'] = 'consistent'
+            state['binlog'] = _binlog_position(cursor)
+            return lambda: cursor.execute("UNLOCK TABLES")
+
+        options = {
+            'directory': directory,
+            'compression': compression,
+            'watermarks': watermarks,
+            'since': since,
+        }
+        results = _run_table_workers('dump', connection_config(), options, tables, workers, lock=lock)
+    finally:
+        cursor.close()
+        control.close()
+
+    for result in results:
+        result['create'] = definitions[result['name']]
+
+    return {
+        'database': current_tenant().database,
+        'compression': compression,
+        'snapshot': state['snapshot'],
+        'binlog': state['binlog'],
+        'workers': workers,
+        'tables': results,
+        'views': view_definitions,
+    }
+
+def parallel_backup(workers=BACKUP_PARALLEL_WORKERS, compression=BACKUP_COMPRESSION, directory=None):
+    """Dump every table concurrently from one consistent snapshot
+
+    Once every worker is connected, a global read lock is held just long
+    enough for each of them to start a consistent snapshot transaction, then the tables (largest first) are
+    dumped in parallel worker processes, one file per table. A manifest
+    records the table definitions, row counts, checksums, per-table
+    high-water marks and the binlog position of the snapshot. Returns
+    (backup directory, manifest).
+    """
+    started = time.monotonic()
+    tenant = current_tenant()
+    timestamp = time.strftime('%Y%m%d-%H%M%S')
+    directory = directory or os.path.join(tenant.backup_dir, f"{tenant.database}-{timestamp}-parallel")
+
+    manifest = {'format': 1, 'type': 'parallel', 'created': timestamp}
+    manifest.update(_snapshot_dump(directory, workers, compression))
+    manifest['elapsed'] = time.monotonic() - started
+    write_manifest(directory, manifest)
+    record_backup('parallel', manifest['elapsed'], sum(table['bytes'] for table in manifest['tables']))
+    return directory, manifest
+
+def write_manifest(directory, manifest):
+    """Write a backup manifest atomically"""
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, default=str)
+    os.replace(f"{path}.tmp", path)
+
+def read_manifest(directory):
+    """Load the manifest of a backup directory"""
+    with open(os.path.join(directory, MANIFEST_NAME), encoding='utf-8') as file:
+        return json.load(file)
+
+def parallel_restore(directory, database, workers=BACKUP_PARALLEL_WORKERS):
+    """Rebuild a database from a parallel backup manifest, loading tables concurrently
+
+    The target database is created if needed; existing tables with the same
+    names are replaced. Returns statistics.
+    """
+    started = time.monotonic()
+    manifest = read_manifest(directory)
+    tables = [entry['name'] for entry in manifest['tables']]
+
+    control = get_connection()
+    cursor = control.cursor()
+    try:
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {quote_identifier(database)}")
+        cursor.execute(f"USE {quote_identifier(database)}")
+        cursor.execute("SET SESSION foreign_key_checks = 0")
+        for entry in manifest['tables']:
+            cursor.execute(f"DROP TABLE IF EXISTS {quote_identifier(entry['name'])}")
+            cursor.execute(entry['create'])
+
+        options = {
+            'directory': directory,
+            'compression': manifest['compression'],
+            'tables': {entry['name']: entry for entry in manifest['tables']},
+        }
+        results = _run_table_workers('restore', connection_config(database), options, tables, workers)
+
+        for view in manifest.get('views', []):
+            cursor.execute(f"DROP VIEW IF EXISTS {quote_identifier(view['name'])}")
+            cursor.execute(re.sub(r'DEFINER=\S+\s', '', view['create']))
+    finally:
+        cursor.close()
+        control.close()
+
+    return {
+        'tables': len(results),
+        'rows': sum(result['rows'] for result in results),
+        'elapsed': time.monotonic() - started,
+    }
+
+def verify_backup(directory, database, workers=BACKUP_PARALLEL_WORKERS):
+    """Compare row counts and checksums of a database with a backup manifest
+
+    Returns a list of mismatches, empty when the database matches.
+    """
+    manifest = read_manifest(directory)
+    tables = [entry['name'] for entry in manifest['tables']]
+    results = _run_table_workers('verify', connection_config(database), {}, tables, workers)
+
+    mismatches = []
+    for entry, result in zip(manifest['tables'], results):
+        if (entry['rows'], entry['checksum']) != (result['rows'], result['checksum']):
+            mismatches.append({
+                'table': entry['name'],
+                'expected_rows': entry['rows'],
+                'actual_rows': result['rows'],
+                'checksum_matches': entry['checksum'] == result['checksum'],
+            })
+    return mismatches
+
+def chain_directory():
+    """Directory holding the current tenant's incremental backup chain"""
+    tenant = current_tenant()
+    return os.path.join(tenant.backup_dir, f"{tenant.database}-chain")
+
+def read_chain(directory):
+    """Load a chain manifest, or None when the directory has no chain yet"""
+    try:
+        with open(os.path.join(directory, CHAIN_NAME), encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def write_chain(directory, chain):
+    """Write a chain manifest atomically"""
+    path = os.path.join(directory, CHAIN_NAME)
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+        json.dump(chain, file, indent=2, default=str)
+    os.replace(f"{path}.tmp", path)
+
+def _chain_mode(base_manifest, mode=BACKUP_INCREMENTAL_MODE):
+    """Pick binlog deltas when the base recorded binlog coordinates and mysqlbinlog exists"""
+    binlog_ready = base_manifest.get('binlog') is not None and shutil.which('mysqlbinlog') is not None
+    if mode == 'binlog' and not binlog_ready:
+        raise Exception("Binlog incremental backups need binary logging, the RELOAD privilege and mysqlbinlog")
+    if mode == 'auto':
+        return 'binlog' if binlog_ready else 'watermark'
+    return mode
+
+def _binlog_files(cursor, first, last):
+    """Names of the binary logs from first to last, inclusive"""
+    for statement in ("SHOW BINARY LOGS", "SHOW MASTER LOGS"):
+        try:
+            cursor.execute(statement)
+            names = [row['Log_name'] for row in cursor.fetchall()]
+            break
+        except Error:
+            continue
+    else:
+        raise Exception("Could not list binary logs")
+    if first not in names:
+        raise Exception(f"Binary log {first} has been purged, start a new chain with a full backup")
+    return names[names.index(first):names.index(last) + 1]
+
+def _binlog_delta(directory, start, compression):
+    """Capture the binlog events since start as SQL in directory; returns the end coordinates"""
+    control = get_connection()
+    cursor = control.cursor(dictionary=True)
+    try:
+        end = _binlog_position(cursor)
+        if end is None:
+            raise Exception("Binary logging is not enabled")
+        files = _binlog_files(cursor, start['file'], end['file'])
+    finally:
+        cursor.close()
+        control.close()
+
+    os.makedirs(directory, exist_ok=True)
+    tenant = current_tenant()
+    cmd = [
+        'mysqlbinlog',
+        '--read-from-remote-server',
+        f'--host={tenant.host}',
+        f'--user={tenant.user}',
+        f'--database={tenant.database}',
+        f"--start-position={start['position']}",
+        f"--stop-position={end['position']}",
+        *files,
+    ]
+    volumes, stats = stream_command_to_volumes(
+        cmd, os.path.join(directory, f"binlog.sql{EXTENSIONS[compression]}"),
+        compression=compression, volume_size=sys.maxsize
+    )
+    return end, [os.path.basename(volume) for volume in volumes], stats
+
+def incremental_backup(workers=BACKUP_PARALLEL_WORKERS, compression=BACKUP_COMPRESSION,
+                       mode=BACKUP_INCREMENTAL_MODE):
+    """Add a backup to the incremental chain: a full base first, small deltas afterwards
+
+    Deltas are either the binlog events since the previous backup, or, where
+    binlog access isn't available, the rows above each table's high-water
+    marks (auto-increment key and last-change column). Watermark deltas can't
+    see deleted rows or edits to tables without a last-change column.
+    Returns (chain directory, chain manifest, entry added).
+    """
+    started = time.monotonic()
+    timestamp = time.strftime('%Y%m%d-%H%M%S')
+    directory = chain_directory()
+    chain = read_chain(directory)
+
+    if chain is not None and len(chain['deltas']) >= BACKUP_CHAIN_MAX_DELTAS:
+        os.rename(directory, f"{directory}-{chain['created']}")
+        chain = None
+
+    if chain is None:
+        base, manifest = parallel_backup(workers, compression, os.path.join(directory, 'base'))
+        chain = {
+            'format': 1,
+            'database': current_tenant().database,
+            'created': timestamp,
+            'mode': _chain_mode(manifest, mode),
+            'base': {'directory': 'base', 'created': timestamp, 'binlog': manifest['binlog']},
+            'deltas': [],
+            'watermarks': {table['name']: table['watermark'] for table in manifest['tables'] if 'watermark' in table},
+            'binlog': manifest['binlog'],
+        }
+        write_chain(directory, chain)
+        return directory, chain, chain['base']
+
+    name = f"delta-{len(chain['deltas']) + 1:04d}-{timestamp}"
+    delta_directory = os.path.join(directory, name)
+    entry = {'directory': name, 'created': timestamp, 'mode': chain['mode']}
+
+    if chain['mode'] == 'binlog':
+        end, files, stats = _binlog_delta(delta_directory, chain['binlog'], compression)
+        entry.update({'start': chain['binlog'], 'end': end, 'files': files, 'bytes': stats['compressed_bytes']})
+        manifest = {'format': 1, 'type': 'delta', 'compression': compression, **entry}
+        chain['binlog'] = end
+    else:
+        manifest = {'format': 1, 'type': 'delta', 'created': timestamp, 'mode': 'watermark'}
+        manifest.update(_snapshot_dump(delta_directory, workers, compression, since=chain['watermarks']))
+        for table in manifest['tables']:
+            if 'watermark' in table:
+                chain['watermarks'][table['name']] = table['watermark']
+        entry.update({
+            'rows': sum(table['rows'] for table in manifest['tables']),
+            'bytes': sum(table['bytes'] for table in manifest['tables']),
+        })
+
+    manifest['elapsed'] = entry['elapsed'] = time.monotonic() - started
+    write_manifest(delta_directory, manifest)
+    chain['deltas'].append(entry)
+    write_chain(directory, chain)
+    record_backup('incremental', entry['elapsed'], entry['bytes'])
+    return directory, chain, entry
+
+def _copy_lines(path, compression, output):
+    with open_compressed(path, 'rt', compression) as file:
+        for line in file:
+            output.write(line)
+
+def rebuild_chain(directory=None, until=None, output=None):
+    """Write one SQL dump of the chain's state at its last backup taken at or before until
+
+    until is a YYYYmmdd-HHMMSS timestamp (default: latest). The result is meant
+    for the mysql client: mysql <database> < dump.sql. Returns the output path.
+    """
+    directory = directory or chain_directory()
+    chain = read_chain(directory)
+    if chain is None:
+        raise Exception(f"No backup chain in {directory}")
+    if until and until < chain['base']['created']:
+        raise Exception(f"The chain starts at {chain['base']['created']}")
+    deltas = [delta for delta in chain['deltas'] if not until or delta['created'] <= until]
+    point = deltas[-1]['created'] if deltas else chain['base']['created']
+    base = read_manifest(os.path.join(directory, chain['base']['directory']))
+    compression = base['compression']
+    output = output or os.path.join(current_tenant().backup_dir, f"{chain['database']}-{point}-rebuilt.sql{EXTENSIONS[compression]}")
+
+    with open_compressed(f"{output}.tmp", 'wt', compression) as dump:
+        dump.write("SET SESSION foreign_key_checks = 0;\n")
+        dump.write("SET SESSION sql_mode = 'NO_AUTO_VALUE_ON_ZERO';\n")
+        base_directory = os.path.join(directory, chain['base']['directory'])
+        for table in base['tables']:
+            dump.write(f"DROP TABLE IF EXISTS {quote_identifier(table['name'])};\n")
+            dump.write(table['create'] + ';\n')
+            _copy_lines(os.path.join(base_directory, table['file']), compression, dump)
+
+        for delta in deltas:
+            delta_directory = os.path.join(directory, delta['directory'])
+            manifest = read_manifest(delta_directory)
+            if delta['mode'] == 'binlog':
+                for name in manifest['files']:
+                    _copy_lines(os.path.join(delta_directory, name), manifest['compression'], dump)
+                continue
+            for table in manifest['tables']:
+                # Tables created after the base need their definition
+                create = re.sub(r'^CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', table['create'])
+                dump.write(create + ';\n')
+                _copy_lines(os.path.join(delta_directory, table['file']), manifest['compression'], dump)
+
+        for view in base.get('views', []):
+            dump.write(f"DROP VIEW IF EXISTS {quote_identifier(view['name'])};\n")
+            dump.write(re.sub(r'DEFINER=\S+\s', '', view['create']) + ';\n')
+        dump.write("SET SESSION foreign_key_checks = 1;\n")
+    os.replace(f"{output}.tmp", output)
+    return output
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Perfex CRM database backups')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('full', help='streaming mysqldump backup')
+    parallel = commands.add_parser('parallel', help='parallel per-table backup from one snapshot')
+    parallel.add_argument('--workers', type=int, default=BACKUP_PARALLEL_WORKERS)
+    restore = commands.add_parser('restore', help='rebuild a database from a parallel backup')
+    restore.add_argument('directory')
+    restore.add_argument('database')
+    restore.add_argument('--workers', type=int, default=BACKUP_PARALLEL_WORKERS)
+    restore.add_argument('--no-verify', action='store_true')
+    commands.add_parser('incremental', help='add a base or delta backup to the incremental chain')
+    rebuild = commands.add_parser('rebuild', help='write a point-in-time dump from the incremental chain')
+    rebuild.add_argument('--chain', default=None)
+    rebuild.add_argument('--until', default=None, help='YYYYmmdd-HHMMSS')
+    rebuild.add_argument('--output', default=None)
+    verify = commands.add_parser('verify', help='check a database against a parallel backup')
+    verify.add_argument('directory')
+    verify.add_argument('database')
+    verify.add_argument('--workers', type=int, default=BACKUP_PARALLEL_WORKERS)
+    args = parser.parse_args(argv)
+
+    if args.command == 'full':
+        volumes, stats = backup_database()
+        print(json.dumps({'volumes': volumes, 'stats': stats}, indent=2))
+    elif args.command == 'parallel':
+        directory, manifest = parallel_backup(workers=args.workers)
+        print(f"{directory}: {len(manifest['tables'])} tables in {manifest['elapsed']:.1f}s "
+              f"({manifest['snapshot']} snapshot)")
+    elif args.command == 'incremental':
+        directory, chain, entry = incremental_backup()
+        print(f"{directory}: added {entry['directory']} ({chain['mode']} chain, {len(chain['deltas'])} deltas)")
+    elif args.command == 'rebuild':
+        print(rebuild_chain(args.chain, args.until, args.output))
+    elif args.command == 'restore':
+        stats = parallel_restore(args.directory, args.database, workers=args.workers)
+        print(f"Restored {stats['tables']} tables, {stats['rows']} rows in {stats['elapsed']:.1f}s")
+        if not args.no_verify:
+            mismatches = verify_backup(args.directory, args.database, workers=args.workers)
+            for mismatch in mismatches:
+                print(f"Mismatch: {mismatch}")
+            return 1 if mismatches else 0
+    elif args.command == 'verify':
+        mismatches = verify_backup(args.directory, args.database, workers=args.workers)
+        for mismatch in mismatches:
+            print(f"Mismatch: {mismatch}")
+        print('OK' if not mismatches else f"{len(mismatches)} tables differ")
+        return 1 if mismatches else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
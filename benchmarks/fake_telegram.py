@@ -0,0 +1,135 @@
+import re
+import json
+import time
+import threading
+import itertools
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeTelegram:
+    """Stand-in for the Telegram Bot API that records uploads
+
+    Every request to /bot<token>/<method> is answered with a successful
+    result; sendDocument calls are recorded with their size and the time
+    it took to receive them. bandwidth (bytes per second) slows uploads
+    down to a realistic rate when set. wait_for() blocks until a message
+    reaches a chat, to time replies end to end.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, bandwidth=None):
+        self.bandwidth = bandwidth
+        self.requests = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._received = threading.Condition(self._lock)
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                started = time.monotonic()
+                size = int(self.headers.get('Content-Length', 0))
+                remaining = size
+                head = b''
+                while remaining:
+                    chunk = self.rfile.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    if not head:
+                        head = chunk[:4096]
+                    remaining -= len(chunk)
+                if fake.bandwidth:
+                    time.sleep(max(0.0, size / fake.bandwidth - (time.monotonic() - started)))
+                method = self.path.rsplit('/', 1)[-1]
+                chat_id = _chat_id(self.headers.get('Content-Type', ''), head)
+                fake.record(method, size, time.monotonic() - started, chat_id)
+
+                body = json.dumps({'ok': True, 'result': fake.result(method, size, chat_id)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def record(self, method, size, seconds, chat_id=None):
+        with self._received:
+            self.requests.append({
+                'method': method, 'bytes': size, 'seconds': seconds,
+                'chat_id': chat_id, 'received': time.monotonic(),
+            })
+            self._received.notify_all()
+
+    def wait_for(self, chat_id, since, timeout=30):
+        """monotonic() time the first message to chat_id after since arrived; None on timeout"""
+        deadline = time.monotonic() + timeout
+        with self._received:
+            while True:
+                for request in reversed(self.requests):
+                    if request['received'] < since:
+                        break
+                    if request['chat_id'] == chat_id and request['method'].startswith('send'):
+                        return request['received']
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._received.wait(remaining)
+
+    def result(self, method, size, chat_id=None):
+        message_id = next(self._ids)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id or 1, 'type': 'private'},
+        }
+        if method == 'sendDocument':
+            message['document'] = {
+                'file_id': f"bench-{message_id}",
+                'file_unique_id': f"bench-{message_id}",
+                'file_size': size,
+            }
+        return message
+
+    def uploads(self):
+        """Recorded sendDocument calls"""
+        with self._lock:
+            return [request for request in self.requests if request['method'] == 'sendDocument']
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-telegram', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def _chat_id(content_type, body):
+    """chat_id parameter of a Bot API request, from JSON, form or multipart bodies"""
+    try:
+        if content_type.startswith('application/json'):
+            value = json.loads(body).get('chat_id')
+        elif content_type.startswith('application/x-www-form-urlencoded'):
+            value = urllib.parse.parse_qs(body.decode('utf-8')).get('chat_id', [None])[0]
+        else:
+            match = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+            value = match and match.group(1)
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,192 @@
+"""Load test of the webhook server
+
+Serves app.py with uvicorn against a stand-in Telegram Bot API server and
+has --admins simulated admins send --updates commands each, one after
+another, all admins at once. Reports requests per second and latency
+percentiles of the webhook acknowledgement and of the first reply reaching
+the admin's chat. Results can be compared with an earlier run:
+
+    python -m benchmarks.load --admins 50 --updates 20 --output load.json
+    python -m benchmarks.load --admins 50 --updates 20 --baseline load.json
+
+The default /help command needs no database; commands like /sales time the
+job acknowledgement while the reports run against DB_* in the background.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.run import compare
+
+FIRST_ADMIN_ID = 1000
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the webhook server with concurrent admins')
+    parser.add_argument('--admins', type=int, default=20, help='admins sending commands at the same time')
+    parser.add_argument('--updates', type=int, default=10, help='commands each admin sends')
+    parser.add_argument('--command', default='/help', help='command every update carries')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for each reply')
+    parser.add_argument('--workdir', help='directory for report files (temporary by default)')
+    parser.add_argument('--output', default='load-results.json')
+    parser.add_argument('--baseline', help='earlier results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio counted as a regression')
+    return parser.parse_args(argv)
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def configure_environment(args, api_url):
+    """Settings app.py reads at import time: the fake Bot API server and the simulated admins"""
+    workdir = args.workdir or tempfile.mkdtemp(prefix='perfex-load-')
+    os.environ.update({
+        'TELEGRAM_TOKEN': '1:load',
+        'TELEGRAM_API_URL': api_url,
+        'ADMIN_USER_IDS': ','.join(str(FIRST_ADMIN_ID + index) for index in range(args.admins)),
+        'WEBHOOK_URL': '',
+        'WEBHOOK_SECRET': '',
+        'PRELOAD_REPORTS': 'false',
+        'REPORTS_DIR': os.path.join(workdir, 'reports'),
+        'BACKUP_DIR': os.path.join(workdir, 'backups'),
+    })
+    return workdir
+
+def start_server(port):
+    """Run app:app with uvicorn in a thread; returns the server once it accepts requests"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config('app:app', host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, name='uvicorn', daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise Exception('Web server failed to start')
+        time.sleep(0.01)
+    server.thread = thread
+    return server
+
+def make_update(update_id, user_id, text):
+    """Telegram update of a private message from user_id"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'admin'},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+async def run_admins(args, url, telegram):
+    """Send every admin's updates concurrently; returns (acknowledgement, reply) latencies and wall time"""
+    import httpx
+
+    acks, replies, missing = [], [], []
+    update_ids = iter(range(1, args.admins * args.updates + 1))
+    # wait_for blocks, so every admin gets a thread to wait in
+    waiters = ThreadPoolExecutor(max_workers=args.admins)
+    loop = asyncio.get_running_loop()
+
+    async def admin(client, user_id):
+        for _ in range(args.updates):
+            update = make_update(next(update_ids), user_id, args.command)
+            started = time.monotonic()
+            response = await client.post(url, json=update)
+            response.raise_for_status()
+            acks.append(time.monotonic() - started)
+            received = await loop.run_in_executor(waiters, telegram.wait_for, user_id, started, args.timeout)
+            if received is None:
+                missing.append(update['update_id'])
+            else:
+                replies.append(received - started)
+
+    limits = httpx.Limits(max_connections=args.admins)
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        started = time.monotonic()
+        await asyncio.gather(*(admin(client, FIRST_ADMIN_ID + index) for index in range(args.admins)))
+        elapsed = time.monotonic() - started
+    waiters.shutdown()
+    return acks, replies, missing, elapsed
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+def _summary(latencies, elapsed):
+    if not latencies:
+        return {'requests': 0}
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed,
+        'p50': _percentile(latencies, 50),
+        'p99': _percentile(latencies, 99),
+        'max': max(latencies),
+        'mean': statistics.mean(latencies),
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    from benchmarks.fake_telegram import FakeTelegram
+
+    telegram = FakeTelegram().start()
+    workdir = configure_environment(args, telegram.base_url)
+    port = _free_port()
+    server = start_server(port)
+    try:
+        acks, replies, missing, elapsed = asyncio.run(
+            run_admins(args, f"http://127.0.0.1:{port}/webhook", telegram)
+        )
+    finally:
+        server.should_exit = True
+        server.thread.join()
+        telegram.stop()
+
+    results = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'admins': args.admins,
+        'updates': args.updates,
+        'command': args.command,
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'results': {
+            'load.webhook': _summary(acks, elapsed),
+            'load.reply': _summary(replies, elapsed),
+        },
+        'missing_replies': missing,
+        'seconds': elapsed,
+        'workdir': workdir,
+    }
+    for name, result in results['results'].items():
+        if result['requests']:
+            print(
+                f"{name}: {result['rps']:.0f} req/s, p50 {result['p50'] * 1000:.1f}ms, "
+                f"p99 {result['p99'] * 1000:.1f}ms, max {result['max'] * 1000:.1f}ms", file=sys.stderr
+            )
+    if missing:
+        print(f"{len(missing)} update(s) got no reply within {args.timeout}s", file=sys.stderr)
+
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.threshold, metrics=('p50', 'p99'))
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 1 if missing else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
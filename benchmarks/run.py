@@ -0,0 +1,249 @@
+"""Offline benchmark of the report and backup paths
+
+Creates the Perfex tables in a separate database, fills them with synthetic
+rows, runs every reports.get_*_report function, the rollup refresh next to
+the grouped query it replaces and backup_database against them and uploads
+the files to a stand-in Telegram Bot API server. Results are written to a
+JSON file and can be compared with an earlier run:
+
+    python -m benchmarks.run --rows 100000 --output bench-100k.json
+    python -m benchmarks.run --rows 100000 --skip-load --baseline bench-100k.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import platform
+import resource
+import statistics
+import tempfile
+import urllib.request
+
+REPORT_TYPES = ['sales', 'payments', 'invoices', 'estimates', 'proposals']
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark reports and backups against synthetic Perfex data')
+    parser.add_argument('--rows', type=int, default=10000, help='invoices to generate (other tables scale with it)')
+    parser.add_argument('--database', default='perfex_bench', help='database to create the tables in')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per report; the first one is cold')
+    parser.add_argument('--skip-load', action='store_true', help='reuse the data already in the database')
+    parser.add_argument('--skip-backup', action='store_true')
+    parser.add_argument('--bandwidth', type=float, help='simulated upload bandwidth in bytes per second')
+    parser.add_argument('--workdir', help='directory for report files and backups (temporary by default)')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--baseline', help='earlier results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio counted as a regression')
+    return parser.parse_args(argv)
+
+def configure_environment(args):
+    """Point the bot's modules at the benchmark database and scratch directories
+
+    Has to run before any of them is imported, as they read their settings
+    at import time.
+    """
+    workdir = args.workdir or tempfile.mkdtemp(prefix='perfex-bench-')
+    os.environ.update({
+        'DB_NAME': args.database,
+        'REPORTS_DIR': os.path.join(workdir, 'reports'),
+        'BACKUP_DIR': os.path.join(workdir, 'backups'),
+        'AGGREGATES_DB': os.path.join(workdir, 'reports', 'aggregates.db'),
+        'ARTIFACTS_DB': os.path.join(workdir, 'reports', 'artifacts.db'),
+        'CACHE_DIR': '',
+    })
+    return workdir
+
+def upload_document(url, path, chat_id=1):
+    """POST a file as multipart/form-data like sendDocument does; returns seconds taken"""
+    boundary = uuid.uuid4().hex
+    with open(path, 'rb') as file:
+        content = file.read()
+    body = b''.join([
+        f'--{boundary}\r\nContent-Disposition: form-data; name="chat_id"\r\n\r\n{chat_id}\r\n'.encode('utf-8'),
+        f'--{boundary}\r\nContent-Disposition: form-data; name="document"; '
+        f'filename="{os.path.basename(path)}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode('utf-8'),
+        content,
+        f'\r\n--{boundary}--\r\n'.encode('utf-8'),
+    ])
+    request = urllib.request.Request(
+        url, data=body, headers={'Content-Type': f'multipart/form-data; boundary={boundary}'}
+    )
+    started = time.monotonic()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.monotonic() - started
+
+def load_data(args):
+    import mysql.connector
+    from backups import connection_config
+    from benchmarks.schema import create_schema, populate
+
+    config = connection_config()
+    config.pop('database')
+    connection = mysql.connector.connect(**config)
+    cursor = connection.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{args.database}` CHARACTER SET utf8mb4")
+    cursor.execute(f"USE `{args.database}`")
+    create_schema(cursor)
+    cursor.close()
+
+    def progress(table, rows):
+        print(f"\r  {table}: {rows} rows", end='', file=sys.stderr)
+
+    started = time.monotonic()
+    counts = populate(connection, args.rows, seed=args.seed, progress=progress)
+    print(file=sys.stderr)
+    connection.close()
+    return {'seconds': time.monotonic() - started, 'rows': counts}
+
+def bench_reports(args, upload_url):
+    import reports
+
+    results = {}
+    for report_type in REPORT_TYPES:
+        build = getattr(reports, f"get_{report_type}_report")
+        runs = []
+        for _ in range(args.repeat):
+            started = time.monotonic()
+            path = build()
+            runs.append(time.monotonic() - started)
+        results[f"report.{report_type}"] = {
+            'cold': runs[0],
+            'warm': statistics.median(runs[1:]) if len(runs) > 1 else None,
+            'runs': runs,
+            'bytes': os.path.getsize(path),
+            'upload': upload_document(upload_url, path),
+        }
+        print(f"  {report_type}: cold {runs[0]:.3f}s, {results[f'report.{report_type}']['bytes']} bytes", file=sys.stderr)
+    return results
+
+def bench_aggregates(args, workdir):
+    """Time the incremental rollup refresh against the grouped query it replaces"""
+    from aggregates import FACTS, AggregateStore
+    from database import execute_query
+    from reports import SALES_QUERY, PAYMENTS_QUERY
+
+    baselines = {'sales': SALES_QUERY, 'payments': PAYMENTS_QUERY}
+    path = os.path.join(workdir, 'bench-aggregates.db')
+    if os.path.exists(path):
+        os.remove(path)
+    store = AggregateStore(path)
+
+    results = {}
+    for fact in FACTS:
+        started = time.monotonic()
+        store.rebuild(fact)
+        rebuild = time.monotonic() - started
+        timings = {}
+        for name, run in (('refresh', lambda: store.refresh(fact)), ('baseline', lambda: execute_query(baselines[fact]))):
+            runs = []
+            for _ in range(args.repeat):
+                started = time.monotonic()
+                run()
+                runs.append(time.monotonic() - started)
+            timings[name] = runs
+            results[f"aggregates.{fact}.{name}"] = {
+                'cold': runs[0],
+                'warm': statistics.median(runs[1:]) if len(runs) > 1 else None,
+                'runs': runs,
+            }
+        results[f"aggregates.{fact}.refresh"]['rebuild'] = rebuild
+        speedup = statistics.median(timings['baseline']) / max(statistics.median(timings['refresh']), 1e-9)
+        results[f"aggregates.{fact}.refresh"]['speedup'] = speedup
+        print(f"  {fact}: refresh {statistics.median(timings['refresh']):.3f}s, "
+              f"full query {statistics.median(timings['baseline']):.3f}s ({speedup:.1f}x)", file=sys.stderr)
+    return results
+
+def bench_backup(upload_url):
+    from backups import backup_database
+
+    uploads = []
+    started = time.monotonic()
+    volumes, stats = backup_database(on_volume=lambda path, index: uploads.append(upload_document(upload_url, path)))
+    return {
+        'backup.full': {
+            'cold': time.monotonic() - started,
+            'volumes': len(volumes),
+            'bytes': stats['compressed_bytes'],
+            'raw_bytes': stats['raw_bytes'],
+            'throughput': stats['throughput'],
+            'timings': stats['timings'],
+            'upload': sum(uploads),
+        }
+    }
+
+def compare(results, baseline, threshold, metrics=('cold', 'warm', 'upload')):
+    """Print the change of every timing against a baseline; returns the regressions"""
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        previous = baseline['results'].get(name)
+        if not previous:
+            continue
+        for metric in metrics:
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = new / old - 1
+            flag = ' REGRESSION' if change > threshold else ''
+            print(f"{name}.{metric}: {old:.3f}s -> {new:.3f}s ({change:+.0%}){flag}")
+            if flag:
+                regressions.append(f"{name}.{metric}")
+    return regressions
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = configure_environment(args)
+
+    from benchmarks.fake_telegram import FakeTelegram
+    from database import get_connection
+
+    results = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'rows': args.rows,
+        'seed': args.seed,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': {},
+    }
+    if not args.skip_load:
+        print(f"Loading {args.rows} invoices into {args.database}...", file=sys.stderr)
+        results['load'] = load_data(args)
+
+    connection = get_connection()
+    results['environment']['mysql'] = connection.get_server_info()
+    connection.close()
+
+    telegram = FakeTelegram(bandwidth=args.bandwidth).start()
+    upload_url = f"{telegram.base_url}bench/sendDocument"
+    try:
+        print('Reports:', file=sys.stderr)
+        results['results'].update(bench_reports(args, upload_url))
+        print('Rollups:', file=sys.stderr)
+        results['results'].update(bench_aggregates(args, workdir))
+        if not args.skip_backup:
+            print('Backup:', file=sys.stderr)
+            results['results'].update(bench_backup(upload_url))
+    finally:
+        telegram.stop()
+
+    results['uploads'] = telegram.uploads()
+    results['environment']['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['workdir'] = workdir
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2, default=str)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
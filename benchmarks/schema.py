@@ -0,0 +1,201 @@
+import random
+import datetime
+
+# The Perfex CRM tables and columns the bot queries, with the indexes a
+# stock Perfex install has (none on the date columns)
+SCHEMA = [
+    """
+    CREATE TABLE tblclients (
+        userid INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        company VARCHAR(191),
+        datecreated DATETIME NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE tblpaymentmodes (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        name VARCHAR(100) NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE tblinvoices (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        number INT NOT NULL,
+        clientid INT NOT NULL,
+        date DATE NOT NULL,
+        duedate DATE,
+        subtotal DECIMAL(15,2) NOT NULL,
+        total_tax DECIMAL(15,2) NOT NULL DEFAULT 0,
+        total DECIMAL(15,2) NOT NULL,
+        status INT NOT NULL DEFAULT 1,
+        datecreated DATETIME NOT NULL,
+        KEY clientid (clientid),
+        KEY status (status)
+    )
+    """,
+    """
+    CREATE TABLE tblinvoicepaymentrecords (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        invoiceid INT NOT NULL,
+        amount DECIMAL(15,2) NOT NULL,
+        paymentmode VARCHAR(40),
+        date DATE NOT NULL,
+        daterecorded DATETIME NOT NULL,
+        transactionid MEDIUMTEXT,
+        KEY invoiceid (invoiceid),
+        KEY paymentmode (paymentmode)
+    )
+    """,
+    """
+    CREATE TABLE tblestimates (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        number INT NOT NULL,
+        clientid INT NOT NULL,
+        date DATE NOT NULL,
+        expirydate DATE,
+        subtotal DECIMAL(15,2) NOT NULL,
+        total_tax DECIMAL(15,2) NOT NULL DEFAULT 0,
+        total DECIMAL(15,2) NOT NULL,
+        status INT NOT NULL DEFAULT 1,
+        datecreated DATETIME NOT NULL,
+        KEY clientid (clientid),
+        KEY status (status)
+    )
+    """,
+    """
+    CREATE TABLE tblproposals (
+        id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        subject VARCHAR(191),
+        rel_id INT,
+        rel_type VARCHAR(40),
+        datecreated DATETIME NOT NULL,
+        open_till DATE,
+        subtotal DECIMAL(15,2) NOT NULL,
+        total_tax DECIMAL(15,2) NOT NULL DEFAULT 0,
+        total DECIMAL(15,2) NOT NULL,
+        status INT NOT NULL DEFAULT 0
+    )
+    """,
+]
+
+TABLES = [
+    'tblclients', 'tblpaymentmodes', 'tblinvoices',
+    'tblinvoicepaymentrecords', 'tblestimates', 'tblproposals',
+]
+
+PAYMENT_MODES = ['Bank', 'Cash', 'Card', 'PayPal', 'Stripe']
+
+# Rows per table relative to the number of invoices
+VOLUMES = {
+    'tblclients': 0.01,
+    'tblinvoicepaymentrecords': 0.8,
+    'tblestimates': 0.5,
+    'tblproposals': 0.3,
+}
+
+INSERT_BATCH = 5000
+
+def table_rows(invoices):
+    """Row count per generated table for a given number of invoices"""
+    counts = {table: max(1, int(invoices * ratio)) for table, ratio in VOLUMES.items()}
+    counts['tblclients'] = max(counts['tblclients'], 100)
+    counts['tblinvoices'] = invoices
+    counts['tblpaymentmodes'] = len(PAYMENT_MODES)
+    return counts
+
+def create_schema(cursor):
+    """Drop and recreate the benchmark tables"""
+    for table in reversed(TABLES):
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+def _amounts(rng):
+    subtotal = round(rng.uniform(10, 5000), 2)
+    tax = round(subtotal * rng.choice((0, 0.09, 0.1)), 2)
+    return subtotal, tax, round(subtotal + tax, 2)
+
+def _rows(table, count, counts, rng, start):
+    """Yield generated rows of a table as tuples in column order"""
+    days = (datetime.date.today() - start).days
+    for index in range(1, count + 1):
+        # Ids grow with the date, as rows are added over time in a real install
+        day = start + datetime.timedelta(days=min(days - 1, (index - 1) * days // count + rng.randrange(2)))
+        created = datetime.datetime.combine(day, datetime.time(rng.randrange(24), rng.randrange(60)))
+        if table == 'tblclients':
+            yield (index, f"Client {index}", created)
+        elif table == 'tblpaymentmodes':
+            yield (index, PAYMENT_MODES[index - 1])
+        elif table in ('tblinvoices', 'tblestimates'):
+            subtotal, tax, total = _amounts(rng)
+            yield (
+                index, index, rng.randint(1, counts['tblclients']), day, day + datetime.timedelta(days=30),
+                subtotal, tax, total, rng.randint(1, 5), created,
+            )
+        elif table == 'tblinvoicepaymentrecords':
+            yield (
+                index, rng.randint(1, counts['tblinvoices']), round(rng.uniform(10, 5000), 2),
+                str(rng.randint(1, len(PAYMENT_MODES))), day, created, f"TX{rng.getrandbits(40):010x}",
+            )
+        elif table == 'tblproposals':
+            subtotal, tax, total = _amounts(rng)
+            rel_type = 'customer' if rng.random() < 0.8 else 'lead'
+            yield (
+                index, f"Proposal {index}", rng.randint(1, counts['tblclients']), rel_type, created,
+                day + datetime.timedelta(days=14), subtotal, tax, total, rng.randint(0, 4),
+            )
+
+COLUMNS = {
+    'tblclients': ('userid', 'company', 'datecreated'),
+    'tblpaymentmodes': ('id', 'name'),
+    'tblinvoices': (
+        'id', 'number', 'clientid', 'date', 'duedate', 'subtotal', 'total_tax', 'total', 'status', 'datecreated'
+    ),
+    'tblinvoicepaymentrecords': ('id', 'invoiceid', 'amount', 'paymentmode', 'date', 'daterecorded', 'transactionid'),
+    'tblestimates': (
+        'id', 'number', 'clientid', 'date', 'expirydate', 'subtotal', 'total_tax', 'total', 'status', 'datecreated'
+    ),
+    'tblproposals': (
+        'id', 'subject', 'rel_id', 'rel_type', 'datecreated', 'open_till', 'subtotal', 'total_tax', 'total', 'status'
+    ),
+}
+
+def populate(connection, invoices, seed=1, years=5, progress=None):
+    """Fill the benchmark tables with deterministic synthetic data
+
+    Returns the row count per table. progress(table, rows) is called after
+    every inserted batch.
+    """
+    rng = random.Random(seed)
+    counts = table_rows(invoices)
+    start = datetime.date.today() - datetime.timedelta(days=365 * years)
+    cursor = connection.cursor()
+    cursor.execute("SET unique_checks = 0")
+    try:
+        for table in TABLES:
+            columns = COLUMNS[table]
+            query = (
+                f"INSERT INTO {table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join(['%s'] * len(columns))})"
+            )
+            batch = []
+            inserted = 0
+            for row in _rows(table, counts[table], counts, rng, start):
+                batch.append(row)
+                if len(batch) >= INSERT_BATCH:
+                    cursor.executemany(query, batch)
+                    connection.commit()
+                    inserted += len(batch)
+                    batch = []
+                    if progress:
+                        progress(table, inserted)
+            if batch:
+                cursor.executemany(query, batch)
+                connection.commit()
+                inserted += len(batch)
+                if progress:
+                    progress(table, inserted)
+    finally:
+        cursor.execute("SET unique_checks = 1")
+        cursor.close()
+    return counts
@@ -0,0 +1,142 @@
+"""Startup time of the bot process
+
+Measures, each in fresh interpreters: importing app.py, importing the report
+stack it loads lazily, and the time from process start until the web server
+answers on /, with the bot started against a stand-in Bot API server. Results are written to JSON and can be compared with an
+earlier run like benchmarks.run results:
+
+    python -m benchmarks.startup --output startup.json
+    python -m benchmarks.startup --baseline startup.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import statistics
+import subprocess
+import urllib.request
+
+from benchmarks.run import compare
+
+IMPORT_APP = "import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)"
+IMPORT_REPORTS = (
+    "import time; started = time.perf_counter(); import reports, backups, xlsxwriter; "
+    "print(time.perf_counter() - started)"
+)
+SERVE_APP = "import uvicorn; uvicorn.run('app:app', host='127.0.0.1', port={port}, log_level='warning')"
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark bot process startup')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh processes per measurement')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for / to answer')
+    parser.add_argument('--output', default='startup-results.json')
+    parser.add_argument('--baseline', help='earlier results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio counted as a regression')
+    return parser.parse_args(argv)
+
+def _environment(**overrides):
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1', **overrides)
+    env.setdefault('TELEGRAM_TOKEN', '0:bench')
+    return env
+
+def time_import(code, repeat, **env):
+    """Seconds reported by code run in fresh interpreters, one per repeat"""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', code], env=_environment(**env),
+            capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(float(output.strip().splitlines()[-1]))
+    return runs
+
+def slowest_imports(module, limit=10, **env):
+    """Modules with the highest cumulative import time when importing module, from -X importtime"""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"], env=_environment(**env),
+        capture_output=True, text=True
+    ).stderr
+    timings = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        timings.append((int(cumulative) / 1e6, name.strip()))
+    return [{'module': name, 'seconds': seconds} for seconds, name in sorted(timings, reverse=True)[:limit]]
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def time_first_response(timeout, **env):
+    """Seconds from starting the web process until / answers"""
+    port = _free_port()
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, '-c', SERVE_APP.format(port=port)], env=_environment(**env),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.monotonic() - started < timeout:
+            if process.poll() is not None:
+                raise Exception(f"Web process exited with code {process.returncode}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                    response.read()
+                return time.monotonic() - started
+            except OSError:
+                time.sleep(0.01)
+        raise Exception(f"/ did not answer within {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+def _summary(runs):
+    return {'cold': statistics.median(runs), 'min': min(runs), 'max': max(runs), 'runs': runs}
+
+def main(argv=None):
+    args = parse_args(argv)
+    from benchmarks.fake_telegram import FakeTelegram
+    telegram = FakeTelegram().start()
+    try:
+        first_response = [
+            time_first_response(args.timeout, TELEGRAM_API_URL=telegram.base_url, WEBHOOK_URL='')
+            for _ in range(args.repeat)
+        ]
+    finally:
+        telegram.stop()
+
+    results = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'results': {
+            'startup.import_app': _summary(time_import(IMPORT_APP, args.repeat, PRELOAD_REPORTS='false')),
+            'startup.import_reports': _summary(time_import(IMPORT_REPORTS, args.repeat)),
+            'startup.first_response': _summary(first_response),
+        },
+        'slowest_imports': {
+            'app': slowest_imports('app', PRELOAD_REPORTS='false'),
+            'reports': slowest_imports('reports'),
+        },
+    }
+    for name, result in results['results'].items():
+        print(f"{name}: {result['cold']:.3f}s (min {result['min']:.3f}s, max {result['max']:.3f}s)", file=sys.stderr)
+
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import os
+import re
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from tenants import current_tenant_id
+
+# Load environment variables
+load_dotenv()
+
+# Cache configuration
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 256))
+CACHE_DIR = os.getenv('CACHE_DIR')  # optional on-disk backing, disabled when unset
+CACHE_DISK_MAX_ENTRIES = int(os.getenv('CACHE_DISK_MAX_ENTRIES', 1024))
+
+# Per report TTLs in seconds, e.g. "sales:600,invoices:120"
+CACHE_TTLS = {
+    name.strip(): float(ttl)
+    for name, ttl in (
+        item.split(':') for item in os.getenv(
+            'CACHE_TTLS', 'sales:600,payments:600,invoices:120,estimates:300,proposals:300'
+        ).split(',') if item
+    )
+}
+
+def normalize_query(query):
+    """Collapse whitespace so formatting differences map to the same key"""
+    return re.sub(r'\s+', ' ', query).strip()
+
+def cache_key(query, params=None):
+    """Key for a query result: hash of the current tenant, the normalized SQL and its parameters"""
+    raw = f"{current_tenant_id() or ''}\0{normalize_query(query)}\0{tuple(params) if params else ()!r}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def report_ttl(report_type):
+    """Cache TTL configured for a report type (0 disables caching)"""
+    return CACHE_TTLS.get(report_type, 0)
+
+class ResultCache:
+    """In-memory LRU of query results with TTL and watermark checks, optionally backed by disk"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, cache_dir=CACHE_DIR,
+                 disk_max_entries=CACHE_DISK_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.disk_max_entries = disk_max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'stale': 0, 'evictions': 0, 'disk_hits': 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def _load(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), 'rb') as file:
+                return pickle.load(file)
+        except (OSError, pickle.PickleError, EOFError):
+            return None
+
+    def _store(self, key, entry):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as file:
+                pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        self._prune_disk()
+
+    def _prune_disk(self):
+        try:
+            files = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.pkl')]
+        except OSError:
+            return
+        if len(files) <= self.disk_max_entries:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - self.disk_max_entries]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        if self.cache_dir:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, key, ttl, watermark=None):
+        """Return cached rows if younger than ttl and stored at the same watermark, else None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            entry = self._load(key)
+            if entry is not None:
+                with self._lock:
+                    self._stats['disk_hits'] += 1
+                    self._put(key, entry)
+
+        with self._lock:
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            stored_at, stored_watermark, rows = entry
+            if time.time() - stored_at > ttl:
+                self._stats['expired'] += 1
+                self._remove(key)
+                return None
+            if stored_watermark != watermark:
+                self._stats['stale'] += 1
+                self._remove(key)
+                return None
+            self._stats['hits'] += 1
+
+        # Callers may annotate the rows they get, so hand out copies
+        return [dict(row) for row in rows]
+
+    def _put(self, key, entry):
+        # Called with the lock held
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def set(self, key, rows, watermark=None):
+        """Store query rows along with the watermark they were read at"""
+        entry = (time.time(), watermark, [dict(row) for row in rows])
+        with self._lock:
+            self._put(key, entry)
+        if self.cache_dir:
+            self._store(key, entry)
+
+    def clear(self):
+        """Drop all cached results"""
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+        if self.cache_dir:
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.pkl'):
+                    os.remove(entry.path)
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses'] + stats['expired'] + stats['stale']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+result_cache = ResultCache()
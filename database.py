@@ -1,106 +1,336 @@
 import os
 import time
-import subprocess
+import functools
+import threading
+from collections import deque
 import mysql.connector
 from mysql.connector import Error
 from dotenv import load_dotenv
+from cache import result_cache, cache_key
+from metrics import DB_QUERY_SECONDS, ERRORS
+from profiler import profiler
+from tenants import TenantLocal, current_tenant, current_tenant_id
 
 # Load environment variables
 load_dotenv()
 
-# Database configuration
-DB_HOST = os.getenv('DB_HOST', 'localhost')
-DB_USER = os.getenv('DB_USER')
-DB_PASSWORD = os.getenv('DB_PASSWORD')
-DB_NAME = os.getenv('DB_NAME')
-BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+# Connection pool configuration
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PING_INTERVAL = int(os.getenv('DB_POOL_PING_INTERVAL', 30))
 
-# Ensure backup directory exists
-os.makedirs(BACKUP_DIR, exist_ok=True)
+# Seconds a change watermark probe is reused before the tables are probed again
+CACHE_WATERMARK_INTERVAL = float(os.getenv('CACHE_WATERMARK_INTERVAL', 5))
 
-def get_connection():
-    """Create a connection to the database"""
+def get_connection(tenant=None):
+    """Create a connection to the database of the current (or the given) tenant"""
+    tenant = tenant or current_tenant()
     try:
-        connection = mysql.connector.connect(
-            host=DB_HOST,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME
-        )
+        connection = mysql.connector.connect(**tenant.connection_config())
         return connection
     except Error as e:
         raise Exception(f"Error connecting to MySQL database: {e}")
 
-def backup_database():
-    """Create a backup of the database"""
-    timestamp = time.strftime('%Y%m%d-%H%M%S')
-    backup_file = os.path.join(BACKUP_DIR, f"{DB_NAME}-{timestamp}.sql")
-    
-    # Check if we're on Windows
-    if os.name == 'nt':
-        # On Windows, use the mysqldump command in a slightly different way
-        cmd = [
-            'mysqldump',
-            f'--host={DB_HOST}',
-            f'--user={DB_USER}',
-            f'--password={DB_PASSWORD}',
-            DB_NAME,
-            f'--result-file={backup_file}'
-        ]
-    else:
-        # Unix-based systems
-        cmd = [
-            'mysqldump',
-            f'--host={DB_HOST}',
-            f'--user={DB_USER}',
-            f'--password={DB_PASSWORD}',
-            DB_NAME,
-            '>', 
-            backup_file
-        ]
-    
-    try:
-        # For Windows, we'll use subprocess directly
-        if os.name == 'nt':
-            subprocess.run(cmd, check=True)
-        else:
-            # For Unix, we'll use shell=True to properly handle the redirect
-            subprocess.run(' '.join(cmd), shell=True, check=True)
-            
-        return backup_file
-    except subprocess.CalledProcessError as e:
-        raise Exception(f"Database backup failed: {e}")
-
-def execute_query(query, params=None, fetch=True):
-    """Execute a query and return results"""
-    connection = get_connection()
+class PooledConnection:
+    """Connection checked out of a ConnectionPool; close() hands it back"""
+
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection)
+
+    def discard(self):
+        """Close the underlying connection instead of returning it, e.g. with unread results"""
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection, discard=True)
+
+class ConnectionPool:
+    """Bounded pool of MySQL connections with health checks and recycling"""
+
+    def __init__(self, factory, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                 recycle=DB_POOL_RECYCLE, ping_interval=DB_POOL_PING_INTERVAL):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self._idle = deque()
+        self._created = {}
+        self._open = 0
+        self._in_use = 0
+        self._lock = threading.Condition()
+        self._stats = {
+            'acquires': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'acquire_time': 0.0,
+            'recycled': 0,
+            'health_check_failures': 0,
+        }
+
+    def _connect(self):
+        connection = self.factory()
+        self._created[id(connection)] = time.monotonic()
+        return connection
+
+    def _discard(self, connection):
+        self._created.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _is_usable(self, connection, last_used):
+        """Recycle old connections and ping ones that sat idle for a while"""
+        now = time.monotonic()
+        if self.recycle and now - self._created.get(id(connection), now) > self.recycle:
+            with self._lock:
+                self._stats['recycled'] += 1
+            return False
+        if self.ping_interval and now - last_used > self.ping_interval:
+            try:
+                connection.ping(reconnect=False)
+            except Exception:
+                with self._lock:
+                    self._stats['health_check_failures'] += 1
+                return False
+        return True
+
+    def acquire(self):
+        """Check a connection out of the pool, waiting up to `timeout` seconds"""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        with self._lock:
+            while True:
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    connection, last_used = None, None
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise Exception(
+                        f"Timed out after {self.timeout}s waiting for a database connection"
+                    )
+                waited = True
+                self._lock.wait(remaining)
+            self._in_use += 1
+
+        try:
+            if connection is not None and not self._is_usable(connection, last_used):
+                self._discard(connection)
+                connection = None
+            if connection is None:
+                connection = self._connect()
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+
+        with self._lock:
+            self._stats['acquires'] += 1
+            self._stats['acquire_time'] += time.monotonic() - started
+            if waited:
+                self._stats['waits'] += 1
+
+        return PooledConnection(self, connection)
+
+    def release(self, connection, discard=False):
+        """Return a connection to the pool, dropping it if it is broken"""
+        healthy = not discard
+        try:
+            if healthy and connection.in_transaction:
+                connection.rollback()
+        except Exception:
+            healthy = False
+
+        with self._lock:
+            self._in_use -= 1
+            if healthy:
+                self._idle.append((connection, time.monotonic()))
+            else:
+                self._open -= 1
+                self._discard(connection)
+            self._lock.notify()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._open -= 1
+                self._discard(connection)
+
+    def stats(self):
+        """Snapshot of pool usage counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'size': self.size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+            })
+        acquires = stats.pop('acquire_time')
+        stats['avg_acquire_ms'] = (acquires / stats['acquires'] * 1000) if stats['acquires'] else 0.0
+        return stats
+
+# Each tenant's pool is created when its database is first used
+_pools = TenantLocal(lambda tenant: ConnectionPool(functools.partial(get_connection, tenant)))
+
+def acquire_connection():
+    """Get a pooled connection to the current tenant's database; call close() on it to return it to the pool"""
+    return _pools.get().acquire()
+
+def get_pool_stats():
+    """Return connection pool statistics (in use, waits, average acquire time...) of the current tenant"""
+    return _pools.get().stats()
+
+def get_tenant_pool_stats():
+    """Connection pool statistics of every tenant that has a pool, by tenant id"""
+    return _pools.stats_by_tenant()
+
+_watermarks = {}
+_watermarks_lock = threading.Lock()
+
+def get_watermark(tables):
+    """Return a cheap change marker for the given tables: their MAX(id) values
+
+    MAX on the primary key is answered from the index without touching rows,
+    so the probe costs a fraction of the report query it guards. New rows move
+    the watermark; edits to existing rows are picked up when the TTL expires.
+    """
+    tables = tuple(sorted(tables))
+    key = (current_tenant_id(), tables)
+    now = time.monotonic()
+    with _watermarks_lock:
+        probed_at, watermark = _watermarks.get(key, (0, None))
+    if watermark is not None and now - probed_at < CACHE_WATERMARK_INTERVAL:
+        return watermark
+
+    for table in tables:
+        if not table.isidentifier():
+            raise Exception(f"Invalid table name for watermark: {table}")
+    query = ' UNION ALL '.join(
+        f"SELECT '{table}' AS table_name, MAX(id) AS max_id FROM `{table}`" for table in tables
+    )
+    watermark = tuple((row['table_name'], row['max_id']) for row in execute_query(query))
+
+    with _watermarks_lock:
+        _watermarks[key] = (now, watermark)
+    return watermark
+
+def execute_query(query, params=None, fetch=True, cache_ttl=None, watermark_tables=()):
+    """Execute a query and return results
+
+    With cache_ttl set, results are served from the result cache for up to
+    cache_ttl seconds, or until the watermark of watermark_tables moves.
+    With profiling on, executed queries are recorded with their rows
+    examined and EXPLAIN plan.
+    """
+    use_cache = fetch and cache_ttl
+    if use_cache:
+        key = cache_key(query, params)
+        watermark = get_watermark(watermark_tables) if watermark_tables else None
+        cached = result_cache.get(key, cache_ttl, watermark)
+        if cached is not None:
+            return cached
+
+    connection = acquire_connection()
     cursor = connection.cursor(dictionary=True)
+    profiling = fetch and profiler.enabled
+    elapsed = None
     
     try:
+        examined = _rows_read(cursor) if profiling else None
+        started = time.monotonic()
         cursor.execute(query, params or ())
         
         if fetch:
             result = cursor.fetchall()
+            elapsed = time.monotonic() - started
+            if profiling:
+                examined = _rows_read(cursor) - examined
+                plan = _explain(cursor, query, params) if profiler.needs_plan(query) else None
+                profiler.record(query, elapsed, len(result), examined, plan)
+            if use_cache:
+                result_cache.set(key, result, watermark)
             return result
         else:
             connection.commit()
+            elapsed = time.monotonic() - started
             return cursor.rowcount
     except Error as e:
+        ERRORS.inc(component='db')
         raise Exception(f"Query execution failed: {e}")
     finally:
+        if elapsed is not None:
+            DB_QUERY_SECONDS.observe(elapsed)
         cursor.close()
         connection.close()
 
-# Alternatively, use pyMySQL with SQLAlchemy for more advanced database operations
-def get_sqlalchemy_engine():
-    """Get SQLAlchemy engine for the database"""
+def _rows_read(cursor):
+    """Rows read by the storage engine in this session so far (approximately the rows examined)"""
+    cursor.execute("SHOW SESSION STATUS LIKE 'Handler_read%'")
+    return sum(int(row['Value']) for row in cursor.fetchall())
+
+def _explain(cursor, query, params=None):
+    cursor.execute("EXPLAIN " + query.strip().rstrip(';'), params or ())
+    return [dict(row) for row in cursor.fetchall()]
+
+def explain_query(query, params=None):
+    """EXPLAIN plan rows of a SELECT query, without running it"""
+    connection = acquire_connection()
+    cursor = connection.cursor(dictionary=True)
     try:
-        from sqlalchemy import create_engine
-        
-        connection_string = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
-        engine = create_engine(connection_string)
-        return engine
-    except ImportError:
-        raise Exception("SQLAlchemy or PyMySQL not installed")
-    except Exception as e:
-        raise Exception(f"Error creating SQLAlchemy engine: {e}") 
\ No newline at end of file
+        return _explain(cursor, query, params)
+    except Error as e:
+        raise Exception(f"Explain failed: {e}")
+    finally:
+        cursor.close()
+        connection.close()
+
+def stream_query(query, params=None, batch_size=1000):
+    """Yield result rows one by one, fetching them from an unbuffered cursor in batches
+
+    Rows are never all held in memory. The pooled connection is busy until
+    the generator is exhausted or closed.
+    """
+    connection = acquire_connection()
+    cursor = connection.cursor(dictionary=True)
+    exhausted = False
+
+    try:
+        cursor.execute(query, params or ())
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+        exhausted = True
+    except Error as e:
+        raise Exception(f"Query execution failed: {e}")
+    finally:
+        if exhausted:
+            cursor.close()
+            connection.close()
+        else:
+            # Reading the rest of a large result just to reuse the connection isn't worth it
+            connection.discard()
+ 
\ No newline at end of file
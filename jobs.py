@@ -0,0 +1,381 @@
+import os
+import time
+import logging
+import itertools
+import threading
+import contextvars
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dotenv import load_dotenv
+from metrics import ERRORS
+from tenants import current_tenant_id
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Worker pool configuration
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 8))
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', 2))
+JOB_HISTORY = int(os.getenv('JOB_HISTORY', 200))
+
+# Per job type concurrency limits, e.g. "report:3,export:1,backup:1"
+JOB_CONCURRENCY = {
+    name.strip(): int(limit)
+    for name, limit in (
+        item.split(':') for item in os.getenv('JOB_CONCURRENCY', 'report:3,export:1,backup:1').split(',') if item
+    )
+}
+# Scheduled reports built at the same time, unless JOB_CONCURRENCY sets "scheduled"
+JOB_CONCURRENCY.setdefault('scheduled', int(os.getenv('SCHEDULE_CONCURRENCY', 1)))
+
+# Order in which queued job types get a free worker, lowest first; unlisted types come last
+JOB_PRIORITIES = {
+    name.strip(): int(priority)
+    for name, priority in (
+        item.split(':') for item in os.getenv('JOB_PRIORITIES', 'report:0,scheduled:1,export:2,backup:3').split(',') if item
+    )
+}
+
+# Job types held back while interactive jobs are running or queued -> longest hold in seconds
+JOB_DEFERRED = {'scheduled': float(os.getenv('SCHEDULE_MAX_DEFER', 600))}
+# Job types that count as interactive work the deferred types yield to
+INTERACTIVE_JOB_TYPES = ('report',)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+_local = threading.local()
+
+class JobCancelled(Exception):
+    """Raised by a job to stop early after it was cancelled; the job ends cancelled, not failed"""
+
+class Job:
+    """A unit of background work and its status"""
+
+    def __init__(self, job_id, job_type, fn, args, kwargs, description='', owner=None):
+        self.id = job_id
+        self.type = job_type
+        self.tenant = current_tenant_id()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.description = description
+        self.owner = owner
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+        # Jobs run in the context they were submitted from, so trace ids carry over
+        self.context = contextvars.copy_context()
+
+    @property
+    def cancelled(self):
+        """True once cancellation was requested; long running jobs should poll this"""
+        return self._cancel.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job finished, failed or was cancelled"""
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'type': self.type,
+            'tenant': self.tenant,
+            'description': self.description,
+            'owner': self.owner,
+            'status': self.status,
+            'error': str(self.error) if self.error else None,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+class JobManager:
+    """Bounded thread pool for background jobs with per-type concurrency limits
+
+    Jobs wait in one queue per type. When a worker frees up, the queued job
+    of the highest priority type that is under its limit starts next, so
+    quick interactive reports overtake bulk exports and backups. Within a
+    type, tenants take turns: the next job is the oldest one of the tenant
+    with the fewest jobs of that type running, so one tenant's pile of
+    exports doesn't hold up everyone else's. Deferred types (scheduled
+    reports) aren't started at all while interactive jobs are running or
+    queued, until their oldest job has waited its longest hold.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, render_workers=RENDER_WORKERS,
+                 limits=None, history=JOB_HISTORY, priorities=None, deferred=None):
+        self.workers = workers
+        self.render_workers = render_workers
+        self.limits = dict(JOB_CONCURRENCY if limits is None else limits)
+        self.priorities = dict(JOB_PRIORITIES if priorities is None else priorities)
+        self.deferred = dict(JOB_DEFERRED if deferred is None else deferred)
+        self.history = history
+        self._ids = itertools.count(1)
+        self._jobs = OrderedDict()
+        self._pending = {}
+        self._running = {}
+        self._tenant_running = {}  # (type, tenant) -> running jobs
+        self._turns = {}  # (type, tenant) -> when the tenant last started a job of the type
+        self._starts = itertools.count(1)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._render_executor = None
+        self._wakeup = None
+
+    def _limit(self, job_type):
+        return self.limits.get(job_type, self.workers)
+
+    def _priority(self, job_type):
+        return self.priorities.get(job_type, max(self.priorities.values(), default=0) + 1)
+
+    def _held(self, job_type):
+        # Called with the lock held: seconds a deferred type is still held back, 0 if it may start
+        if job_type not in self.deferred or not self._pending.get(job_type):
+            return 0
+        if not any(
+            self._running.get(interactive, 0) or self._pending.get(interactive)
+            for interactive in INTERACTIVE_JOB_TYPES
+        ):
+            return 0
+        waited = time.time() - self._pending[job_type][0].created
+        return max(self.deferred[job_type] - waited, 0)
+
+    def _wake_after(self, delay):
+        # Called with the lock held: dispatch again once a held type's hold is over,
+        # even if no job finishes by then
+        if self._wakeup is None or not self._wakeup.is_alive():
+            self._wakeup = threading.Timer(delay, self._wake)
+            self._wakeup.daemon = True
+            self._wakeup.start()
+
+    def _wake(self):
+        with self._lock:
+            self._dispatch()
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        return self._executor
+
+    def submit(self, job_type, fn, *args, description='', owner=None, **kwargs):
+        """Queue fn(*args, **kwargs) as a job of the given type and return the Job"""
+        with self._lock:
+            job = Job(next(self._ids), job_type, fn, args, kwargs, description, owner)
+            self._jobs[job.id] = job
+            self._trim()
+            self._pending.setdefault(job_type, deque()).append(job)
+            self._dispatch()
+        return job
+
+    def _dispatch(self):
+        # Called with the lock held: start queued jobs while workers are free,
+        # highest priority type first, skipping types at their limit
+        while sum(self._running.values()) < self.workers:
+            ready = []
+            for job_type, pending in self._pending.items():
+                if not pending or self._running.get(job_type, 0) >= self._limit(job_type):
+                    continue
+                held = self._held(job_type)
+                if held:
+                    self._wake_after(held)
+                else:
+                    ready.append(job_type)
+            if not ready:
+                return
+            job_type = min(ready, key=self._priority)
+            job = self._next(self._pending[job_type], job_type, self._tenant_running, self._turns)
+            self._pending[job_type].remove(job)
+            if job.status == QUEUED:
+                self._start(job)
+
+    @staticmethod
+    def _next(pending, job_type, running, turns):
+        # The oldest queued job of the tenant with the fewest jobs of the type running,
+        # and of those, the tenant whose last turn was longest ago
+        heads = {}
+        for job in pending:
+            heads.setdefault(job.tenant, job)
+        return min(heads.values(), key=lambda job: (
+            running.get((job_type, job.tenant), 0), turns.get((job_type, job.tenant), 0), job.id
+        ))
+
+    def _order(self, job_type):
+        # Called with the lock held: queued jobs of a type in the order they would start
+        pending = list(self._pending.get(job_type, ()))
+        running = dict(self._tenant_running)
+        turns = dict(self._turns)
+        order = []
+        while pending:
+            job = self._next(pending, job_type, running, turns)
+            pending.remove(job)
+            order.append(job)
+            key = (job_type, job.tenant)
+            running[key] = running.get(key, 0) + 1
+            turns[key] = max(turns.values(), default=0) + 1
+        return order
+
+    def _start(self, job):
+        # Called with the lock held
+        key = (job.type, job.tenant)
+        self._running[job.type] = self._running.get(job.type, 0) + 1
+        self._tenant_running[key] = self._tenant_running.get(key, 0) + 1
+        self._turns[key] = next(self._starts)
+        self._get_executor().submit(job.context.run, self._run, job)
+
+    def _run(self, job):
+        if job.cancelled:
+            self._finish(job, CANCELLED)
+            return
+        job.status = RUNNING
+        job.started = time.time()
+        _local.job = job
+        try:
+            job.result = job.fn(*job.args, **job.kwargs)
+            self._finish(job, CANCELLED if job.cancelled else DONE)
+        except JobCancelled:
+            self._finish(job, CANCELLED)
+        except Exception as e:
+            logger.error(f"Job {job.id} ({job.type}) failed: {e}")
+            ERRORS.inc(component=f"job_{job.type}")
+            job.error = e
+            self._finish(job, FAILED)
+        finally:
+            _local.job = None
+
+    def _finish(self, job, status):
+        job.status = status
+        job.finished = time.time()
+        job._done.set()
+        with self._lock:
+            self._running[job.type] -= 1
+            self._tenant_running[(job.type, job.tenant)] -= 1
+            self._dispatch()
+
+    def _trim(self):
+        # Forget the oldest finished jobs once the history is full
+        excess = len(self._jobs) - self.history
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].finished is not None:
+                del self._jobs[job_id]
+                excess -= 1
+
+    def get(self, job_id):
+        """Return the job with the given id, or None"""
+        return self._jobs.get(job_id)
+
+    def list(self, owner=None):
+        """Return known jobs, newest first, optionally only those of one owner"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job for job in reversed(jobs) if owner is None or job.owner == owner]
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or ask a running one to stop; returns False if unknown or finished"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished is not None:
+                return False
+            job._cancel.set()
+            if job.status == QUEUED:
+                pending = self._pending.get(job.type)
+                if pending and job in pending:
+                    pending.remove(job)
+                    job.status = CANCELLED
+                    job.finished = time.time()
+                    job._done.set()
+        return True
+
+    def position(self, job):
+        """1-based place of a queued job in the order jobs will start; 0 once it started
+
+        Counts the jobs of its type ahead of it in the tenants' turns, and
+        those of other types with higher (or equal and older) priority that
+        could still start before their type reaches its limit. Jobs of types
+        held back by their own limit never take this job's worker.
+        """
+        with self._lock:
+            pending = self._pending.get(job.type)
+            if job.status != QUEUED or not pending or job not in pending:
+                return 0
+            priority = self._priority(job.type)
+            ahead = self._order(job.type).index(job)
+            for job_type, others in self._pending.items():
+                if job_type == job.type:
+                    continue
+                room = self._limit(job_type) - self._running.get(job_type, 0)
+                if room <= 0 or self._held(job_type):
+                    continue
+                if self._priority(job_type) < priority:
+                    ahead += min(len(others), room)
+                elif self._priority(job_type) == priority:
+                    ahead += min(sum(1 for other in others if other.id < job.id), room)
+            return 1 + ahead
+
+    def active(self, job_type, tenant=None):
+        """Number of jobs of a type that are running or waiting, optionally only of one tenant"""
+        with self._lock:
+            if tenant is not None:
+                return self._tenant_running.get((job_type, tenant), 0) + sum(
+                    1 for job in self._pending.get(job_type, ()) if job.tenant == tenant
+                )
+            return self._running.get(job_type, 0) + len(self._pending.get(job_type, ()))
+
+    def stats(self):
+        """Running and queued job counts per job type"""
+        with self._lock:
+            types = set(self._running) | set(self._pending)
+            return {
+                job_type: {
+                    'running': self._running.get(job_type, 0),
+                    'queued': len(self._pending.get(job_type, ())),
+                    'limit': self._limit(job_type),
+                }
+                for job_type in sorted(types)
+            }
+
+    def queue_depth(self, job_type=None):
+        """Number of jobs waiting for a free slot"""
+        with self._lock:
+            if job_type is not None:
+                return len(self._pending.get(job_type, ()))
+            return sum(len(pending) for pending in self._pending.values())
+
+    def render(self, fn, *args):
+        """Run a CPU bound, picklable fn(*args) in the render process pool and wait for it"""
+        if self.render_workers <= 0:
+            return fn(*args)
+        with self._lock:
+            if self._render_executor is None:
+                self._render_executor = ProcessPoolExecutor(
+                    max_workers=self.render_workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+        return self._render_executor.submit(fn, *args).result()
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+        if self._render_executor is not None:
+            self._render_executor.shutdown(wait=wait)
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+
+def current_job():
+    """Return the Job running in this worker thread, if any"""
+    return getattr(_local, 'job', None)
+
+job_manager = JobManager()
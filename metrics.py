@@ -0,0 +1,235 @@
+import os
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket bounds in seconds, e.g. "0.05,0.1,0.5,1,5"
+METRICS_BUCKETS = tuple(
+    float(bound) for bound in os.getenv(
+        'METRICS_BUCKETS', '0.01,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120'
+    ).split(',') if bound
+)
+# Stages slower than this many seconds are logged at INFO level
+SLOW_STAGE_SECONDS = float(os.getenv('SLOW_STAGE_SECONDS', 5))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic counter, optionally split by label values"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, _format_labels(self.labels, key), value) for key, value in sorted(values.items())]
+
+class Gauge(Counter):
+    """Value that can go up and down, e.g. the size of the last backup"""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values per label set"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                labels = _format_labels(self.labels, key, [('le', _format_value(bound))])
+                samples.append((f"{self.name}_bucket", labels, count))
+            samples.append((f"{self.name}_sum", _format_labels(self.labels, key), total))
+            samples.append((f"{self.name}_count", _format_labels(self.labels, key), counts[-1]))
+        return samples
+
+class Registry:
+    """Metrics of this process, rendered in the Prometheus text format
+
+    Collectors are callables returning (name, type, help, [(labels dict,
+    value)]) tuples; they are called at scrape time for values other modules
+    already keep, such as pool and cache statistics.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        for collector in self._collectors:
+            try:
+                collected = collector()
+            except Exception as e:
+                logger.warning(f"Metrics collector {getattr(collector, '__name__', collector)} failed: {e}")
+                continue
+            for name, metric_type, help, values in collected:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in values:
+                    names = tuple(labels)
+                    lines.append(f"{name}{_format_labels(names, [labels[key] for key in names])} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+REPORT_STAGE_SECONDS = registry.register(Histogram(
+    'report_stage_seconds', 'Time spent per report type and stage (query, transform, render, upload)',
+    labels=('report', 'stage')
+))
+DB_QUERY_SECONDS = registry.register(Histogram(
+    'db_query_seconds', 'Time spent running SQL queries against MySQL, cache hits excluded'
+))
+BACKUP_SECONDS = registry.register(Histogram(
+    'backup_duration_seconds', 'Backup duration per backup kind', labels=('kind',),
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+))
+BACKUP_BYTES = registry.register(Gauge(
+    'backup_size_bytes', 'Compressed size of the last backup per backup kind', labels=('kind',)
+))
+WEBHOOK_UPDATES = registry.register(Counter(
+    'webhook_updates_total', 'Telegram updates received on the webhook'
+))
+ERRORS = registry.register(Counter(
+    'errors_total', 'Errors per component', labels=('component',)
+))
+
+# Tracing: an id shared by all log lines and stages of one update
+_trace_id = contextvars.ContextVar('trace_id', default='-')
+
+def start_trace(trace_id=None):
+    """Start a trace in the current context and return its id"""
+    trace_id = str(trace_id or uuid.uuid4().hex[:12])
+    _trace_id.set(trace_id)
+    return trace_id
+
+def get_trace_id():
+    """Id of the trace of the current context, or '-' outside of one"""
+    return _trace_id.get()
+
+class TraceFilter(logging.Filter):
+    """Adds the current trace id to log records as %(trace_id)s"""
+
+    def filter(self, record):
+        record.trace_id = _trace_id.get()
+        return True
+
+def install_log_tracing(logger=None):
+    """Add the trace id to every record handled by a logger's handlers (the root logger by default)"""
+    for handler in (logger or logging.getLogger()).handlers:
+        handler.addFilter(TraceFilter())
+
+@contextmanager
+def stage(report, name):
+    """Time a stage of building a report into report_stage_seconds"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        REPORT_STAGE_SECONDS.observe(elapsed, report=report, stage=name)
+        level = logging.INFO if elapsed >= SLOW_STAGE_SECONDS else logging.DEBUG
+        logger.log(level, f"{report} {name} took {elapsed:.3f}s")
+
+def record_backup(kind, seconds, size):
+    """Record the duration and compressed size of a finished backup"""
+    BACKUP_SECONDS.observe(seconds, kind=kind)
+    BACKUP_BYTES.set(size, kind=kind)
+
+def stats_collector(prefix, stats, help=''):
+    """Collector exposing the numeric values of a stats() dict as <prefix>_<key> gauges"""
+    def collect():
+        return [
+            (f"{prefix}_{key}", 'gauge', f"{help} {key}".strip(), [({}, value)])
+            for key, value in stats().items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        ]
+    collect.__name__ = f"{prefix}_collector"
+    return collect
+
+def tenant_stats_collector(prefix, stats, help=''):
+    """Collector like stats_collector for a stats() returning {tenant id: stats dict}, labeled by tenant"""
+    def collect():
+        samples = {}
+        for tenant, values in stats().items():
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    samples.setdefault(key, []).append(({'tenant': tenant}, value))
+        return [(f"{prefix}_{key}", 'gauge', f"{help} {key}".strip(), values) for key, values in samples.items()]
+    collect.__name__ = f"{prefix}_collector"
+    return collect
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    return registry.render()
@@ -0,0 +1,177 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from cache import normalize_query
+from tenants import TenantLocal
+
+# Load environment variables
+load_dotenv()
+
+# Opt-in: record timings, rows examined and EXPLAIN plans of executed queries
+DB_PROFILE = os.getenv('DB_PROFILE', 'false').lower() in ('1', 'true', 'yes')
+# Distinct query shapes kept; the least recently run are dropped
+PROFILE_MAX_QUERIES = int(os.getenv('PROFILE_MAX_QUERIES', 200))
+# Seconds an EXPLAIN plan is reused before the query shape is explained again
+PROFILE_PLAN_INTERVAL = float(os.getenv('PROFILE_PLAN_INTERVAL', 600))
+
+_FUNCTION_ON_COLUMN = re.compile(r'\b(YEAR|MONTH|DAY|DATE|QUARTER)\(\s*([\w.]+)\s*\)', re.IGNORECASE)
+_CLAUSE_ENDS = ('GROUP BY', 'ORDER BY', 'LIMIT', 'HAVING')
+
+def _clause(sql, keyword, ends=_CLAUSE_ENDS):
+    """Text of the last top level clause starting with keyword, up to the next clause"""
+    upper = sql.upper()
+    start = upper.rfind(keyword + ' ')
+    if start < 0:
+        return ''
+    start += len(keyword) + 1
+    end = min([index for index in (upper.find(f' {word} ', start) for word in ends) if index >= 0] or [len(sql)])
+    return sql[start:end]
+
+def _columns(clause, table):
+    """Columns of table referenced in a clause, in order of first use"""
+    return list(OrderedDict.fromkeys(re.findall(rf'\b{re.escape(table)}\.(\w+)', clause)))
+
+def _where_columns(where, table):
+    """Columns of table compared for equality only, and those compared by range"""
+    ranged = set(re.findall(
+        rf'\b{re.escape(table)}\.(\w+)\s*(?:<|>|!=|BETWEEN\b|IN\b|LIKE\b)', where, re.IGNORECASE
+    ))
+    columns = _columns(where, table)
+    return [column for column in columns if column not in ranged], [column for column in columns if column in ranged]
+
+def _join_condition(sql, table):
+    match = re.search(
+        rf'JOIN {re.escape(table)} ON (.+?)(?= (?:LEFT |RIGHT |INNER )?JOIN | WHERE | GROUP BY | ORDER BY | LIMIT |$)',
+        sql, re.IGNORECASE
+    )
+    return match.group(1) if match else ''
+
+def _index_statement(table, columns):
+    name = f"idx_{table}_{'_'.join(columns)}"[:64]
+    return f"CREATE INDEX {name} ON {table} ({', '.join(columns)});"
+
+def plan_flags(plan):
+    """Problems visible in an EXPLAIN plan: full scans, filesorts and temporary tables"""
+    flags = []
+    for row in plan:
+        extra = row.get('Extra') or ''
+        if row.get('type') == 'ALL':
+            flags.append(f"full scan of {row.get('table')} (~{row.get('rows')} rows)")
+        if 'Using filesort' in extra:
+            flags.append(f"filesort on {row.get('table')}")
+        if 'Using temporary' in extra:
+            flags.append(f"temporary table for {row.get('table')}")
+    return flags
+
+def recommend(query, plan):
+    """Index and rewrite suggestions for a query from its text and EXPLAIN plan"""
+    sql = normalize_query(query)
+    where = _clause(sql, 'WHERE')
+    order = _clause(sql, 'ORDER BY', ('LIMIT',))
+    group = _clause(sql, 'GROUP BY', ('ORDER BY', 'LIMIT', 'HAVING'))
+    suggestions = []
+
+    for position, row in enumerate(plan):
+        table = row.get('table')
+        if not table or table.startswith('<'):
+            continue
+        filesort = 'Using filesort' in (row.get('Extra') or '')
+        if row.get('type') != 'ALL' and not filesort:
+            continue
+
+        if position > 0:
+            # A joined table read in full for every row: its join column isn't indexed
+            columns = _columns(_join_condition(sql, table), table)
+        else:
+            # Equality filters first, then the sort order (so MySQL can stop after
+            # LIMIT rows) or else the first range filter; sorting on YEAR(date)
+            # and the like can't be served by an index
+            equal, ranged = _where_columns(where, table)
+            if filesort and not _FUNCTION_ON_COLUMN.search(order):
+                columns = equal + _columns(order, table)
+            else:
+                columns = equal + ranged[:1]
+        columns = list(OrderedDict.fromkeys(columns))[:5]
+        if columns:
+            suggestions.append(_index_statement(table, columns))
+
+    for function, column in _FUNCTION_ON_COLUMN.findall(where):
+        suggestions.append(
+            f"WHERE {function.upper()}({column}) can't use an index on {column}; "
+            f"compare {column} with a date range instead: {column} >= %s AND {column} < %s"
+        )
+    if plan and plan[0].get('type') == 'ALL' and _FUNCTION_ON_COLUMN.search(group):
+        suggestions.append(
+            f"GROUP BY on {', '.join(sorted({column for _, column in _FUNCTION_ON_COLUMN.findall(group)}))} "
+            "reads every row; serve it from the monthly rollups (USE_AGGREGATES=true) "
+            "or limit it with a date range on the raw column"
+        )
+
+    # Same suggestion from several plan rows only once
+    return list(OrderedDict.fromkeys(suggestions))
+
+class QueryProfiler:
+    """Timings, rows examined and plans of executed queries, per query shape
+
+    Queries are grouped by their normalized SQL, so the pages of a keyset
+    export or the same report run with different filters add up under one
+    entry.
+    """
+
+    def __init__(self, enabled=DB_PROFILE, max_queries=PROFILE_MAX_QUERIES,
+                 plan_interval=PROFILE_PLAN_INTERVAL):
+        self.enabled = enabled
+        self.max_queries = max_queries
+        self.plan_interval = plan_interval
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def needs_plan(self, query):
+        """True if the query shape has no EXPLAIN plan yet, or an old one"""
+        with self._lock:
+            profile = self._profiles.get(normalize_query(query))
+        return profile is None or time.monotonic() - profile['planned'] > self.plan_interval
+
+    def record(self, query, seconds, rows, examined=None, plan=None):
+        """Add one execution of a query"""
+        shape = normalize_query(query)
+        with self._lock:
+            profile = self._profiles.get(shape)
+            if profile is None:
+                profile = self._profiles[shape] = {
+                    'query': shape, 'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                    'rows': 0, 'examined': 0, 'plan': None, 'planned': float('-inf'),
+                }
+            self._profiles.move_to_end(shape)
+            profile['count'] += 1
+            profile['seconds'] += seconds
+            profile['max_seconds'] = max(profile['max_seconds'], seconds)
+            profile['rows'] += rows
+            profile['examined'] += examined or 0
+            if plan is not None:
+                profile['plan'] = plan
+                profile['planned'] = time.monotonic()
+            while len(self._profiles) > self.max_queries:
+                self._profiles.popitem(last=False)
+
+    def profiles(self, limit=None):
+        """Recorded query shapes, the most total time first, with flags and suggestions"""
+        with self._lock:
+            profiles = [dict(profile) for profile in self._profiles.values()]
+        profiles.sort(key=lambda profile: profile['seconds'], reverse=True)
+        for profile in profiles[:limit]:
+            plan = profile['plan'] or []
+            profile['avg_seconds'] = profile['seconds'] / profile['count']
+            profile['flags'] = plan_flags(plan)
+            profile['suggestions'] = recommend(profile['query'], plan)
+        return profiles[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+
+# Each CRM's queries are profiled apart, so /diagnose never shows another tenant's queries
+profiler = TenantLocal(lambda tenant: QueryProfiler())
@@ -1,64 +1,163 @@
 import os
 import time
-import pandas as pd
-import matplotlib.pyplot as plt
-from database import execute_query, get_sqlalchemy_engine
+import hashlib
+import datetime
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from database import DB_POOL_SIZE, execute_query
+from cache import report_ttl
+from aggregates import USE_AGGREGATES, get_sales_rollup, get_payments_rollup
+from jobs import job_manager
+from singleflight import SingleFlight, coalesce
+from metrics import stage
+from storage import atomic_path, report_files
+from tenants import TenantLocal, current_tenant, current_tenant_id
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Reports directory
-REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')
+# Rows fetched per round trip when streaming exports
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 2000))
+# Most recent rows shown by the invoices, estimates and proposals menu reports
+REPORT_ROWS = int(os.getenv('REPORT_ROWS', 100))
+EXCEL_MAX_ROWS = 1048576
+# Reports fetched at the same time by /bundle; each holds a pooled connection while it runs
+BUNDLE_WORKERS = int(os.getenv('BUNDLE_WORKERS', 5))
+# Bundle queries of a tenant, across all running bundles, share this many pooled
+# connections, always leaving one for exports, scheduled and single reports
+BUNDLE_CONNECTIONS = max(1, min(BUNDLE_WORKERS, DB_POOL_SIZE - 1))
+_bundle_slots = TenantLocal(lambda tenant: threading.BoundedSemaphore(BUNDLE_CONNECTIONS))
 
-# Ensure reports directory exists
-os.makedirs(REPORTS_DIR, exist_ok=True)
+# Identical reports requested while one is being built share its file
+_report_flights = SingleFlight()
+
+# (tenant, digest) -> file of recently rendered reports
+RENDERED_FILES = 64
+_rendered = OrderedDict()
+_rendered_lock = threading.Lock()
+
+def get_coalescing_stats():
+    """Return how many report requests were served by an in-flight build"""
+    return _report_flights.stats()
 
 def generate_report_file(data, title, report_type):
-    """Generate a report file in Excel format with charts"""
+    """Generate a report file in Excel format with charts
+
+    data is a list of row dicts, or any iterable of them (e.g. the keyset
+    pages of keyset_rows) for exports too large to hold in memory.
+    """
     timestamp = time.strftime('%Y%m%d-%H%M%S')
-    filename = os.path.join(REPORTS_DIR, f"{report_type}-{timestamp}.xlsx")
-    
-    # Create a Pandas Excel writer
-    writer = pd.ExcelWriter(filename, engine='xlsxwriter')
-    
-    # Convert data to DataFrame
-    df = pd.DataFrame(data)
-    
-    # Write DataFrame to Excel
-    df.to_excel(writer, sheet_name='Report', index=False)
-    
-    # Access the XlsxWriter workbook and worksheet objects
-    workbook = writer.book
-    worksheet = writer.sheets['Report']
-    
+    filename = os.path.join(current_tenant().reports_dir, f"{report_type}-{timestamp}.xlsx")
+
+    if isinstance(data, list):
+        # Writing the workbook is CPU bound, so do it in the render process pool
+        filename = job_manager.render(_write_report_file, data, title, filename)
+    else:
+        # Streamed rows can't be sent to another process, write them as they arrive
+        filename = _write_report_file(data, title, filename)
+    report_files.add(filename)
+    return filename
+
+def report_digest(report_type, data):
+    """Content hash of a report's result set; equal digests render identical files"""
+    digest = hashlib.sha256(report_type.encode('utf-8'))
+    for row in data:
+        digest.update(repr(sorted(row.items())).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def _write_report_file(data, title, filename):
+    """Write report rows to an Excel file with a chart of the total column
+
+    Rows are written one at a time in xlsxwriter's constant_memory mode, so
+    memory use stays flat however many rows the iterable yields.
+    """
+    return _write_workbook([('Report', title, data)], filename)
+
+def _write_bundle_file(sections, filename):
+    """Write several reports into one workbook, given as (sheet name, title, rows)"""
+    return _write_workbook(sections, filename)
+
+def _write_workbook(sections, filename):
+    # Imported here so loading this module (and the bot) doesn't pay for it
+    import xlsxwriter
+
+    # Written under a temporary name, so a half written file is never sent or reused
+    with atomic_path(filename) as partial:
+        workbook = xlsxwriter.Workbook(partial, {'constant_memory': True})
+        formats = {
+            'header': workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}),
+            'date': workbook.add_format({'num_format': 'yyyy-mm-dd'}),
+            'datetime': workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'}),
+        }
+        for sheet_name, title, data in sections:
+            _write_sheet(workbook, formats, sheet_name, title, data)
+
+        # Save the Excel file
+        workbook.close()
+
+    return filename
+
+def _write_sheet(workbook, formats, sheet_name, title, data):
+    """Write rows to a new worksheet (continued on more sheets past Excel's row limit) with a chart"""
+    worksheet = workbook.add_worksheet(sheet_name)
+    sheets = 1
+    columns = None
+    row_number = 0
+    first_sheet_rows = 0
+
+    for row in data:
+        if columns is None:
+            columns = list(row)
+            worksheet.write_row(0, 0, columns, formats['header'])
+        row_number += 1
+
+        # Start a new sheet when Excel's row limit is reached
+        if row_number >= EXCEL_MAX_ROWS:
+            sheets += 1
+            worksheet = workbook.add_worksheet(f'{sheet_name} {sheets}')
+            worksheet.write_row(0, 0, columns, formats['header'])
+            row_number = 1
+        if sheets == 1:
+            first_sheet_rows = row_number
+
+        for column_number, column in enumerate(columns):
+            value = row.get(column)
+            if value is None:
+                continue
+            if isinstance(value, datetime.datetime):
+                worksheet.write_datetime(row_number, column_number, value, formats['datetime'])
+            elif isinstance(value, datetime.date):
+                worksheet.write_datetime(row_number, column_number, value, formats['date'])
+            elif isinstance(value, datetime.timedelta):
+                worksheet.write_string(row_number, column_number, str(value))
+            else:
+                worksheet.write(row_number, column_number, value)
+
     # Create a chart object
-    if len(data) > 0 and 'total' in df.columns:
+    if first_sheet_rows > 0 and 'total' in columns:
         chart = workbook.add_chart({'type': 'column'})
-        
-        # Configure the series of the chart from the dataframe data
+        total_column = columns.index('total')
+
+        # Configure the series of the chart from the first sheet's data
         chart.add_series({
             'name': 'Total',
-            'categories': ['Report', 1, 0, len(df), 0],
-            'values': ['Report', 1, df.columns.get_loc('total'), len(df), df.columns.get_loc('total')],
+            'categories': [sheet_name, 1, 0, first_sheet_rows, 0],
+            'values': [sheet_name, 1, total_column, first_sheet_rows, total_column],
         })
-        
+
         # Configure the chart
         chart.set_title({'name': title})
         chart.set_x_axis({'name': 'Items'})
         chart.set_y_axis({'name': 'Amount'})
-        
-        # Insert the chart into the worksheet
-        worksheet.insert_chart('H2', chart)
-    
-    # Save the Excel file
-    writer.save()
-    
-    return filename
 
-def get_sales_report():
-    """Generate sales report from Perfex CRM database"""
-    query = """
+        # Insert the chart into the first worksheet
+        workbook.get_worksheet_by_name(sheet_name).insert_chart('H2', chart)
+
+SALES_QUERY = """
     SELECT 
         YEAR(date) as year,
         MONTH(date) as month,
@@ -69,20 +168,31 @@ def get_sales_report():
     GROUP BY YEAR(date), MONTH(date)
     ORDER BY YEAR(date) DESC, MONTH(date) DESC
     LIMIT 24; -- Last 24 months
-    """
-    
-    data = execute_query(query)
+"""
+
+@coalesce(_report_flights, 'sales')
+def get_sales_data():
+    """Fetch sales report rows from Perfex CRM database"""
+    with stage('sales', 'query'):
+        if USE_AGGREGATES:
+            # Read the incrementally maintained monthly rollup instead of scanning tblinvoices
+            data = get_sales_rollup(24)
+        else:
+            data = execute_query(
+                SALES_QUERY,
+                cache_ttl=report_ttl('sales'),
+                watermark_tables=('tblinvoices', 'tblinvoicepaymentrecords')
+            )
     
     # Add month name
-    for row in data:
-        row['month_name'] = time.strftime('%B', time.strptime(str(row['month']), '%m'))
-        row['period'] = f"{row['month_name']} {row['year']}"
+    with stage('sales', 'transform'):
+        for row in data:
+            row['month_name'] = time.strftime('%B', time.strptime(str(row['month']), '%m'))
+            row['period'] = f"{row['month_name']} {row['year']}"
     
-    return generate_report_file(data, 'Sales Report', 'sales')
+    return data
 
-def get_payments_report():
-    """Generate payments report from Perfex CRM database"""
-    query = """
+PAYMENTS_QUERY = """
     SELECT 
         YEAR(tblinvoicepaymentrecords.date) as year,
         MONTH(tblinvoicepaymentrecords.date) as month,
@@ -94,20 +204,30 @@ def get_payments_report():
     GROUP BY YEAR(tblinvoicepaymentrecords.date), MONTH(tblinvoicepaymentrecords.date), tblpaymentmodes.name
     ORDER BY YEAR(tblinvoicepaymentrecords.date) DESC, MONTH(tblinvoicepaymentrecords.date) DESC
     LIMIT 100;
-    """
-    
-    data = execute_query(query)
+"""
+
+@coalesce(_report_flights, 'payments')
+def get_payments_data():
+    """Fetch payments report rows from Perfex CRM database"""
+    with stage('payments', 'query'):
+        if USE_AGGREGATES:
+            data = get_payments_rollup(100)
+        else:
+            data = execute_query(
+                PAYMENTS_QUERY,
+                cache_ttl=report_ttl('payments'),
+                watermark_tables=('tblinvoicepaymentrecords',)
+            )
     
     # Add month name
-    for row in data:
-        row['month_name'] = time.strftime('%B', time.strptime(str(row['month']), '%m'))
-        row['period'] = f"{row['month_name']} {row['year']}"
+    with stage('payments', 'transform'):
+        for row in data:
+            row['month_name'] = time.strftime('%B', time.strptime(str(row['month']), '%m'))
+            row['period'] = f"{row['month_name']} {row['year']}"
     
-    return generate_report_file(data, 'Payments Report', 'payments')
+    return data
 
-def get_invoices_report():
-    """Generate invoices report from Perfex CRM database"""
-    query = """
+INVOICES_SELECT = """
     SELECT 
         tblinvoices.id,
         tblinvoices.number,
@@ -127,17 +247,9 @@ def get_invoices_report():
         END as status_text
     FROM tblinvoices
     LEFT JOIN tblclients ON tblclients.userid = tblinvoices.clientid
-    ORDER BY tblinvoices.date DESC
-    LIMIT 100;
-    """
-    
-    data = execute_query(query)
-    
-    return generate_report_file(data, 'Invoices Report', 'invoices')
+"""
 
-def get_estimates_report():
-    """Generate estimates report from Perfex CRM database"""
-    query = """
+ESTIMATES_SELECT = """
     SELECT 
         tblestimates.id,
         tblestimates.number,
@@ -157,17 +269,9 @@ def get_estimates_report():
         END as status_text
     FROM tblestimates
     LEFT JOIN tblclients ON tblclients.userid = tblestimates.clientid
-    ORDER BY tblestimates.date DESC
-    LIMIT 100;
-    """
-    
-    data = execute_query(query)
-    
-    return generate_report_file(data, 'Estimates Report', 'estimates')
+"""
 
-def get_proposals_report():
-    """Generate proposals report from Perfex CRM database"""
-    query = """
+PROPOSALS_SELECT = """
     SELECT 
         tblproposals.id,
         tblproposals.subject,
@@ -187,10 +291,329 @@ def get_proposals_report():
         END as status_text
     FROM tblproposals
     LEFT JOIN tblclients ON tblclients.userid = tblproposals.rel_id AND tblproposals.rel_type = 'customer'
-    ORDER BY tblproposals.datecreated DESC
-    LIMIT 100;
+"""
+
+PAYMENTS_SELECT = """
+    SELECT 
+        tblinvoicepaymentrecords.id,
+        tblinvoicepaymentrecords.date,
+        tblinvoicepaymentrecords.amount as total,
+        tblpaymentmodes.name as payment_mode,
+        tblinvoicepaymentrecords.transactionid,
+        tblinvoices.number as invoice_number,
+        tblclients.company as client_name
+    FROM tblinvoicepaymentrecords
+    LEFT JOIN tblpaymentmodes ON tblpaymentmodes.id = tblinvoicepaymentrecords.paymentmode
+    LEFT JOIN tblinvoices ON tblinvoices.id = tblinvoicepaymentrecords.invoiceid
+    LEFT JOIN tblclients ON tblclients.userid = tblinvoices.clientid
+"""
+
+# Export type -> how to page through it: base query, keyset and filter columns
+EXPORTS = {
+    'invoices': {
+        'select': INVOICES_SELECT,
+        'date': 'tblinvoices.date',
+        'id': 'tblinvoices.id',
+        'client': 'tblinvoices.clientid',
+        'status': 'tblinvoices.status',
+        'statuses': {'unpaid': 1, 'paid': 2, 'partially_paid': 3, 'overdue': 4, 'cancelled': 5},
+        'watermark_tables': ('tblinvoices', 'tblinvoicepaymentrecords'),
+        'title': 'Invoices Export',
+    },
+    'payments': {
+        'select': PAYMENTS_SELECT,
+        'date': 'tblinvoicepaymentrecords.date',
+        'id': 'tblinvoicepaymentrecords.id',
+        'client': 'tblinvoices.clientid',
+        'status': None,
+        'statuses': {},
+        'watermark_tables': ('tblinvoicepaymentrecords',),
+        'title': 'Payments Export',
+    },
+    'estimates': {
+        'select': ESTIMATES_SELECT,
+        'date': 'tblestimates.date',
+        'id': 'tblestimates.id',
+        'client': 'tblestimates.clientid',
+        'status': 'tblestimates.status',
+        'statuses': {'draft': 1, 'sent': 2, 'declined': 3, 'accepted': 4, 'expired': 5},
+        'watermark_tables': ('tblestimates',),
+        'title': 'Estimates Export',
+    },
+    'proposals': {
+        'select': PROPOSALS_SELECT,
+        'date': 'tblproposals.datecreated',
+        'id': 'tblproposals.id',
+        'client': "tblproposals.rel_type = 'customer' AND tblproposals.rel_id",
+        'status': 'tblproposals.status',
+        'statuses': {'draft': 0, 'open': 1, 'declined': 2, 'accepted': 3, 'sent': 4},
+        'watermark_tables': ('tblproposals',),
+        'title': 'Proposals Export',
+    },
+}
+
+def parse_status(export_type, status):
+    """Status code from a number or a name such as 'paid' or 'partially paid'"""
+    statuses = EXPORTS[export_type]['statuses']
+    if not statuses:
+        raise Exception(f"{export_type} can't be filtered by status")
+    if str(status).isdigit() and int(status) in statuses.values():
+        return int(status)
+    name = str(status).strip().lower().replace(' ', '_').replace('-', '_')
+    if name not in statuses:
+        raise Exception(f"Unknown {export_type} status: {status} (one of {', '.join(statuses)})")
+    return statuses[name]
+
+def keyset_rows(export_type, date_from=None, date_to=None, client=None, status=None,
+                max_rows=None, batch_size=EXPORT_BATCH_SIZE, progress=None, cache_ttl=None):
+    """Yield rows newest first, one page at a time, using keyset pagination on (date, id)
+
+    Each page continues after the last (date, id) seen instead of using
+    OFFSET, so every page costs the same however deep the export goes.
+    date_from and date_to are inclusive dates (datetime.date or YYYY-MM-DD).
+    progress(rows, last_date) is called after every page.
     """
-    
-    data = execute_query(query)
-    
-    return generate_report_file(data, 'Proposals Report', 'proposals') 
\ No newline at end of file
+    definition = EXPORTS[export_type]
+    date_column = definition['date']
+    conditions = []
+    params = []
+
+    # Plain range comparisons on the raw column, so an index on it can be used
+    if date_from:
+        conditions.append(f"{date_column} >= %s")
+        params.append(_parse_date(date_from))
+    if date_to:
+        conditions.append(f"{date_column} < %s")
+        params.append(_parse_date(date_to) + datetime.timedelta(days=1))
+    if client is not None:
+        conditions.append(f"{definition['client']} = %s")
+        params.append(int(client))
+    if status is not None:
+        conditions.append(f"{definition['status']} = %s")
+        params.append(parse_status(export_type, status))
+
+    last = None
+    fetched = 0
+    while max_rows is None or fetched < max_rows:
+        limit = batch_size if max_rows is None else min(batch_size, max_rows - fetched)
+        query, page_params = _page_query(definition, conditions, params, last, limit)
+
+        rows = execute_query(
+            query, page_params,
+            cache_ttl=cache_ttl,
+            watermark_tables=definition['watermark_tables']
+        )
+        if not rows:
+            break
+        yield from rows
+        fetched += len(rows)
+
+        date_key = date_column.split('.')[-1]
+        last = (rows[-1][date_key], rows[-1]['id'])
+        if progress:
+            progress(fetched, last[0])
+        if len(rows) < limit:
+            break
+
+def _page_query(definition, conditions, params, last, limit):
+    """Query and parameters of the page after the (date, id) key last"""
+    date_column, id_column = definition['date'], definition['id']
+    conditions = list(conditions)
+    params = list(params)
+    if last is not None:
+        conditions.append(f"({date_column} < %s OR ({date_column} = %s AND {id_column} < %s))")
+        params.extend([last[0], last[0], last[1]])
+
+    query = definition['select']
+    if conditions:
+        query += "    WHERE " + " AND ".join(conditions) + "\n"
+    query += f"    ORDER BY {date_column} DESC, {id_column} DESC\n    LIMIT %s"
+    params.append(limit)
+    return query, params
+
+def report_queries():
+    """Representative (name, query, params) of every report and export, for diagnosing indexes
+
+    Covers the sales and payments queries against the source tables and,
+    per export, a filtered later page of the keyset pagination.
+    """
+    queries = [('sales', SALES_QUERY, None), ('payments', PAYMENTS_QUERY, None)]
+    today = datetime.date.today()
+    for export_type, definition in EXPORTS.items():
+        conditions = [f"{definition['date']} >= %s", f"{definition['client']} = %s"]
+        params = [today - datetime.timedelta(days=365), 1]
+        if definition['status']:
+            conditions.append(f"{definition['status']} = %s")
+            params.append(min(definition['statuses'].values()))
+        query, params = _page_query(definition, conditions, params, (today, 1), EXPORT_BATCH_SIZE)
+        queries.append((f"{export_type} export", query, params))
+    return queries
+
+def _parse_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(str(value), '%Y-%m-%d').date()
+
+@coalesce(_report_flights, 'invoices')
+def get_invoices_data():
+    """Fetch invoices report rows from Perfex CRM database"""
+    with stage('invoices', 'query'):
+        return list(keyset_rows('invoices', max_rows=REPORT_ROWS, cache_ttl=report_ttl('invoices')))
+
+@coalesce(_report_flights, 'estimates')
+def get_estimates_data():
+    """Fetch estimates report rows from Perfex CRM database"""
+    with stage('estimates', 'query'):
+        return list(keyset_rows('estimates', max_rows=REPORT_ROWS, cache_ttl=report_ttl('estimates')))
+
+@coalesce(_report_flights, 'proposals')
+def get_proposals_data():
+    """Fetch proposals report rows from Perfex CRM database"""
+    with stage('proposals', 'query'):
+        return list(keyset_rows('proposals', max_rows=REPORT_ROWS, cache_ttl=report_ttl('proposals')))
+
+# Report type -> (data function, report title)
+REPORTS = {
+    'sales': (get_sales_data, 'Sales Report'),
+    'payments': (get_payments_data, 'Payments Report'),
+    'invoices': (get_invoices_data, 'Invoices Report'),
+    'estimates': (get_estimates_data, 'Estimates Report'),
+    'proposals': (get_proposals_data, 'Proposals Report'),
+}
+
+def get_report_data(report_type):
+    """Fetch the rows of a report by its type"""
+    fetch, _ = REPORTS[report_type]
+    return fetch()
+
+def render_report(report_type, data, digest=None):
+    """Write report rows to a file; renders of the same data share one file
+
+    Files rendered earlier (e.g. pre-built by the scheduler) are reused while
+    they still exist.
+    """
+    _, title = REPORTS[report_type]
+    digest = digest or report_digest(report_type, data)
+    key = (current_tenant_id(), digest)
+    with _rendered_lock:
+        filename = _rendered.get(key)
+        if filename and os.path.exists(filename):
+            _rendered.move_to_end(key)
+            report_files.touch(filename)
+            return filename
+
+    with stage(report_type, 'render'):
+        filename = _report_flights.do(('render', report_type, digest), generate_report_file, data, title, report_type)
+    with _rendered_lock:
+        _rendered[key] = filename
+        while len(_rendered) > RENDERED_FILES:
+            _rendered.popitem(last=False)
+    return filename
+
+def get_bundle_data(report_types=None):
+    """Fetch the rows of several reports at once, as {report type: rows}
+
+    Each report's queries run in their own thread on a pooled connection,
+    so the wait is about that of the slowest report instead of the sum.
+    All bundles of a tenant together use at most BUNDLE_CONNECTIONS of its
+    pool; a second bundle waits for a slot instead of for a connection.
+    """
+    report_types = list(report_types or REPORTS)
+    slots = _bundle_slots.get()
+
+    def fetch(report_type):
+        with slots:
+            return get_report_data(report_type)
+
+    with ThreadPoolExecutor(max_workers=min(len(report_types), BUNDLE_CONNECTIONS)) as executor:
+        # Each thread runs in a copy of this context, keeping the trace id
+        futures = {
+            report_type: executor.submit(contextvars.copy_context().run, fetch, report_type)
+            for report_type in report_types
+        }
+        return {report_type: future.result() for report_type, future in futures.items()}
+
+def bundle_digest(datasets):
+    """Content hash of a bundle; equal digests render identical workbooks"""
+    digest = hashlib.sha256(b'bundle')
+    for report_type, data in datasets.items():
+        digest.update(report_digest(report_type, data).encode('ascii'))
+    return digest.hexdigest()
+
+def render_bundle(datasets, digest=None):
+    """Write several reports into one workbook, one sheet and chart per report"""
+    digest = digest or bundle_digest(datasets)
+    key = (current_tenant_id(), digest)
+    with _rendered_lock:
+        filename = _rendered.get(key)
+        if filename and os.path.exists(filename):
+            _rendered.move_to_end(key)
+            report_files.touch(filename)
+            return filename
+
+    sections = [
+        (report_type.capitalize(), REPORTS[report_type][1], data)
+        for report_type, data in datasets.items()
+    ]
+    timestamp = time.strftime('%Y%m%d-%H%M%S')
+    filename = os.path.join(current_tenant().reports_dir, f"bundle-{timestamp}.xlsx")
+    with stage('bundle', 'render'):
+        filename = _report_flights.do(
+            ('render', 'bundle', digest), job_manager.render, _write_bundle_file, sections, filename
+        )
+    report_files.add(filename)
+    with _rendered_lock:
+        _rendered[key] = filename
+        while len(_rendered) > RENDERED_FILES:
+            _rendered.popitem(last=False)
+    return filename
+
+def get_sales_report():
+    """Generate sales report from Perfex CRM database"""
+    return render_report('sales', get_sales_data())
+
+def get_payments_report():
+    """Generate payments report from Perfex CRM database"""
+    return render_report('payments', get_payments_data())
+
+def get_invoices_report():
+    """Generate invoices report from Perfex CRM database"""
+    return render_report('invoices', get_invoices_data())
+
+def get_estimates_report():
+    """Generate estimates report from Perfex CRM database"""
+    return render_report('estimates', get_estimates_data())
+
+def get_proposals_report():
+    """Generate proposals report from Perfex CRM database"""
+    return render_report('proposals', get_proposals_data())
+
+# Trend -> title shown in year-over-year and trend reports
+TREND_TITLES = {'sales': 'Sales', 'payments': 'Payments'}
+
+def get_yoy_report(trend, year=None):
+    """Generate a year-over-year report from the monthly snapshots"""
+    from snapshots import get_yoy_data
+    year = year or datetime.date.today().year
+    with stage(f"{trend}_yoy", 'query'):
+        data = get_yoy_data(trend, year)
+    with stage(f"{trend}_yoy", 'render'):
+        return generate_report_file(data, f"{TREND_TITLES[trend]} {year} vs {year - 1}", f"{trend}-yoy-{year}")
+
+def get_trend_report(trend, months=36):
+    """Generate a monthly trend report from the monthly snapshots"""
+    from snapshots import get_trend_data
+    with stage(f"{trend}_trend", 'query'):
+        data = get_trend_data(trend, months)
+    with stage(f"{trend}_trend", 'render'):
+        return generate_report_file(data, f"{TREND_TITLES[trend]} trend", f"{trend}-trend")
+
+def export_report(export_type, date_from=None, date_to=None, client=None, status=None, progress=None):
+    """Export all matching rows, streamed page by page into the report file"""
+    rows = keyset_rows(
+        export_type, date_from=date_from, date_to=date_to, client=client, status=status,
+        progress=progress
+    )
+    # Pages are fetched while the file is written, so the export is timed as one stage
+    with stage(f"{export_type}_export", 'render'):
+        return generate_report_file(rows, EXPORTS[export_type]['title'], f"{export_type}-export")
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from dotenv import load_dotenv
+from jobs import job_manager
+from tenants import TenantLocal, all_tenants, use_tenant
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Scheduler configuration
+SCHEDULED_REPORTS = [
+    name.strip() for name in os.getenv('SCHEDULED_REPORTS', 'sales,payments,invoices').split(',') if name.strip()
+]
+# Local times to pre-build at, e.g. "06:30,13:00" (off-peak and before working hours)
+SCHEDULE_TIMES = [
+    value.strip() for value in os.getenv('SCHEDULE_TIMES', '06:30').split(',') if value.strip()
+]
+SCHEDULE_PUSH = os.getenv('SCHEDULE_PUSH', 'false').lower() in ('1', 'true', 'yes')
+
+REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')
+SUBSCRIBERS_FILE = os.getenv('SUBSCRIBERS_FILE', os.path.join(REPORTS_DIR, 'subscribers.json'))
+
+class Subscribers:
+    """Chat ids that receive scheduled reports, persisted as JSON"""
+
+    def __init__(self, path=SUBSCRIBERS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._chats = None
+
+    def _load(self):
+        # Called with the lock held
+        if self._chats is None:
+            try:
+                with open(self.path, encoding='utf-8') as file:
+                    self._chats = set(json.load(file))
+            except FileNotFoundError:
+                self._chats = set()
+        return self._chats
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{self.path}.tmp", 'w', encoding='utf-8') as file:
+            json.dump(sorted(self._chats), file)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def add(self, chat_id):
+        with self._lock:
+            self._load().add(chat_id)
+            self._save()
+
+    def remove(self, chat_id):
+        with self._lock:
+            self._load().discard(chat_id)
+            self._save()
+
+    def __contains__(self, chat_id):
+        with self._lock:
+            return chat_id in self._load()
+
+    def list(self):
+        with self._lock:
+            return sorted(self._load())
+
+subscribers = TenantLocal(lambda tenant: Subscribers(tenant.path('subscribers.json', SUBSCRIBERS_FILE)))
+
+def build_scheduled_report(report_type, push=None):
+    """Scheduled job: warm the caches and pre-render one report, then optionally push it
+
+    push(report_type, data, digest) is called with the fresh result so it
+    can be sent to subscribers. The job manager holds scheduled jobs back
+    while interactive reports run, so this starts right away.
+    """
+    from reports import get_report_data, render_report, report_digest
+
+    started = time.monotonic()
+    data = get_report_data(report_type)
+    digest = report_digest(report_type, data)
+    report_file = render_report(report_type, data, digest)
+    logger.info(f"Pre-built {report_type} report in {time.monotonic() - started:.1f}s: {report_file}")
+
+    if push:
+        push(report_type, data, digest)
+    return report_file
+
+def build_snapshots():
+    """Scheduled job: write the Parquet snapshots of the months closed since the last run"""
+    from snapshots import update_snapshots
+
+    return update_snapshots()
+
+class Scheduler:
+    """Background thread submitting scheduled report builds (and snapshot updates) at the configured times"""
+
+    def __init__(self, reports=SCHEDULED_REPORTS, times=SCHEDULE_TIMES, push=None):
+        self.reports = reports
+        self.times = sorted(datetime.datetime.strptime(value, '%H:%M').time() for value in times)
+        self.push = push
+        self._stop = threading.Event()
+        self._thread = None
+
+    def next_run(self, now=None):
+        """Next configured time after now"""
+        now = now or datetime.datetime.now()
+        for day in range(2):
+            date = now.date() + datetime.timedelta(days=day)
+            for at in self.times:
+                candidate = datetime.datetime.combine(date, at)
+                if candidate > now:
+                    return candidate
+        return None
+
+    def run_now(self):
+        """Submit, for every tenant, a build job per scheduled report and one updating the snapshots"""
+        jobs = []
+        for tenant in all_tenants():
+            # Jobs run as the tenant they were submitted for
+            with use_tenant(tenant):
+                jobs += [
+                    job_manager.submit(
+                        'scheduled', build_scheduled_report, report_type, self.push,
+                        description=f'scheduled {report_type}'
+                    )
+                    for report_type in self.reports
+                ]
+                jobs.append(job_manager.submit('scheduled', build_snapshots, description='scheduled snapshots'))
+        return jobs
+
+    def _loop(self):
+        while not self._stop.is_set():
+            next_run = self.next_run()
+            if next_run is None:
+                return
+            delay = (next_run - datetime.datetime.now()).total_seconds()
+            if self._stop.wait(max(delay, 0)):
+                return
+            logger.info(f"Running scheduled reports: {', '.join(self.reports)}")
+            self.run_now()
+
+    def start(self):
+        if self._thread is None and self.times:
+            self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
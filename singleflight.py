@@ -0,0 +1,73 @@
+import threading
+import functools
+from tenants import current_tenant_id
+
+class _Call:
+    """An in-flight computation that other callers can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Deduplicate concurrent calls: callers of the same tenant with the same key share one execution"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'executions': 0, 'coalesced': 0}
+        self._coalesced_by_group = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) unless a call with the same key is in flight, then wait for it"""
+        group = key[0] if isinstance(key, tuple) else key
+        key = (current_tenant_id(), key)
+        with self._lock:
+            self._stats['calls'] += 1
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._stats['coalesced'] += 1
+                self._coalesced_by_group[group] = self._coalesced_by_group.get(group, 0) + 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self._stats['executions'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Return call, execution and coalesced counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+            stats['coalesced_by_group'] = dict(self._coalesced_by_group)
+        return stats
+
+def coalesce(flight, group):
+    """Decorator sharing one execution between identical concurrent calls of fn"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = (group, args, tuple(sorted(kwargs.items())))
+            return flight.do(key, fn, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,380 @@
+import os
+import sys
+import time
+import decimal
+import logging
+import argparse
+import datetime
+import threading
+from dotenv import load_dotenv
+from database import execute_query, stream_query
+from storage import atomic_path
+from tenants import TenantLocal
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Snapshot store configuration
+REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', os.path.join(REPORTS_DIR, 'snapshots'))
+# Days into a month during which the previous month is still open for edits
+SNAPSHOT_GRACE_DAYS = int(os.getenv('SNAPSHOT_GRACE_DAYS', 7))
+# Datasets the scheduler keeps snapshotted; empty disables it
+SNAPSHOT_DATASETS = [
+    name.strip() for name in os.getenv('SNAPSHOT_DATASETS', 'invoices,payments').split(',') if name.strip()
+]
+
+# Dataset -> source table and the columns the reports use, with their Arrow types
+DATASETS = {
+    'invoices': {
+        'table': 'tblinvoices',
+        'columns': [
+            ('id', 'int64'), ('number', 'int64'), ('clientid', 'int64'), ('date', 'date'),
+            ('duedate', 'date'), ('status', 'int16'), ('subtotal', 'money'), ('total_tax', 'money'),
+            ('total', 'money'),
+        ],
+    },
+    'payments': {
+        'table': 'tblinvoicepaymentrecords',
+        'columns': [
+            ('id', 'int64'), ('invoiceid', 'int64'), ('paymentmode', 'string'), ('date', 'date'),
+            ('amount', 'money'),
+        ],
+    },
+}
+
+# Trend -> dataset, summed column and the (column, value) of rows left out
+TRENDS = {
+    'sales': {'dataset': 'invoices', 'amount': 'total', 'exclude': ('status', 5)},  # Not cancelled
+    'payments': {'dataset': 'payments', 'amount': 'amount', 'exclude': None},
+}
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("pyarrow not installed, it is needed for snapshots: pip install pyarrow")
+    return pyarrow
+
+def _arrow_type(pa, name):
+    return {
+        'int16': pa.int16(),
+        'int64': pa.int64(),
+        'date': pa.date32(),
+        'string': pa.string(),
+        'money': pa.decimal128(15, 2),
+    }[name]
+
+def _next_month(month):
+    year, number = month
+    return (year + number // 12, number % 12 + 1)
+
+def _months(first, last):
+    """(year, month) tuples from first to last, inclusive"""
+    month = first
+    while month <= last:
+        yield month
+        month = _next_month(month)
+
+def _month_start(month):
+    return datetime.date(month[0], month[1], 1)
+
+def last_closed_month(today=None):
+    """Newest month that no longer changes: the previous one once the grace days are over"""
+    today = today or datetime.date.today()
+    first_open = today.replace(day=1)
+    if today.day <= SNAPSHOT_GRACE_DAYS:
+        first_open = (first_open - datetime.timedelta(days=1)).replace(day=1)
+    last = first_open - datetime.timedelta(days=1)
+    return (last.year, last.month)
+
+class SnapshotStore:
+    """Append-only monthly Parquet snapshots of the tables the reports read
+
+    Each closed month of a dataset is written once, to
+    <dataset>/month=YYYY-MM/part-<timestamp>.parquet. Rewriting a month
+    (after a late correction) adds a newer part and readers use the newest,
+    so files are never modified in place. Trend and year-over-year totals
+    are computed with Arrow kernels over memory-mapped reads of these files;
+    MySQL is only queried for months that are still open or not written yet.
+    """
+
+    def __init__(self, directory=SNAPSHOT_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # Parts never change, so their totals are kept: (path, trend) -> (count, total)
+        self._totals = {}
+
+    def partitions(self, dataset):
+        """{(year, month): newest part file} of a dataset"""
+        parts = {}
+        try:
+            entries = os.scandir(os.path.join(self.directory, dataset))
+        except FileNotFoundError:
+            return parts
+        with entries:
+            for entry in entries:
+                if not entry.is_dir() or not entry.name.startswith('month='):
+                    continue
+                names = sorted(
+                    name for name in os.listdir(entry.path)
+                    if name.startswith('part-') and name.endswith('.parquet')
+                )
+                if names:
+                    year, month = entry.name[len('month='):].split('-')
+                    parts[(int(year), int(month))] = os.path.join(entry.path, names[-1])
+        return parts
+
+    def write_month(self, dataset, month):
+        """Snapshot one month of a dataset from MySQL with a date range query; returns the file"""
+        definition = DATASETS[dataset]
+        names = [name for name, _ in definition['columns']]
+        rows = execute_query(
+            f"SELECT {', '.join(names)} FROM {definition['table']} WHERE date >= %s AND date < %s",
+            (_month_start(month), _month_start(_next_month(month)))
+        )
+        return self._write_part(dataset, month, rows)
+
+    def _write_part(self, dataset, month, rows):
+        """Write the rows of one month of a dataset as a new part; returns the file"""
+        pa = _pyarrow()
+        definition = DATASETS[dataset]
+        names = [name for name, _ in definition['columns']]
+        schema = pa.schema([(name, _arrow_type(pa, kind)) for name, kind in definition['columns']])
+        table = pa.table(
+            {name: pa.array([row[name] for row in rows], type=schema.field(name).type) for name in names},
+            schema=schema
+        )
+
+        directory = os.path.join(self.directory, dataset, f"month={month[0]:04d}-{month[1]:02d}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{time.strftime('%Y%m%d-%H%M%S')}.parquet")
+        with atomic_path(path) as partial:
+            pa.parquet.write_table(table, partial)
+        return path
+
+    def update(self, dataset, until=None):
+        """Snapshot the closed months of a dataset that have none yet; returns the months written
+
+        The first run backfills from the oldest row; later runs only add the
+        months closed since. The missing months are read in one pass ordered
+        by date and written a month at a time, as there is no date index to
+        serve a query per month.
+        """
+        until = until or last_closed_month()
+        with self._lock:
+            existing = self.partitions(dataset)
+            if existing:
+                first = min(existing)
+            else:
+                oldest = execute_query(f"SELECT MIN(date) AS date FROM {DATASETS[dataset]['table']}")[0]['date']
+                if oldest is None:
+                    return []
+                first = (oldest.year, oldest.month)
+            missing = [month for month in _months(first, until) if month not in existing]
+            if missing:
+                self._write_months(dataset, missing)
+                logger.info(f"Snapshotted {len(missing)} month(s) of {dataset}")
+            return missing
+
+    def _write_months(self, dataset, months):
+        """Write parts for the given months from one streaming query ordered by date"""
+        definition = DATASETS[dataset]
+        names = [name for name, _ in definition['columns']]
+        wanted = set(months)
+        rows = stream_query(
+            f"SELECT {', '.join(names)} FROM {definition['table']} "
+            f"WHERE date >= %s AND date < %s ORDER BY date",
+            (_month_start(months[0]), _month_start(_next_month(months[-1])))
+        )
+        current, batch = None, []
+        for row in rows:
+            month = (row['date'].year, row['date'].month)
+            if month != current:
+                if current in wanted:
+                    self._write_part(dataset, current, batch)
+                    wanted.discard(current)
+                current, batch = month, []
+            if month in wanted:
+                batch.append(row)
+        if current in wanted:
+            self._write_part(dataset, current, batch)
+            wanted.discard(current)
+        # Months without rows still get an (empty) part, so they aren't queried again
+        for month in sorted(wanted):
+            self._write_part(dataset, month, [])
+
+    def _part_totals(self, path, trend):
+        key = (path, trend)
+        if key not in self._totals:
+            pa = _pyarrow()
+            definition = TRENDS[trend]
+            columns = [definition['amount']]
+            if definition['exclude']:
+                columns.append(definition['exclude'][0])
+            table = pa.parquet.read_table(path, columns=columns, memory_map=True)
+            if definition['exclude']:
+                column, value = definition['exclude']
+                table = table.filter(pa.compute.not_equal(table[column], value))
+            total = pa.compute.sum(table[definition['amount']]).as_py()
+            self._totals[key] = (table.num_rows, total or decimal.Decimal(0))
+        return self._totals[key]
+
+    def _live_totals(self, trend, first):
+        """Totals of the months from first on, from MySQL with one grouped query"""
+        definition = TRENDS[trend]
+        dataset = DATASETS[definition['dataset']]
+        conditions = ["date >= %s"]
+        if definition['exclude']:
+            conditions.append(f"{definition['exclude'][0]} != {int(definition['exclude'][1])}")
+        rows = execute_query(
+            f"SELECT YEAR(date) AS year, MONTH(date) AS month, COUNT(*) AS count, "
+            f"SUM({definition['amount']}) AS total FROM {dataset['table']} "
+            f"WHERE {' AND '.join(conditions)} GROUP BY YEAR(date), MONTH(date)",
+            (_month_start(first),)
+        )
+        return {(row['year'], row['month']): (row['count'], row['total'] or decimal.Decimal(0)) for row in rows}
+
+    def monthly_totals(self, trend, first, last):
+        """{(year, month): (count, total)} of a trend from first to last, inclusive
+
+        Closed months come from the snapshots, open months and closed ones
+        not snapshotted yet from one grouped query; months without rows are
+        left out. Missing snapshots are written by the scheduler or the
+        command line, never while a user waits for a report.
+        """
+        dataset = TRENDS[trend]['dataset']
+        closed = last_closed_month()
+        parts = self.partitions(dataset)
+        # Months before the oldest snapshot have no rows
+        start = max(first, min(parts)) if parts else first
+        live_months = [month for month in _months(start, min(last, closed)) if month not in parts]
+        if last > closed:
+            live_months.append(max(first, _next_month(closed)))
+
+        totals = {}
+        for month in _months(first, min(last, closed)):
+            if month in parts:
+                count, total = self._part_totals(parts[month], trend)
+                if count:
+                    totals[month] = (count, total)
+        if live_months:
+            live = self._live_totals(trend, min(live_months))
+            totals.update({
+                month: value for month, value in live.items()
+                if month <= last and (month > closed or month not in parts)
+            })
+        return totals
+
+    def stats(self):
+        """Number and total size of the snapshot files"""
+        stats = {'partitions': 0, 'bytes': 0, 'cached_totals': len(self._totals)}
+        for dataset in DATASETS:
+            for path in self.partitions(dataset).values():
+                stats['partitions'] += 1
+                stats['bytes'] += os.path.getsize(path)
+        return stats
+
+snapshot_store = TenantLocal(lambda tenant: SnapshotStore(tenant.path('snapshots', SNAPSHOT_DIR)))
+
+def get_snapshot_stats():
+    """Snapshot statistics of every tenant that has used them, by tenant id"""
+    return snapshot_store.stats_by_tenant()
+
+def update_snapshots(datasets=None):
+    """Snapshot the newly closed months of every configured dataset; returns {dataset: months}"""
+    return {dataset: snapshot_store.update(dataset) for dataset in (datasets or SNAPSHOT_DATASETS)}
+
+def _month_name(month):
+    return datetime.date(2000, month, 1).strftime('%B')
+
+def _change(current, previous):
+    if not current or not previous:
+        return None
+    return round(float(current / previous - 1) * 100, 1)
+
+def get_yoy_data(trend, year=None):
+    """Month by month totals of a year next to the year before"""
+    today = datetime.date.today()
+    year = year or today.year
+    last = min((year, 12), (today.year, today.month))
+    totals = snapshot_store.monthly_totals(trend, (year - 1, 1), last)
+
+    data = []
+    for month in range(1, 13):
+        count, total = totals.get((year, month), (None, None))
+        previous_count, previous_total = totals.get((year - 1, month), (None, None))
+        if (year, month) > last:
+            count = total = None
+        data.append({
+            'month_name': _month_name(month),
+            'count': count,
+            'total': total,
+            'previous_count': previous_count,
+            'previous_total': previous_total,
+            'change_percent': _change(total, previous_total),
+        })
+    return data
+
+def get_trend_data(trend, months=36):
+    """Monthly totals of the last months, oldest first, with a 12 month moving average
+    and the change against the same month a year earlier"""
+    today = datetime.date.today()
+    last = (today.year, today.month)
+    first = last
+    for _ in range(months + 11):
+        year, month = first
+        first = (year - 1, 12) if month == 1 else (year, month - 1)
+    totals = snapshot_store.monthly_totals(trend, first, last)
+
+    series = [(month, totals.get(month, (0, decimal.Decimal(0)))) for month in _months(first, last)]
+    data = []
+    for index, (month, (count, total)) in enumerate(series):
+        if index < 12:
+            continue
+        window = [value for _, (_, value) in series[index - 11:index + 1]]
+        data.append({
+            'period': f"{_month_name(month[1])} {month[0]}",
+            'count': count,
+            'total': total,
+            'moving_average': (sum(window) / 12).quantize(decimal.Decimal('0.01')),
+            'yoy_change_percent': _change(total, series[index - 12][1][1]),
+        })
+    return data[-months:]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Monthly Parquet snapshots of the report tables')
+    commands = parser.add_subparsers(dest='command', required=True)
+    update = commands.add_parser('update', help='snapshot the closed months that have none yet')
+    update.add_argument('datasets', nargs='*', help=f"default: {','.join(SNAPSHOT_DATASETS)}")
+    rewrite = commands.add_parser('rewrite', help='snapshot a month again, e.g. after a late correction')
+    rewrite.add_argument('dataset', choices=list(DATASETS))
+    rewrite.add_argument('month', help='YYYY-MM')
+    commands.add_parser('list', help='list the snapshotted months')
+    args = parser.parse_args(argv)
+
+    if args.command == 'update':
+        unknown = set(args.datasets) - set(DATASETS)
+        if unknown:
+            parser.error(f"unknown dataset(s): {', '.join(sorted(unknown))}")
+        for dataset, months in update_snapshots(args.datasets).items():
+            print(f"{dataset}: {len(months)} month(s) written")
+    elif args.command == 'rewrite':
+        year, month = args.month.split('-')
+        print(snapshot_store.write_month(args.dataset, (int(year), int(month))))
+    elif args.command == 'list':
+        for dataset in DATASETS:
+            months = sorted(snapshot_store.partitions(dataset))
+            if months:
+                print(f"{dataset}: {len(months)} months, {months[0][0]}-{months[0][1]:02d} "
+                      f"to {months[-1][0]}-{months[-1][1]:02d}")
+            else:
+                print(f"{dataset}: no snapshots")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
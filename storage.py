@@ -0,0 +1,403 @@
+import os
+import re
+import sys
+import time
+import shutil
+import logging
+import argparse
+import datetime
+import threading
+import contextlib
+from dotenv import load_dotenv
+from tenants import TenantLocal, all_tenants
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+
+# Report files, per tenant: total size (MB, 0 = no limit) and days since last use before they're removed
+REPORTS_MAX_MB = float(os.getenv('REPORTS_MAX_MB', 1024))
+REPORTS_MAX_AGE_DAYS = float(os.getenv('REPORTS_MAX_AGE_DAYS', 14))
+# Backups kept: the newest of each of the last N days, ISO weeks and months (0 = no limit)
+BACKUP_KEEP_DAILY = int(os.getenv('BACKUP_KEEP_DAILY', 7))
+BACKUP_KEEP_WEEKLY = int(os.getenv('BACKUP_KEEP_WEEKLY', 4))
+BACKUP_KEEP_MONTHLY = int(os.getenv('BACKUP_KEEP_MONTHLY', 12))
+# Total size of each tenant's backups (MB, 0 = no limit); the oldest go first, the newest is always kept
+BACKUP_MAX_MB = float(os.getenv('BACKUP_MAX_MB', 0))
+
+# Seconds between passes of the background sweeper
+STORAGE_SWEEP_INTERVAL = float(os.getenv('STORAGE_SWEEP_INTERVAL', 300))
+# Directory entries scanned, and files removed, per step; the sweeper pauses between steps
+STORAGE_BATCH = int(os.getenv('STORAGE_BATCH', 200))
+# Files written or used more recently than this many seconds are never removed
+STORAGE_MIN_AGE = float(os.getenv('STORAGE_MIN_AGE', 600))
+
+# Files are written under this suffix and renamed once complete
+PARTIAL_SUFFIX = '.partial'
+# Partial files left behind by a crash are removed after a day
+PARTIAL_MAX_AGE = 86400
+
+REPORT_EXTENSIONS = ('.xlsx',)
+
+_FULL_BACKUP = re.compile(r'^(?P<database>.+)-(?P<created>\d{8}-\d{6})\.sql(?:\.gz|\.zst)?\.\d{3}$')
+_PARALLEL_BACKUP = re.compile(r'^(?P<database>.+)-(?P<created>\d{8}-\d{6})-parallel$')
+_RETIRED_CHAIN = re.compile(r'^(?P<database>.+)-chain-(?P<created>\d{8}-\d{6})$')
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """Path to write a file at; it only appears under path once the block completes
+
+    Readers never see a half written file: a crash or exception leaves at
+    most a <path>.partial file, which the sweeper removes later.
+    """
+    partial = path + PARTIAL_SUFFIX
+    try:
+        yield partial
+        os.replace(partial, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(partial)
+        raise
+
+def _tree_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(OSError):
+                size += os.path.getsize(os.path.join(root, name))
+    return size
+
+def _remove(path):
+    """Delete a file or directory tree; returns the bytes freed (0 if it was already gone)"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            size = _tree_size(path)
+            shutil.rmtree(path)
+        else:
+            size = os.path.getsize(path)
+            os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+def gfs_keep(times, daily=BACKUP_KEEP_DAILY, weekly=BACKUP_KEEP_WEEKLY, monthly=BACKUP_KEEP_MONTHLY):
+    """Grandfather-father-son selection: the newest time of each of the last daily days,
+    weekly ISO weeks and monthly months that have one"""
+    keep = set()
+    periods = (
+        (daily, lambda value: value.date()),
+        (weekly, lambda value: value.isocalendar()[:2]),
+        (monthly, lambda value: (value.year, value.month)),
+    )
+    newest_first = sorted(times, reverse=True)
+    for count, period in periods:
+        seen = set()
+        for value in newest_first:
+            key = period(value)
+            if key in seen:
+                continue
+            if len(seen) >= count:
+                break
+            seen.add(key)
+            keep.add(value)
+    return keep
+
+class ReportFiles:
+    """Generated report files, removed when unused for too long or least recently used first
+
+    A file's modification time is its last use: reusing a rendered file
+    touches it. Only report files (.xlsx) and stale partial files are
+    managed; databases, JSON state and anything else in the directory
+    are left alone.
+    """
+
+    name = 'reports'
+
+    def __init__(self, directory=REPORTS_DIR, max_mb=REPORTS_MAX_MB, max_age_days=REPORTS_MAX_AGE_DAYS,
+                 min_age=STORAGE_MIN_AGE):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age = max_age_days * 86400
+        self.min_age = min_age
+        self.wake = None
+        self._lock = threading.Lock()
+        self._files = {}  # path -> (size, last used)
+        self._partials = []
+
+    def add(self, path):
+        """Account for a newly written file right away; wakes the sweeper when over quota"""
+        with contextlib.suppress(OSError):
+            self._record(path, os.path.getsize(path), time.time())
+        if self.max_bytes and self.stats()['bytes'] > self.max_bytes and self.wake:
+            self.wake()
+
+    def touch(self, path):
+        """Mark a file as used now"""
+        with contextlib.suppress(OSError):
+            os.utime(path)
+            self._record(path, os.path.getsize(path), time.time())
+
+    def _record(self, path, size, used):
+        with self._lock:
+            self._files[path] = (size, used)
+
+    def scan(self):
+        """Re-read the directory, yielding after each entry so the caller can pace it"""
+        seen = {}
+        partials = []
+        with contextlib.suppress(FileNotFoundError), os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    if entry.name.endswith(PARTIAL_SUFFIX):
+                        partials.append((entry.path, entry.stat().st_mtime))
+                    elif entry.name.endswith(REPORT_EXTENSIONS):
+                        stat = entry.stat()
+                        seen[entry.path] = (stat.st_size, stat.st_mtime)
+                yield
+        with self._lock:
+            self._files = seen
+            self._partials = partials
+
+    def expired(self, now=None):
+        """Files to remove: stale partials, files unused for max_age, then the least
+        recently used until the rest fits in max_bytes"""
+        now = now or time.time()
+        with self._lock:
+            files = sorted(self._files.items(), key=lambda item: item[1][1])
+            partials = list(self._partials)
+        remove = [path for path, modified in partials if now - modified > PARTIAL_MAX_AGE]
+        total = sum(size for _, (size, _) in files)
+        for path, (size, used) in files:
+            if now - used < self.min_age:
+                break
+            if (self.max_age and now - used > self.max_age) or (self.max_bytes and total > self.max_bytes):
+                remove.append(path)
+                total -= size
+        return remove
+
+    def remove(self, path):
+        """Delete one expired file; returns the bytes freed"""
+        with self._lock:
+            self._files.pop(path, None)
+        return _remove(path)
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._files), 'bytes': sum(size for size, _ in self._files.values())}
+
+class BackupSets:
+    """Backups rotated grandfather-father-son, per kind and database
+
+    A set is a full backup's volumes, a parallel backup directory or a
+    retired incremental chain. The active chain, rebuilt dumps and
+    anything else in the directory are left alone; a parallel backup
+    without its manifest is still being written, or failed and is removed
+    after a day.
+    """
+
+    name = 'backups'
+
+    def __init__(self, directory=BACKUP_DIR, daily=BACKUP_KEEP_DAILY, weekly=BACKUP_KEEP_WEEKLY,
+                 monthly=BACKUP_KEEP_MONTHLY, max_mb=BACKUP_MAX_MB, min_age=STORAGE_MIN_AGE):
+        self.directory = directory
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.min_age = min_age
+        self.wake = None
+        self._lock = threading.Lock()
+        self._sets = {}  # name -> {'kind', 'database', 'created', 'paths', 'bytes'}
+        self._sizes = {}  # complete directory -> size, as they don't change
+        self._partials = []
+
+    def _add_path(self, sets, kind, match, path, size):
+        key = f"{kind}:{match['database']}-{match['created']}"
+        backup = sets.setdefault(key, {
+            'kind': kind,
+            'database': match['database'],
+            'created': datetime.datetime.strptime(match['created'], '%Y%m%d-%H%M%S'),
+            'paths': [],
+            'bytes': 0,
+        })
+        backup['paths'].append(path)
+        backup['bytes'] += size
+
+    def scan(self):
+        """Re-read the directory, yielding after each entry so the caller can pace it"""
+        sets = {}
+        partials = []
+        with contextlib.suppress(FileNotFoundError), os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    match = _FULL_BACKUP.match(entry.name)
+                    if match:
+                        self._add_path(sets, 'full', match, entry.path, entry.stat().st_size)
+                    elif entry.name.endswith(PARTIAL_SUFFIX):
+                        partials.append((entry.path, entry.stat().st_mtime))
+                elif entry.is_dir(follow_symlinks=False):
+                    match = _PARALLEL_BACKUP.match(entry.name)
+                    kind = 'parallel'
+                    if not match:
+                        match, kind = _RETIRED_CHAIN.match(entry.name), 'chain'
+                    if match and kind == 'parallel' and not os.path.exists(os.path.join(entry.path, 'manifest.json')):
+                        partials.append((entry.path, entry.stat().st_mtime))
+                    elif match:
+                        if entry.path not in self._sizes:
+                            self._sizes[entry.path] = _tree_size(entry.path)
+                        self._add_path(sets, kind, match, entry.path, self._sizes[entry.path])
+                yield
+        with self._lock:
+            self._sets = sets
+            self._partials = partials
+            self._sizes = {path: size for path, size in self._sizes.items() if os.path.exists(path)}
+
+    def expired(self, now=None):
+        """Sets outside the daily/weekly/monthly rotation, then the oldest until the rest
+        fits in max_bytes; the newest set of each kind is always kept"""
+        now = now or time.time()
+        with self._lock:
+            sets = dict(self._sets)
+            partials = list(self._partials)
+        remove = [path for path, modified in partials if now - modified > PARTIAL_MAX_AGE]
+        cutoff = datetime.datetime.fromtimestamp(now - self.min_age)
+
+        groups = {}
+        for key, backup in sets.items():
+            groups.setdefault((backup['kind'], backup['database']), []).append(key)
+        newest = {max(keys, key=lambda key: sets[key]['created']) for keys in groups.values()}
+        expired = []
+        for keys in groups.values():
+            keep = gfs_keep([sets[key]['created'] for key in keys], self.daily, self.weekly, self.monthly)
+            expired += [key for key in keys if sets[key]['created'] not in keep]
+
+        total = sum(backup['bytes'] for backup in sets.values()) - sum(sets[key]['bytes'] for key in expired)
+        if self.max_bytes:
+            for key in sorted(sets, key=lambda key: sets[key]['created']):
+                if total <= self.max_bytes:
+                    break
+                if key not in expired and key not in newest:
+                    expired.append(key)
+                    total -= sets[key]['bytes']
+
+        return remove + [key for key in expired if sets[key]['created'] < cutoff]
+
+    def remove(self, key):
+        """Delete one expired set (or partial path); returns the bytes freed"""
+        with self._lock:
+            backup = self._sets.pop(key, None)
+        paths = backup['paths'] if backup else [key]
+        for path in paths:
+            self._sizes.pop(path, None)
+        return sum(_remove(path) for path in paths)
+
+    def stats(self):
+        with self._lock:
+            return {'sets': len(self._sets), 'bytes': sum(backup['bytes'] for backup in self._sets.values())}
+
+class StorageManager:
+    """Background sweeper keeping the report and backup directories within their quotas
+
+    Each pass re-reads the directories and removes what the stores' policies
+    expire, STORAGE_BATCH entries at a time with a short pause in between, so
+    a large directory never turns into one long blocking sweep. A store that
+    goes over quota wakes the sweeper early.
+    """
+
+    def __init__(self, stores, interval=STORAGE_SWEEP_INTERVAL, batch=STORAGE_BATCH, pause=0.05):
+        self.stores = stores
+        self.interval = interval
+        self.batch = batch
+        self.pause = pause
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._stats = {'passes': 0, 'removed': 0, 'freed_bytes': 0, 'errors': 0}
+        for store in stores:
+            store.wake = self._wake.set
+
+    def _step(self, index):
+        # Pause after every batch of entries; True when stopping
+        return index % self.batch == self.batch - 1 and self._stopping.wait(self.pause)
+
+    def run_pass(self, dry_run=False):
+        """Scan every store and remove what it expires; returns what was (or would be) removed"""
+        removed = []
+        for store in self.stores:
+            for index, _ in enumerate(store.scan()):
+                if self._step(index):
+                    return removed
+            for index, key in enumerate(store.expired()):
+                if dry_run:
+                    removed.append((store.name, key, 0))
+                    continue
+                try:
+                    freed = store.remove(key)
+                except OSError as e:
+                    self._stats['errors'] += 1
+                    logger.warning(f"Removing {key} from {store.name} failed: {e}")
+                    continue
+                removed.append((store.name, key, freed))
+                self._stats['removed'] += 1
+                self._stats['freed_bytes'] += freed
+                logger.info(f"Storage: removed {key} from {store.name} ({freed} bytes)")
+                if self._step(index):
+                    return removed
+        self._stats['passes'] += 1
+        return removed
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.run_pass()
+            except Exception as e:
+                self._stats['errors'] += 1
+                logger.error(f"Storage sweep failed: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='storage', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def stats(self):
+        stats = dict(self._stats)
+        for store in self.stores:
+            # Totals over the tenants' stores of the same kind
+            for key, value in store.stats().items():
+                stats[f"{store.name}_{key}"] = stats.get(f"{store.name}_{key}", 0) + value
+        return stats
+
+# Each tenant's reports and backups have their own quotas
+report_files = TenantLocal(lambda tenant: ReportFiles(tenant.reports_dir))
+backup_sets = TenantLocal(lambda tenant: BackupSets(tenant.backup_dir))
+storage_manager = StorageManager([
+    store for tenant in all_tenants() for store in (report_files.get(tenant), backup_sets.get(tenant))
+])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply every tenant's report and backup retention policies once")
+    parser.add_argument('--dry-run', action='store_true', help='only list what would be removed')
+    args = parser.parse_args(argv)
+
+    stores = [
+        store for tenant in all_tenants()
+        for store in (ReportFiles(tenant.reports_dir), BackupSets(tenant.backup_dir))
+    ]
+    manager = StorageManager(stores, pause=0)
+    for store, key, freed in manager.run_pass(dry_run=args.dry_run):
+        print(f"{store}: {'would remove' if args.dry_run else 'removed'} {key}" + ('' if args.dry_run else f" ({freed} bytes)"))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
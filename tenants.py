@@ -0,0 +1,179 @@
+import os
+import re
+import json
+import threading
+import contextlib
+import contextvars
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# A single Perfex CRM, used when TENANTS_FILE is unset
+DB_HOST = os.getenv('DB_HOST', 'localhost')
+DB_USER = os.getenv('DB_USER')
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+DB_NAME = os.getenv('DB_NAME')
+ADMIN_USER_IDS = [int(id) for id in os.getenv('ADMIN_USER_IDS', '').split(',') if id]
+REPORTS_DIR = os.getenv('REPORTS_DIR', 'reports')
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+
+# JSON file listing several Perfex CRM instances served by one bot, see the README
+TENANTS_FILE = os.getenv('TENANTS_FILE')
+# Tenant used outside of a Telegram update, e.g. by the command line tools
+TENANT = os.getenv('TENANT')
+
+DEFAULT_TENANT = 'default'
+
+_TENANT_ID = re.compile(r'^[A-Za-z0-9_-]+$')
+
+class Tenant:
+    """One Perfex CRM instance: its database, its admins and its own report and backup directories"""
+
+    def __init__(self, tenant_id, host='localhost', user=None, password=None, database=None,
+                 admins=(), reports_dir=REPORTS_DIR, backup_dir=BACKUP_DIR, name=None):
+        self.id = tenant_id
+        self.name = name or tenant_id
+        self.host = host
+        self.user = user
+        self.password = password
+        self.database = database
+        self.admins = [int(user_id) for user_id in admins]
+        self.reports_dir = reports_dir
+        self.backup_dir = backup_dir
+
+    def connection_config(self):
+        """Arguments for mysql.connector.connect()"""
+        return {'host': self.host, 'user': self.user, 'password': self.password, 'database': self.database}
+
+    def path(self, name, default):
+        """Where a state file or directory of this tenant lives: default (its own setting)
+        for the single CRM of the DB_* settings, name inside the tenant's reports directory otherwise"""
+        return default if not TENANTS_FILE else os.path.join(self.reports_dir, name)
+
+def load_tenants(path=TENANTS_FILE):
+    """Tenants by id: those in the JSON file at path, or the one CRM of the DB_* settings"""
+    if not path:
+        return {DEFAULT_TENANT: Tenant(
+            DEFAULT_TENANT, DB_HOST, DB_USER, DB_PASSWORD, DB_NAME, ADMIN_USER_IDS, REPORTS_DIR, BACKUP_DIR
+        )}
+
+    with open(path, encoding='utf-8') as file:
+        config = json.load(file)
+    tenants = {}
+    owners = {}
+    for tenant_id, settings in config.items():
+        if not _TENANT_ID.match(tenant_id):
+            raise Exception(f"Invalid tenant id {tenant_id!r}: use letters, digits, '-' and '_'")
+        password = settings.get('db_password')
+        if settings.get('db_password_env'):
+            password = os.getenv(settings['db_password_env'])
+        tenant = Tenant(
+            tenant_id,
+            host=settings.get('db_host', 'localhost'),
+            user=settings.get('db_user'),
+            password=password,
+            database=settings.get('db_name'),
+            admins=settings.get('admins', ()),
+            reports_dir=settings.get('reports_dir', os.path.join(REPORTS_DIR, tenant_id)),
+            backup_dir=settings.get('backup_dir', os.path.join(BACKUP_DIR, tenant_id)),
+            name=settings.get('name'),
+        )
+        for user_id in tenant.admins:
+            if user_id in owners:
+                raise Exception(f"Admin {user_id} is mapped to both {owners[user_id]} and {tenant_id}")
+            owners[user_id] = tenant_id
+        tenants[tenant_id] = tenant
+    if not tenants:
+        raise Exception(f"No tenants configured in {path}")
+    return tenants
+
+tenants = load_tenants()
+_owners = {user_id: tenant for tenant in tenants.values() for user_id in tenant.admins}
+
+# Ensure every tenant's directories exist
+for _tenant in tenants.values():
+    os.makedirs(_tenant.reports_dir, exist_ok=True)
+    os.makedirs(_tenant.backup_dir, exist_ok=True)
+
+# Tenant of the update being handled; jobs copy it along with the rest of the context
+_current = contextvars.ContextVar('tenant', default=None)
+
+def get_tenant(tenant_id):
+    """Return the tenant with the given id"""
+    try:
+        return tenants[tenant_id]
+    except KeyError:
+        raise Exception(f"Unknown tenant: {tenant_id}")
+
+def all_tenants():
+    return list(tenants.values())
+
+def tenant_for_user(user_id):
+    """Tenant a Telegram user is an admin of, or None"""
+    return _owners.get(user_id)
+
+def set_tenant(tenant):
+    """Make tenant current for the rest of this context, e.g. an update's handlers and jobs"""
+    _current.set(tenant)
+    return tenant
+
+@contextlib.contextmanager
+def use_tenant(tenant):
+    """Make tenant current inside the block"""
+    token = _current.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current.reset(token)
+
+def current_tenant():
+    """Tenant of the current update or job; outside of one, TENANT or the only configured tenant"""
+    tenant = _current.get()
+    if tenant is not None:
+        return tenant
+    if TENANT:
+        return get_tenant(TENANT)
+    if len(tenants) == 1:
+        return next(iter(tenants.values()))
+    raise Exception('No tenant selected; set TENANT to choose one')
+
+def current_tenant_id():
+    """Id of the current tenant, or None when there is none"""
+    tenant = _current.get()
+    if tenant is not None:
+        return tenant.id
+    if TENANT or len(tenants) == 1:
+        return current_tenant().id
+    return None
+
+class TenantLocal:
+    """One instance of factory(tenant) per tenant, created on first use
+
+    Attribute access goes to the current tenant's instance, so a module
+    level store keeps being used as before while each tenant gets its own.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def get(self, tenant=None):
+        tenant = tenant or current_tenant()
+        with self._lock:
+            instance = self._instances.get(tenant.id)
+            if instance is None:
+                instance = self._instances[tenant.id] = self._factory(tenant)
+        return instance
+
+    def instances(self):
+        """{tenant id: instance} of the tenants that have used it"""
+        with self._lock:
+            return dict(self._instances)
+
+    def stats_by_tenant(self):
+        return {tenant_id: instance.stats() for tenant_id, instance in self.instances().items()}
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
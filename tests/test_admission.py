@@ -0,0 +1,67 @@
+import pytest
+import admission
+from admission import AdmissionController, TokenBucket
+
+class FakeJobs:
+    def __init__(self):
+        self.backups = {}
+
+    def active(self, job_type, tenant=None):
+        return self.backups.get(tenant, 0) if job_type == 'backup' else 0
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: now[0])
+    return now
+
+def test_bucket_allows_a_burst_then_refills():
+    bucket = TokenBucket(3, 60)
+    for _ in range(3):
+        assert bucket.wait_time(bucket.updated) == 0
+        bucket.take()
+    assert bucket.wait_time(bucket.updated) == pytest.approx(20)
+    assert bucket.wait_time(bucket.updated + 20) == 0
+
+def test_bucket_never_holds_more_than_its_capacity():
+    bucket = TokenBucket(2, 10)
+    bucket.wait_time(bucket.updated + 3600)
+    assert bucket.tokens == 2
+
+def test_per_command_limit(clock):
+    controller = AdmissionController(user_limit=(30, 60), limits={'export': (2, 600)}, jobs=FakeJobs())
+    assert controller.admit(1, 'export', 'export') == (None, 0)
+    assert controller.admit(1, 'export', 'export') == (None, 0)
+    reason, wait = controller.admit(1, 'export', 'export')
+    assert reason == 'rate' and wait == pytest.approx(300)
+
+    # Other users and commands have their own buckets
+    assert controller.admit(2, 'export', 'export') == (None, 0)
+    assert controller.admit(1, 'sales', 'report') == (None, 0)
+    clock[0] += 300
+    assert controller.admit(1, 'export', 'export') == (None, 0)
+
+def test_refused_command_takes_no_tokens(clock):
+    controller = AdmissionController(user_limit=(2, 60), limits={'backup': (1, 3600)}, jobs=FakeJobs())
+    assert controller.admit(1, 'backup', 'backup') == (None, 0)
+    assert controller.admit(1, 'backup', 'backup')[0] == 'rate'
+    # The refused backup didn't use the user's second token
+    assert controller.admit(1, 'sales', 'report') == (None, 0)
+    assert controller.admit(1, 'sales', 'report')[0] == 'rate'
+    assert controller.stats()['rate_limited'] == 2
+
+def test_star_applies_to_unlisted_commands(clock):
+    controller = AdmissionController(user_limit=(30, 60), limits={'*': (1, 60)}, jobs=FakeJobs())
+    assert controller.admit(1, 'sales', 'report') == (None, 0)
+    assert controller.admit(1, 'sales', 'report')[0] == 'rate'
+    assert controller.admit(1, 'payments', 'report') == (None, 0)
+
+def test_backups_are_capped_per_tenant(clock):
+    jobs = FakeJobs()
+    controller = AdmissionController(user_limit=(30, 60), limits={}, max_backups=1, jobs=jobs)
+    tenant = admission.current_tenant_id()
+    jobs.backups[tenant] = 1
+    assert controller.admit(1, 'backup', 'backup') == ('backups', 0)
+    assert controller.admit(1, 'sales', 'report') == (None, 0)
+    jobs.backups[tenant] = 0
+    assert controller.admit(1, 'backup', 'backup') == (None, 0)
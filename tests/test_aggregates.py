@@ -0,0 +1,84 @@
+import sqlite3
+import datetime
+import pytest
+import aggregates
+from aggregates import AggregateStore
+
+TODAY = datetime.date.today()
+
+@pytest.fixture
+def source(monkeypatch):
+    """SQLite stand-in for the Perfex tables, ids growing with the date as in a real install"""
+    db = sqlite3.connect(':memory:', check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.create_function('YEAR', 1, lambda value: int(value[:4]) if value else None)
+    db.create_function('MONTH', 1, lambda value: int(value[5:7]) if value else None)
+    db.executescript("""
+        CREATE TABLE tblinvoices (id INTEGER PRIMARY KEY, date TEXT, total INTEGER, status INTEGER);
+        CREATE TABLE tblinvoicepaymentrecords (id INTEGER PRIMARY KEY, date TEXT, amount INTEGER, paymentmode TEXT);
+    """)
+    for index in range(1, 401):
+        day = (TODAY - datetime.timedelta(days=400 - index)).isoformat()
+        db.execute("INSERT INTO tblinvoices VALUES (?, ?, ?, ?)", (index, day, index * 10, 5 if index % 7 == 0 else 2))
+        db.execute("INSERT INTO tblinvoicepaymentrecords VALUES (?, ?, ?, ?)", (index, day, index, str(index % 3)))
+    queries = []
+
+    def execute_query(query, params=None, **kwargs):
+        params = [value.isoformat() if isinstance(value, datetime.date) else value for value in params or ()]
+        queries.append((query, params))
+        return [dict(row) for row in db.execute(query.replace('%s', '?'), params)]
+
+    monkeypatch.setattr(aggregates, 'execute_query', execute_query)
+    return db, queries
+
+def _rebuilt(tmp_path, fact, name):
+    store = AggregateStore(str(tmp_path / name))
+    store.rebuild(fact)
+    return store.rows(fact)
+
+@pytest.mark.parametrize('fact', ['sales', 'payments'])
+def test_refresh_matches_a_rebuild(source, tmp_path, fact):
+    db, queries = source
+    store = AggregateStore(str(tmp_path / 'aggregates.db'))
+    assert store.refresh(fact) is None  # First refresh rebuilds
+
+    table = aggregates.FACTS[fact]['table']
+    previous = (TODAY.replace(day=1) - datetime.timedelta(days=1)).isoformat()
+    db.execute(f"INSERT INTO {table} VALUES (401, ?, 1000, ?)", (TODAY.isoformat(), '2' if fact == 'sales' else '1'))
+    if fact == 'sales':
+        # Cancelled last month, and an old cancellation reinstated
+        db.execute("UPDATE tblinvoices SET status = 5 WHERE date = ?", (previous,))
+        db.execute("UPDATE tblinvoices SET status = 2 WHERE id = 392")
+    else:
+        db.execute("UPDATE tblinvoicepaymentrecords SET amount = 7 WHERE date = ?", (previous,))
+    del queries[:]
+
+    assert store.refresh(fact) >= 2
+    # One grouped query over the ids of the recent months, not one date range scan per month
+    [(query, params)] = [(query, params) for query, params in queries if 'GROUP BY' in query]
+    assert store.rows(fact) == _rebuilt(tmp_path, fact, 'rebuilt.db')
+
+    month_start = (TODAY.replace(day=1) - datetime.timedelta(days=1)).replace(day=1).isoformat()
+    [(first_id,)] = db.execute(f"SELECT MIN(id) FROM {table} WHERE date >= ?", (month_start,))
+    assert params[0] == first_id and first_id > 300
+
+def test_backdated_rows_widen_the_id_range(source, tmp_path):
+    db, queries = source
+    store = AggregateStore(str(tmp_path / 'aggregates.db'))
+    store.rebuild('sales')
+    old = (TODAY - datetime.timedelta(days=300)).isoformat()
+    db.execute("INSERT INTO tblinvoices VALUES (401, ?, 5, 2)", (old,))
+    del queries[:]
+
+    store.refresh('sales')
+    [(query, params)] = [(query, params) for query, params in queries if 'GROUP BY' in query]
+    assert params[0] < 101
+    assert store.rows('sales') == _rebuilt(tmp_path, 'sales', 'rebuilt.db')
+
+def test_refresh_respects_max_age(source, tmp_path):
+    _, queries = source
+    store = AggregateStore(str(tmp_path / 'aggregates.db'))
+    store.refresh('sales')
+    del queries[:]
+    assert store.refresh('sales', max_age=60) == 0
+    assert queries == []
@@ -0,0 +1,238 @@
+"""Tests of the parallel and incremental backup formats
+
+The MySQL tests run against the benchmark schema in the database named by
+TEST_DATABASE (on DB_HOST, as DB_USER) and are skipped when it is unset:
+
+    TEST_DATABASE=perfex_test python -m pytest tests
+"""
+import os
+import decimal
+import datetime
+import pytest
+import backups
+from backups import sql_literal, quote_identifier, write_manifest, write_chain, rebuild_chain
+from tenants import Tenant, use_tenant
+
+TEST_DATABASE = os.getenv('TEST_DATABASE')
+
+class FakeCursor:
+    def __init__(self, names, rows):
+        self.description = [(name,) for name in names]
+        self.rows = list(rows)
+        self.query = None
+        self.params = None
+
+    def execute(self, query, params=()):
+        self.query = query
+        self.params = params
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+def test_sql_literal_values():
+    assert sql_literal(None) == 'NULL'
+    assert sql_literal(True) == '1'
+    assert sql_literal(42) == '42'
+    assert sql_literal(decimal.Decimal('1234.50')) == '1234.50'
+    assert sql_literal(b'\x00\xffab') == '0x00ff6162'
+    assert sql_literal(b'') == "''"
+    assert sql_literal(datetime.date(2024, 2, 29)) == "'2024-02-29'"
+    assert sql_literal(datetime.datetime(2024, 2, 29, 13, 5, 1, 250)) == "'2024-02-29 13:05:01.000250'"
+    assert sql_literal(datetime.timedelta(hours=-1, minutes=-30)) == "'-01:30:00'"
+    assert sql_literal({'b', 'a'}) == "'a,b'"
+
+def test_sql_literal_escapes_strings_onto_one_line():
+    literal = sql_literal("it's\\\n\r\0\x1a;")
+    assert literal == "'it\\'s\\\\\\n\\r\\0\\Z;'"
+    assert '\n' not in literal
+
+def _dump(tmp_path, names, rows, options=None):
+    cursor = FakeCursor(names, rows)
+    options = dict({'directory': str(tmp_path), 'compression': 'none'}, **(options or {}))
+    result = backups._dump_table(FakeConnection(cursor), 'tblproposals', options)
+    with open(tmp_path / result['file'], encoding='utf-8') as file:
+        return cursor, result, file.read().splitlines(keepends=True)
+
+def test_dump_caps_statements_by_bytes(tmp_path, monkeypatch):
+    monkeypatch.setattr(backups, 'BACKUP_INSERT_BYTES', 2000)
+    rows = [(index, 'ä' * 300) for index in range(1, 21)]
+    rows.append((21, 'x' * 5000))
+    _, result, lines = _dump(tmp_path, ['id', 'content'], rows)
+
+    assert result['rows'] == 21
+    assert len(lines) > 1
+    # A row larger than the limit gets a statement of its own
+    assert lines[-1].startswith('INSERT INTO `tblproposals` (`id`, `content`) VALUES (21,')
+    assert all(len(line.encode('utf-8')) <= 2000 for line in lines[:-1])
+    assert sum(line.count('),(') + 1 for line in lines) == 21
+
+def test_dump_caps_statements_by_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(backups, 'BACKUP_INSERT_ROWS', 3)
+    _, result, lines = _dump(tmp_path, ['id'], [(index,) for index in range(1, 8)])
+    assert [line.count('),(') + 1 for line in lines] == [3, 3, 1]
+    expected = 0
+    for index in range(1, 8):
+        expected = backups._checksum(expected, f'({index})'.encode('utf-8'))
+    assert result['checksum'] == expected
+
+def test_incremental_dump_selects_rows_past_watermarks(tmp_path):
+    options = {
+        'watermarks': {'tblproposals': {'key': 'id', 'change': 'last_updated'}},
+        'since': {'tblproposals': {'key': 10, 'change': '2024-01-01 00:00:00'}},
+    }
+    rows = [(4, datetime.datetime(2024, 3, 1)), (11, datetime.datetime(2023, 12, 1))]
+    cursor, result, lines = _dump(tmp_path, ['id', 'last_updated'], rows, options)
+
+    assert cursor.query.endswith('WHERE `id` > %s OR `last_updated` > %s')
+    assert cursor.params == [10, '2024-01-01 00:00:00']
+    assert lines[0].startswith('REPLACE INTO `tblproposals`')
+    assert result['watermark'] == {'key': 11, 'change': '2024-03-01 00:00:00'}
+
+def _write_table(directory, name, statement):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{name}.sql"), 'w', encoding='utf-8') as file:
+        file.write(statement + '\n')
+    return {'name': name, 'file': f"{name}.sql", 'create': f"CREATE TABLE {quote_identifier(name)} (id INT)"}
+
+def test_rebuild_chain_applies_deltas_in_order(tmp_path):
+    chain = {
+        'format': 1,
+        'database': 'crm',
+        'created': '20240101-000000',
+        'mode': 'watermark',
+        'base': {'directory': 'base', 'created': '20240101-000000'},
+        'deltas': [],
+    }
+    base = tmp_path / 'base'
+    write_manifest(str(base), {
+        'compression': 'none',
+        'tables': [_write_table(str(base), 't', "INSERT INTO `t` (`id`) VALUES (1);")],
+        'views': [],
+    })
+    for number, created in enumerate(('20240102-000000', '20240103-000000'), start=2):
+        name = f"delta-{number - 1:04d}-{created}"
+        directory = tmp_path / name
+        write_manifest(str(directory), {
+            'compression': 'none',
+            'tables': [_write_table(str(directory), 't', f"REPLACE INTO `t` (`id`) VALUES ({number});")],
+        })
+        chain['deltas'].append({'directory': name, 'created': created, 'mode': 'watermark'})
+    write_chain(str(tmp_path), chain)
+
+    with open(rebuild_chain(str(tmp_path), output=str(tmp_path / 'all.sql')), encoding='utf-8') as file:
+        dump = file.read()
+    positions = [dump.index(f"VALUES ({number});") for number in (1, 2, 3)]
+    assert positions == sorted(positions)
+    assert dump.index('DROP TABLE IF EXISTS `t`') < positions[0]
+
+    with open(rebuild_chain(str(tmp_path), until='20240102-120000', output=str(tmp_path / 'until.sql')),
+              encoding='utf-8') as file:
+        dump = file.read()
+    assert 'VALUES (2);' in dump and 'VALUES (3);' not in dump
+
+    with pytest.raises(Exception, match='starts at'):
+        rebuild_chain(str(tmp_path), until='20231231-000000')
+
+@pytest.fixture
+def mysql_tenant(tmp_path):
+    """Tenant of a scratch database holding a few hundred synthetic Perfex rows"""
+    if not TEST_DATABASE:
+        pytest.skip('TEST_DATABASE is not set')
+    import mysql.connector
+    from benchmarks.schema import create_schema, populate
+
+    tenant = Tenant(
+        'test', os.getenv('DB_HOST', 'localhost'), os.getenv('DB_USER'), os.getenv('DB_PASSWORD'),
+        TEST_DATABASE, reports_dir=str(tmp_path), backup_dir=str(tmp_path),
+    )
+    config = tenant.connection_config()
+    server = mysql.connector.connect(**dict(config, database=None))
+    cursor = server.cursor()
+    for database in (TEST_DATABASE, f"{TEST_DATABASE}_rebuilt"):
+        cursor.execute(f"DROP DATABASE IF EXISTS {quote_identifier(database)}")
+        cursor.execute(f"CREATE DATABASE {quote_identifier(database)}")
+    cursor.close()
+    server.close()
+
+    connection = mysql.connector.connect(**config)
+    cursor = connection.cursor()
+    create_schema(cursor)
+    populate(connection, 300)
+    # A last-change column, so edited invoices move the watermark
+    cursor.execute("ALTER TABLE tblinvoices ADD COLUMN last_updated DATETIME NULL")
+    cursor.execute("UPDATE tblinvoices SET last_updated = datecreated")
+    connection.commit()
+    cursor.close()
+    yield tenant, connection
+    connection.close()
+
+def _contents(connection, database, table):
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT * FROM {quote_identifier(database)}.{quote_identifier(table)} ORDER BY 1")
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def test_incremental_chain_rebuilds_the_database(mysql_tenant, tmp_path):
+    from benchmarks.schema import TABLES
+
+    tenant, connection = mysql_tenant
+    cursor = connection.cursor()
+    with use_tenant(tenant):
+        backups.incremental_backup(workers=2, compression='none', mode='watermark')
+
+        cursor.execute("UPDATE tblinvoices SET total = total + 1, last_updated = NOW() + INTERVAL 1 DAY WHERE id = 5")
+        cursor.execute(
+            "INSERT INTO tblinvoices (number, clientid, date, subtotal, total, datecreated, last_updated) "
+            "VALUES (301, 1, CURDATE(), 10, 10, NOW(), NOW())"
+        )
+        cursor.execute("INSERT INTO tblpaymentmodes (name) VALUES ('Crypto')")
+        connection.commit()
+        directory, chain, entry = backups.incremental_backup(workers=2, compression='none', mode='watermark')
+
+        manifest = backups.read_manifest(os.path.join(directory, entry['directory']))
+        delta_rows = {table['name']: table['rows'] for table in manifest['tables']}
+        assert delta_rows['tblinvoices'] == 2
+        assert delta_rows['tblpaymentmodes'] == 1
+
+        dump = rebuild_chain(directory, output=str(tmp_path / 'rebuilt.sql'))
+
+    cursor.execute(f"USE {quote_identifier(TEST_DATABASE + '_rebuilt')}")
+    with open(dump, encoding='utf-8') as file:
+        for statement in file.read().split(';\n'):
+            if statement.strip():
+                cursor.execute(statement)
+    connection.commit()
+    cursor.close()
+
+    for table in TABLES:
+        assert _contents(connection, TEST_DATABASE + '_rebuilt', table) == _contents(connection, TEST_DATABASE, table)
+
+def test_sql_literal_round_trips_through_mysql(mysql_tenant):
+    _, connection = mysql_tenant
+    values = (
+        b'\x00\x01\xfe\xff', None, datetime.date(2024, 2, 29), datetime.datetime(2024, 2, 29, 13, 5, 1, 250),
+        datetime.timedelta(hours=-26, seconds=-5), decimal.Decimal('-1234567.891234'), "it's \\ a\n\r\0\x1a test ✓",
+    )
+    cursor = connection.cursor()
+    cursor.execute("""
+        CREATE TEMPORARY TABLE literals (
+            b BLOB, n INT, d DATE, dt DATETIME(6), t TIME, m DECIMAL(20,6), s TEXT CHARACTER SET utf8mb4
+        )
+    """)
+    cursor.execute(f"INSERT INTO literals VALUES ({','.join(map(sql_literal, values))})")
+    cursor.execute("SELECT * FROM literals")
+    row = cursor.fetchone()
+    cursor.close()
+    assert tuple(bytes(value) if isinstance(value, bytearray) else value for value in row) == values
@@ -0,0 +1,62 @@
+import pytest
+import cache
+from cache import ResultCache, cache_key
+from tenants import Tenant, use_tenant
+
+ROWS = [{'month': '2024-01', 'total': 100}]
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    return now
+
+def test_hit_within_ttl_and_expiry_after(clock):
+    results = ResultCache()
+    results.set('key', ROWS)
+    clock[0] += 59
+    assert results.get('key', 60) == ROWS
+    clock[0] += 2
+    assert results.get('key', 60) is None
+    # Expired entries are dropped, not served again later
+    assert results.get('key', 3600) is None
+    assert results.stats()['expired'] == 1
+
+def test_moved_watermark_invalidates(clock):
+    results = ResultCache()
+    results.set('key', ROWS, watermark=(('tblinvoices', 41),))
+    assert results.get('key', 60, (('tblinvoices', 41),)) == ROWS
+    assert results.get('key', 60, (('tblinvoices', 42),)) is None
+    assert results.get('key', 60, (('tblinvoices', 41),)) is None
+    assert results.stats()['stale'] == 1
+
+def test_hands_out_copies(clock):
+    results = ResultCache()
+    results.set('key', ROWS)
+    results.get('key', 60)[0]['total'] = 0
+    assert results.get('key', 60) == ROWS
+
+def test_evicts_least_recently_used(clock):
+    results = ResultCache(max_entries=2)
+    results.set('a', ROWS)
+    results.set('b', ROWS)
+    results.get('a', 60)
+    results.set('c', ROWS)
+    assert results.get('b', 60) is None
+    assert results.get('a', 60) == ROWS
+    assert results.stats()['evictions'] == 1
+
+def test_disk_copy_survives_a_restart(clock, tmp_path):
+    ResultCache(cache_dir=str(tmp_path)).set('key', ROWS, watermark=1)
+    results = ResultCache(cache_dir=str(tmp_path))
+    assert results.get('key', 60, 1) == ROWS
+    assert results.stats()['disk_hits'] == 1
+
+def test_keys_differ_by_tenant_and_params_not_whitespace():
+    query = "SELECT * FROM tblinvoices WHERE id > %s"
+    with use_tenant(Tenant('a')):
+        key = cache_key(query, [1])
+        assert cache_key("SELECT *\n  FROM tblinvoices   WHERE id > %s", [1]) == key
+        assert cache_key(query, [2]) != key
+    with use_tenant(Tenant('b')):
+        assert cache_key(query, [1]) != key
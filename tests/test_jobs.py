@@ -0,0 +1,159 @@
+import threading
+import pytest
+import jobs as jobs_module
+from jobs import JobManager, JobCancelled, current_job, DONE, CANCELLED
+from tenants import Tenant, use_tenant
+
+@pytest.fixture
+def manager():
+    managers = []
+
+    def make(**kwargs):
+        kwargs.setdefault('render_workers', 0)
+        kwargs.setdefault('priorities', {'report': 0, 'scheduled': 1, 'export': 2, 'backup': 3})
+        managers.append(JobManager(**kwargs))
+        return managers[-1]
+    yield make
+    for jobs in managers:
+        jobs.shutdown()
+
+def _blocker(jobs, job_type='backup'):
+    release = threading.Event()
+    job = jobs.submit(job_type, release.wait, 5)
+    return job, release
+
+def test_higher_priority_types_start_first(manager):
+    jobs = manager(workers=1)
+    blocker, release = _blocker(jobs)
+    started = []
+    queued = [
+        jobs.submit('export', started.append, 'export'),
+        jobs.submit('backup', started.append, 'backup'),
+        jobs.submit('report', started.append, 'report'),
+    ]
+    assert [jobs.position(job) for job in queued] == [2, 3, 1]
+
+    release.set()
+    for job in queued:
+        assert job.wait(5)
+    assert started == ['report', 'export', 'backup']
+
+def test_type_limits_let_other_types_through(manager):
+    jobs = manager(workers=2, limits={'report': 1})
+    report, release = _blocker(jobs, 'report')
+    waiting = jobs.submit('report', lambda: None)
+    export = jobs.submit('export', lambda: None)
+
+    assert export.wait(5) and export.status == DONE
+    assert jobs.position(waiting) == 1
+    assert jobs.stats()['report'] == {'running': 1, 'queued': 1, 'limit': 1}
+    release.set()
+    assert waiting.wait(5)
+
+def test_position_ignores_types_held_back_by_their_limit(manager):
+    jobs = manager(workers=2, limits={'report': 1, 'export': 2})
+    report, release_report = _blocker(jobs, 'report')
+    export, release_export = _blocker(jobs, 'export')
+    reports = [jobs.submit('report', lambda: None) for _ in range(3)]
+    queued = jobs.submit('export', lambda: None)
+
+    # The reports wait for the report slot, not for the worker the export gets next
+    assert jobs.position(queued) == 1
+    assert [jobs.position(job) for job in reports] == [1, 2, 3]
+
+    release_export.set()
+    assert queued.wait(5)
+    release_report.set()
+    for job in reports:
+        assert job.wait(5)
+
+def test_position_counts_higher_priority_jobs_up_to_their_limit(manager):
+    jobs = manager(workers=1, limits={'report': 2})
+    blocker, release = _blocker(jobs)
+    for _ in range(4):
+        jobs.submit('report', lambda: None)
+    export = jobs.submit('export', lambda: None)
+    assert jobs.position(export) == 3
+    release.set()
+    assert export.wait(5)
+
+def test_cancel_queued_job(manager):
+    jobs = manager(workers=1)
+    blocker, release = _blocker(jobs)
+    started = []
+    job = jobs.submit('export', started.append, 'export')
+
+    assert jobs.cancel(job.id)
+    assert job.status == CANCELLED and jobs.position(job) == 0
+    release.set()
+    assert blocker.wait(5)
+    assert started == []
+    assert not jobs.cancel(job.id)
+
+def test_tenants_take_turns_within_a_type(manager):
+    jobs = manager(workers=1)
+    blocker, release = _blocker(jobs)
+    started = []
+    with use_tenant(Tenant('a')):
+        first = [jobs.submit('export', started.append, f'a{index}') for index in range(1, 4)]
+    with use_tenant(Tenant('b')):
+        second = jobs.submit('export', started.append, 'b1')
+
+    assert jobs.position(second) == 2
+    assert [jobs.position(job) for job in first] == [1, 3, 4]
+    assert jobs.active('export', 'a') == 3
+
+    release.set()
+    for job in first + [second]:
+        assert job.wait(5)
+    assert started == ['a1', 'b1', 'a2', 'a3']
+
+def test_scheduler_leaves_the_job_limits_alone(monkeypatch):
+    import jobs
+    import scheduler
+    monkeypatch.setattr(jobs.job_manager, 'limits', {'report': 3})
+    scheduler.Scheduler(times=[])
+    assert jobs.job_manager.limits == {'report': 3}
+    assert 'scheduled' in jobs.JOB_CONCURRENCY
+
+def test_scheduled_jobs_wait_in_the_queue_for_interactive_reports(manager):
+    jobs = manager(workers=2, deferred={'scheduled': 60})
+    report, release = _blocker(jobs, 'report')
+    scheduled = jobs.submit('scheduled', lambda: None)
+
+    # Held back without taking a worker: an export still gets the free one
+    export = jobs.submit('export', lambda: None)
+    assert export.wait(5)
+    assert scheduled.status == 'queued' and jobs.position(scheduled) == 1
+    assert jobs.cancel(scheduled.id) and scheduled.status == CANCELLED
+
+    scheduled = jobs.submit('scheduled', lambda: None)
+    release.set()
+    assert scheduled.wait(5) and scheduled.status == DONE
+
+def test_scheduled_jobs_start_anyway_after_the_longest_hold(manager):
+    jobs = manager(workers=2, deferred={'scheduled': 0.2})
+    report, release = _blocker(jobs, 'report')
+    scheduled = jobs.submit('scheduled', lambda: None)
+    assert scheduled.wait(5) and scheduled.status == DONE
+    assert report.status == 'running'
+    release.set()
+
+def test_job_stopping_on_cancel_ends_cancelled_not_failed(manager, monkeypatch):
+    errors = []
+    monkeypatch.setattr(jobs_module.ERRORS, 'inc', lambda **labels: errors.append(labels))
+    jobs = manager(workers=1)
+    started = threading.Event()
+
+    def export():
+        started.set()
+        while True:
+            if current_job().cancelled:
+                raise JobCancelled()
+            started.wait(0.01)
+
+    job = jobs.submit('export', export)
+    assert started.wait(5) and jobs.cancel(job.id)
+    assert job.wait(5)
+    assert job.status == CANCELLED and job.error is None
+    assert errors == []
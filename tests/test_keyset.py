@@ -0,0 +1,67 @@
+import datetime
+import pytest
+import reports
+from reports import EXPORTS, _page_query, keyset_rows, parse_status
+
+DAY = datetime.date(2024, 3, 1)
+
+def test_first_page_has_no_keyset_condition():
+    query, params = _page_query(EXPORTS['invoices'], ["tblinvoices.status = %s"], [2], None, 50)
+    assert query.rstrip().endswith("ORDER BY tblinvoices.date DESC, tblinvoices.id DESC\n    LIMIT %s")
+    assert "WHERE tblinvoices.status = %s\n" in query
+    assert params == [2, 50]
+
+def test_later_pages_continue_after_the_last_key():
+    query, params = _page_query(EXPORTS['payments'], [], [], (DAY, 17), 50)
+    assert (
+        "WHERE (tblinvoicepaymentrecords.date < %s OR "
+        "(tblinvoicepaymentrecords.date = %s AND tblinvoicepaymentrecords.id < %s))" in query
+    )
+    assert params == [DAY, DAY, 17, 50]
+    assert 'OFFSET' not in query
+
+def _fake_table(rows):
+    """execute_query stand-in answering unfiltered invoice pages from rows"""
+    queries = []
+
+    def execute_query(query, params, **kwargs):
+        queries.append(params)
+        *keyset, limit = params
+        ordered = sorted(rows, key=lambda row: (row['date'], row['id']), reverse=True)
+        if keyset:
+            last = (keyset[0], keyset[2])
+            ordered = [row for row in ordered if (row['date'], row['id']) < last]
+        return [dict(row) for row in ordered[:limit]]
+    return execute_query, queries
+
+def test_pages_neither_skip_nor_repeat_rows_sharing_a_date(monkeypatch):
+    # Many rows per date, so page boundaries fall inside a date
+    rows = [{'id': index, 'date': DAY - datetime.timedelta(days=index % 4)} for index in range(1, 24)]
+    execute_query, queries = _fake_table(rows)
+    monkeypatch.setattr(reports, 'execute_query', execute_query)
+    progress = []
+
+    fetched = list(keyset_rows('invoices', batch_size=5, progress=lambda count, date: progress.append(count)))
+
+    assert sorted(row['id'] for row in fetched) == list(range(1, 24))
+    assert fetched == sorted(fetched, key=lambda row: (row['date'], row['id']), reverse=True)
+    assert progress == [5, 10, 15, 20, 23]
+    # The short last page ends the export without another query
+    assert len(queries) == 5
+
+def test_max_rows_stops_early(monkeypatch):
+    rows = [{'id': index, 'date': DAY} for index in range(1, 50)]
+    execute_query, queries = _fake_table(rows)
+    monkeypatch.setattr(reports, 'execute_query', execute_query)
+
+    fetched = list(keyset_rows('invoices', max_rows=12, batch_size=5))
+    assert [row['id'] for row in fetched] == list(range(49, 37, -1))
+    assert [params[-1] for params in queries] == [5, 5, 2]
+
+def test_status_names_and_codes():
+    assert parse_status('invoices', 'partially paid') == 3
+    assert parse_status('proposals', '0') == 0
+    with pytest.raises(Exception, match='Unknown invoices status'):
+        parse_status('invoices', 'lost')
+    with pytest.raises(Exception, match="can't be filtered"):
+        parse_status('payments', 'paid')
@@ -0,0 +1,16 @@
+from profiler import profiler
+from tenants import Tenant, use_tenant
+
+def test_profiles_are_kept_per_tenant():
+    with use_tenant(Tenant('a')):
+        profiler.clear()
+        profiler.record("SELECT * FROM tblinvoices WHERE clientid = %s", 0.5, 10, 1000)
+        profiler.record("SELECT *  FROM tblinvoices WHERE clientid = %s", 0.25, 5, 500)
+    with use_tenant(Tenant('b')):
+        assert profiler.profiles() == []
+
+    with use_tenant(Tenant('a')):
+        [profile] = profiler.profiles()
+    assert profile['count'] == 2
+    assert profile['rows'] == 15 and profile['examined'] == 1500
+    assert profile['avg_seconds'] == 0.375
@@ -0,0 +1,96 @@
+import time
+import threading
+import pytest
+from singleflight import SingleFlight
+from tenants import Tenant, use_tenant
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+def _call_in_threads(flight, key, fn, count, tenant=None):
+    results = [None] * count
+    errors = [None] * count
+
+    def call(index):
+        try:
+            if tenant is None:
+                results[index] = flight.do(key, fn)
+            else:
+                with use_tenant(tenant):
+                    results[index] = flight.do(key, fn)
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    release = threading.Event()
+    executions = []
+
+    def build():
+        executions.append(1)
+        release.wait(5)
+        return 'report.xlsx'
+
+    threads, results, errors = _call_in_threads(flight, ('sales',), build, 5)
+    _wait_for(lambda: flight.stats()['coalesced'] == 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert executions == [1]
+    assert results == ['report.xlsx'] * 5
+    assert errors == [None] * 5
+    assert flight.stats()['in_flight'] == 0
+    assert flight.stats()['coalesced_by_group'] == {'sales': 4}
+
+    # Once finished, the next call runs again
+    assert flight.do(('sales',), lambda: 'new.xlsx') == 'new.xlsx'
+
+def test_waiters_get_the_leaders_error():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def build():
+        release.wait(5)
+        raise ValueError('database is down')
+
+    threads, results, errors = _call_in_threads(flight, 'payments', build, 3)
+    _wait_for(lambda: flight.stats()['coalesced'] == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert flight.stats()['executions'] == 1
+
+def test_tenants_never_share_a_call():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def build():
+        release.wait(5)
+        return 'done'
+
+    first = _call_in_threads(flight, 'sales', build, 1, Tenant('a'))
+    second = _call_in_threads(flight, 'sales', build, 1, Tenant('b'))
+    _wait_for(lambda: flight.stats()['in_flight'] == 2)
+    release.set()
+    for thread in first[0] + second[0]:
+        thread.join()
+
+    assert flight.stats()['executions'] == 2
+    assert flight.stats()['coalesced'] == 0
+
+def test_a_failed_call_is_not_kept_in_flight():
+    flight = SingleFlight()
+    with pytest.raises(KeyError):
+        flight.do('invoices', {}.__getitem__, 'missing')
+    assert flight.stats()['in_flight'] == 0
@@ -0,0 +1,94 @@
+import shutil
+import sqlite3
+import datetime
+import pytest
+import snapshots
+from snapshots import SnapshotStore, last_closed_month
+
+pytest.importorskip('pyarrow')
+
+TODAY = datetime.date.today()
+
+@pytest.fixture
+def source(monkeypatch):
+    """SQLite stand-in for the Perfex tables, with a month without invoices"""
+    db = sqlite3.connect(':memory:', check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.create_function('YEAR', 1, lambda value: int(value[:4]) if value else None)
+    db.create_function('MONTH', 1, lambda value: int(value[5:7]) if value else None)
+    db.executescript("""
+        CREATE TABLE tblinvoices (
+            id INTEGER PRIMARY KEY, number INTEGER, clientid INTEGER, date TEXT, duedate TEXT,
+            status INTEGER, subtotal INTEGER, total_tax INTEGER, total INTEGER
+        );
+    """)
+    gap = (TODAY.replace(day=1) - datetime.timedelta(days=100)).replace(day=1)
+    for index in range(1, 301):
+        day = TODAY - datetime.timedelta(days=300 - index)
+        if day.replace(day=1) == gap:
+            continue
+        db.execute(
+            "INSERT INTO tblinvoices VALUES (?, ?, 1, ?, ?, ?, ?, 0, ?)",
+            (index, index, day.isoformat(), day.isoformat(), 5 if index % 7 == 0 else 2, index, index)
+        )
+    queries = []
+
+    def rows(query, params):
+        params = [value.isoformat() if isinstance(value, datetime.date) else value for value in params or ()]
+        queries.append(query)
+        for row in db.execute(query.replace('%s', '?'), params):
+            row = dict(row)
+            for name in ('date', 'duedate'):
+                if isinstance(row.get(name), str):
+                    row[name] = datetime.date.fromisoformat(row[name])
+            yield row
+
+    monkeypatch.setattr(snapshots, 'execute_query', lambda query, params=None, **kwargs: list(rows(query, params)))
+    monkeypatch.setattr(snapshots, 'stream_query', lambda query, params=None, **kwargs: rows(query, params))
+    return db, queries, gap
+
+def _first_month():
+    first = TODAY - datetime.timedelta(days=299)
+    return (first.year, first.month)
+
+def test_update_writes_every_missing_month_in_one_pass(source, tmp_path):
+    _, queries, gap = source
+    store = SnapshotStore(str(tmp_path))
+    written = store.update('invoices')
+
+    assert written == list(snapshots._months(_first_month(), last_closed_month()))
+    assert sorted(store.partitions('invoices')) == written
+    # The oldest date, then one ordered read of all the months
+    assert len(queries) == 2 and queries[1].endswith('ORDER BY date')
+    assert store._part_totals(store.partitions('invoices')[(gap.year, gap.month)], 'sales')[0] == 0
+
+    del queries[:]
+    assert store.update('invoices') == []
+    assert queries == []
+
+def test_totals_of_missing_months_come_from_one_query_without_writing(source, tmp_path):
+    _, queries, _ = source
+    store = SnapshotStore(str(tmp_path))
+    last = (TODAY.year, TODAY.month)
+    live = store.monthly_totals('sales', _first_month(), last)
+
+    assert store.partitions('invoices') == {}
+    assert len(queries) == 1 and 'GROUP BY' in queries[0]
+
+    store.update('invoices')
+    del queries[:]
+    assert store.monthly_totals('sales', _first_month(), last) == live
+    assert all(query.startswith('SELECT YEAR') for query in queries)
+
+def test_totals_fill_a_month_without_snapshot(source, tmp_path):
+    _, queries, _ = source
+    store = SnapshotStore(str(tmp_path))
+    store.update('invoices')
+    last = (TODAY.year, TODAY.month)
+    expected = store.monthly_totals('sales', _first_month(), last)
+
+    month = sorted(store.partitions('invoices'))[1]
+    shutil.rmtree(tmp_path / 'invoices' / f"month={month[0]:04d}-{month[1]:02d}")
+    del queries[:]
+    assert store.monthly_totals('sales', _first_month(), last) == expected
+    assert len(queries) == 1 and month not in store.partitions('invoices')
@@ -0,0 +1,33 @@
+import datetime
+from storage import gfs_keep
+
+def _days(start, count, hours=(3,)):
+    return [
+        datetime.datetime.combine(start + datetime.timedelta(days=day), datetime.time(hour))
+        for day in range(count) for hour in hours
+    ]
+
+def test_keeps_the_newest_backup_of_each_recent_day():
+    times = _days(datetime.date(2024, 5, 1), 10, hours=(3, 15))
+    keep = gfs_keep(times, daily=3, weekly=0, monthly=0)
+    assert sorted(keep) == [datetime.datetime(2024, 5, day, 15) for day in (8, 9, 10)]
+
+def test_weekly_and_monthly_reach_further_back():
+    # Daily backups from 2024-01-01 (a Monday) to 2024-04-29
+    times = _days(datetime.date(2024, 1, 1), 120)
+    keep = gfs_keep(times, daily=2, weekly=2, monthly=3)
+    assert sorted(keep) == [
+        datetime.datetime(2024, 2, 29, 3),  # February
+        datetime.datetime(2024, 3, 31, 3),  # March
+        datetime.datetime(2024, 4, 28, 3),  # yesterday and last week
+        datetime.datetime(2024, 4, 29, 3),  # today, this week and April
+    ]
+
+def test_counts_only_periods_that_have_a_backup():
+    times = [datetime.datetime(2023, month, 1) for month in (1, 6, 12)]
+    assert gfs_keep(times, daily=0, weekly=0, monthly=2) == set(times[1:])
+    assert gfs_keep(times, daily=0, weekly=0, monthly=12) == set(times)
+
+def test_nothing_to_keep():
+    assert gfs_keep([], daily=7, weekly=4, monthly=12) == set()
+    assert gfs_keep(_days(datetime.date(2024, 1, 1), 5), daily=0, weekly=0, monthly=0) == set()